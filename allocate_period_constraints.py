@@ -17,27 +17,26 @@
 # overall distribution.
 ####################
 
-import os
+import os, glob, json, hashlib
 from pyomo.environ import *
+from pyomo.core.util import quicksum
+try:
+    from pyomo.core.expr.current import identify_variables
+except ImportError:
+    # Pyomo < 5.5
+    from pyomo.core.base.expr import identify_variables
 from switch_model.utilities import make_iterable
 from fix_build_vars import fix_var
+from dw_trace import usage, measure
+from file_utils import atomic_open
 
-# List of constraints and maximum amount they could be relaxed in each scenario.
-# (Bounds were needed for PHA to linearize the quadratic penalty term; not used here.)
-# note: these can be found semi-automatically via the following code,
-# but this would need to be subfiltered to only include constraints that
-# consider sums across timepoints or timeseries within the period. Then
-# we still need to assign maximum relaxation manually.
-# from pyomo.environ import *
-# first_period = m.PERIODS.first()
-# period_constraints = [
-#     V.name
-#     for V in instance.component_objects(Constraint)
-#     if any(
-#         first_period in make_iterable(idx) for idx in V.index_set()
-#     )
-# ]
-# print period_constraints
+# List of known cross-time constraints and maximum amount they could be relaxed in
+# each scenario. (Bounds were needed for PHA to linearize the quadratic penalty term;
+# here they keep slices from being unbounded when a price is attached.)
+# These are relaxed by default. Other cross-time constraints can be found
+# automatically with --discover-cross-time-constraints (see
+# discover_period_constraints()) and are relaxed along with these; they get
+# default_relax_limit.
 fuel_cell_mwh_per_kg = 0.018
 period_constraint_data = [
     ('Enforce_Fuel_Consumption', 2000*8760*10), # MMBtu/year in a fuel market
@@ -47,52 +46,95 @@ period_constraint_data = [
     ('Hydrogen_Conservation_of_Mass_Annual', 2000*8760/fuel_cell_mwh_per_kg), # kg per year
     ('Max_Store_Liquid_Hydrogen', 2000*8760/fuel_cell_mwh_per_kg) # kg per year
 ]
+default_relax_limit = 2000*8760*10
 relax_var_prefix = 'Relax_'
 
+# most recent prices read by this process, as (SHA-1 hash of the price file,
+# dict with key=(constraint name, index1, ..., indexn) as strings and
+# value=price); `switch solve-scenarios` and persistent slice workers apply
+# the same prices to many models, so each file is only parsed once
+price_file_cache = [None, None]
+
 def get_period_constraints(m):
-    return [
-        c
-        for c in (
-            getattr(m, const_data[0], None)
-            for const_data in period_constraint_data
-        )
-        if c is not None
-    ]
+    """
+    Return the cross-time constraints that are relaxed in this model (see
+    relaxed_constraint_keys()), or the known ones if there is no relaxation.
+    """
+    names = getattr(m, 'relaxed_constraints', None)
+    if names is None:
+        names = [name for name, relax_limit in period_constraint_data]
+    else:
+        names = [name for name, keys in names]
+    return [c for c in (getattr(m, name, None) for name in names) if c is not None]
 
-def move_component_above(new_component, old_component):
-    # move new component above old component within their parent block
-    block = new_component.parent_block()
-    if block is not old_component.parent_block():
-        raise ValueError(
-            'Cannot move component {} above {} because they are declared in different blocks.'
-            .format(new_component.name, old_component.name)
-        )
-    old_idx = block._decl[old_component.name]
-    new_idx = block._decl[new_component.name]
-    if new_idx < old_idx:
-        # new_component is already above old_component
-        return
+def discover_period_constraints(m):
+    """
+    Return all active constraints in the constructed model m that are indexed
+    by period and whose rows use variables from more than one timepoint or
+    timeseries (e.g., sums over all timepoints, or annual balances of
+    variables indexed by timeseries), i.e., the constraints that link
+    timepoints within a period and must be relaxed when the period is split
+    into slices. Constraints indexed by timepoint or timeseries are left out,
+    since each of their rows belongs to one slice.
+    """
+    periods = set(m.PERIODS)
+    timepoints = set(m.TIMEPOINTS)
+    timeseries = set(m.TIMESERIES)
+    found = []
+    for c in m.component_objects(Constraint, active=True):
+        if c.name.startswith(relax_var_prefix) or not c.is_indexed():
+            continue
+        first_key = set(make_iterable(next(iter(c.keys()), ())))
+        if first_key & (timepoints | timeseries):
+            continue
+        if not any(periods.intersection(make_iterable(key)) for key in c.keys()):
+            continue
+        for row in c.values():
+            row_timepoints = set()
+            row_timeseries = set()
+            for v in identify_variables(row.body):
+                for i in make_iterable(v.index()):
+                    if i in timepoints:
+                        row_timepoints.add(i)
+                        row_timeseries.add(m.tp_ts[i])
+                    elif i in timeseries:
+                        row_timeseries.add(i)
+            if len(row_timepoints) > 1 or len(row_timeseries) > 1:
+                found.append(c)
+                break
+    return found
+
+def relaxed_constraint_keys(options):
+    """
+    Return a list of (constraint name, keys) pairs for the cross-time
+    constraints to relax in this model, where keys is a set of the rows to
+    relax, as tuples of strings (as in the price file), or None to relax all
+    rows. Only constraints and rows that have prices (when solving with
+    relaxation prices) or allocated slack (when fixing the relaxation
+    variables) are relaxed, so solve_loop.py can limit the relaxation to
+    binding rows or add constraints found by discover_period_constraints().
+    Otherwise, all rows of the known constraints are relaxed.
+    """
+    relaxed = {}
+    if options.cross_time_relaxation_price_file:
+        price_hash, price_dict = read_price_file(options.cross_time_relaxation_price_file)
+        for k in price_dict:
+            relaxed.setdefault(k[0], set()).add(k[1:])
+    elif options.fix_cross_time_relaxation_variables:
+        source_dir = options.cross_time_relaxation_dir or options.inputs_dir
+        for file in glob.glob(os.path.join(source_dir, relax_var_prefix + '*.tab')):
+            name = os.path.basename(file)[len(relax_var_prefix):-len('.tab')]
+            with open(file) as f:
+                next(f) # skip headers
+                relaxed[name] = {tuple(r.rstrip('\n').split('\t')[:-1]) for r in f}
     else:
-        # reorder components
-        # see https://groups.google.com/d/msg/pyomo-forum/dLbD2ly_hZo/5-INUaECNBkJ
-        # remove all components from this block
-        block_components = [c[0] for c in block._decl_order]
-        # import pdb; pdb.set_trace()
-        for c in block_components:
-            if c is not None:
-                block.del_component(c)
-        # move the new component above the old one
-        block_components.insert(old_idx, block_components.pop(new_idx))
-        # add components back to the block
-        for c in block_components:
-            if c is not None:
-                block.add_component(c.name, c)
-        # the code below does the same thing, but seems a little too undocumented
-        # new_cmp_entry = block._decl_order.pop(new_idx)
-        # block._decl_order.insert(old_idx, new_cmp_entry)
-        # # renumber block._decl to match new indexes
-        # for i in range(old_idx, new_idx+1):
-        #     block._decl[block._decl_order[i][0].name] = i
+        return [(name, None) for name, relax_limit in period_constraint_data]
+    # keep the known constraints in their usual order, then any others
+    known = [name for name, relax_limit in period_constraint_data]
+    return [
+        (name, relaxed[name])
+        for name in sorted(relaxed, key=lambda n: (known.index(n) if n in known else len(known), n))
+    ]
 
 def relax_var_name(constraint):
     return relax_var_prefix + constraint.name
@@ -104,16 +146,28 @@ def relax_var_name(constraint):
 # programmatically.
 # If this doesn't work, we might have to extract the constraint reference from the
 # next higher frame in the call stack.
-def relax_constraint(c):
+def relax_constraint(c, keys=None):
+    # keys is a set of the rows to relax (as tuples of strings), or None for all
     constraint_name = c.name
     c.original_rule = c.rule
     def new_rule(m, *idx):
+        relax_var = getattr(m, relax_var_prefix + constraint_name)
+        if not relax_var.is_constructed():
+            # The relaxation variables are declared after the constraint (see
+            # define_components()), so we construct them the first time they
+            # are needed. Their index set (the constraint's) has already been
+            # constructed by now, and Pyomo skips already-constructed
+            # components when it reaches them in declaration order.
+            relax_var.construct()
         expr = getattr(m, constraint_name).original_rule(m, *idx)
-        if expr is not Constraint.Skip and expr is not Constraint.Infeasible:
+        if (
+            expr is not Constraint.Skip and expr is not Constraint.Infeasible
+            and (keys is None or tuple(str(i) for i in idx) in keys)
+        ):
             args = list(expr._args) # make mutable
             # add this scenario's relaxation var to the high side of the inequality (always _args[1])
             # note: this also works for equality constraints, which just need to have the same side relaxed in all cases.
-            args[1] += getattr(m, relax_var_name(c))[idx]
+            args[1] += relax_var[idx]
             expr._args = type(expr._args)(args)    # convert back to original type
         return expr
     c.rule = new_rule
@@ -125,12 +179,26 @@ def define_arguments(argparser):
              "they will be saved in a file called 'cross_time_duals.tab' in the outputs directory "
              "for use in later model runs."
     )
+    argparser.add_argument(
+        "--discover-cross-time-constraints", action='store_true',
+        help="Save duals in 'cross_time_duals.tab' for all constraints that are indexed by "
+             "period and use variables from more than one timepoint or timeseries, as well "
+             "as the known cross-time constraints. The constraints found are also listed in "
+             "'cross_time_constraints.txt' in the outputs directory."
+    )
     argparser.add_argument(
         "--save-relaxation-bid", action='store_true',
         help="Save total cost and values of relaxation variables for "
              "cross-timeseries constraints in a file called 'relaxation_bid.tab' "
              "in the outputs directory for use in later model runs."
     )
+    argparser.add_argument(
+        "--relaxation-bid-tag", default=None,
+        help="Label (e.g., iteration number) to save in 'relaxation_bid_done.json' in the "
+             "outputs directory, with a hash of the relaxation price file, after the "
+             "relaxation bid is saved. This shows which round the bid belongs to, so "
+             "finished slices can be skipped if a round is restarted."
+    )
     argparser.add_argument(
         "--add-cross-time-relaxation-variables", action='store_true',
         help="Add relaxation variables to all cross-timeseries (per-period) constraints."
@@ -144,6 +212,17 @@ def define_arguments(argparser):
         "--fix-cross-time-relaxation-variables", action='store_true',
         help="Set cross-time relaxation variables to fixed values stored in .tab files in the inputs dir."
     )
+    argparser.add_argument(
+        "--cross-time-relaxation-dir", default=None,
+        help="Directory holding the .tab files used by --fix-cross-time-relaxation-variables, "
+             "if not the inputs dir (e.g., when several base scenarios share the same slice inputs)."
+    )
+    argparser.add_argument(
+        "--warm-start-basis", action='store_true',
+        help="Save the final basis from each solution in 'warm_start.bas' in the outputs "
+             "directory and use it as the starting basis the next time the same model is "
+             "solved (e.g., with new relaxation prices). Currently only works with cplexamp."
+    )
     argparser.add_argument(
         "--no-standard-results", action='store_true',
         help="Prevent saving of results by standard switch modules (useful for minimizing disk access)."
@@ -152,14 +231,24 @@ def define_arguments(argparser):
 
 def define_components(m):
 
+    if m.options.save_relaxation_bid:
+        # note when construction starts, so we can report time and memory
+        # used to build and solve the model with the bid (used to schedule
+        # and trace slices in solve_loop.py)
+        m.build_start_usage = usage()
+
     if not m.options.no_cross_time_duals:
         # make sure the dual suffix is defined
         if not hasattr(m, "dual"):
             m.dual = Suffix(direction=Suffix.IMPORT)
 
     if m.options.add_cross_time_relaxation_variables:
-        # Add relaxation variables for all cross-time constraints
-        for constraint_name, relax_limit in period_constraint_data:
+        # Add relaxation variables for the cross-time constraints that have
+        # prices or allocated slack (or all the known ones)
+        m.relaxed_constraints = relaxed_constraint_keys(m.options)
+        relax_limits = dict(period_constraint_data)
+        for constraint_name, keys in m.relaxed_constraints:
+            relax_limit = relax_limits.get(constraint_name, default_relax_limit)
             try:
                 c = getattr(m, constraint_name)
             except AttributeError:
@@ -170,11 +259,10 @@ def define_components(m):
             # set bounds to avoid unbounded model when price is attached
             relax_var.relax_limit = relax_limit
             setattr(m, relax_var_name(c), relax_var)
-            # make sure the relaxation variable is constructed before the constraint
-            # but after the constraint's indexing set.
-            move_component_above(relax_var, c)
-            # relax the constraint
-            relax_constraint(c)
+            # relax the constraint; this also constructs the relaxation
+            # variable before the constraint needs it, without reordering the
+            # components in the model
+            relax_constraint(c, keys)
         # apply the bounds later, after the objects are constructed
         def relax_rule(m):
             for c in get_period_constraints(m):
@@ -190,12 +278,13 @@ def define_components(m):
         # the final allocation of slack for each slice and then runs one more pass to get final
         # costs and operating state.
         # The values for the relaxation variables are slice-specific, so we look for the tab files
-        # in the inputs directory for this particular slice.
+        # in the inputs directory for this particular slice (or --cross-time-relaxation-dir).
         def rule(m):
+            source_dir = m.options.cross_time_relaxation_dir or m.options.inputs_dir
             if m.options.verbose:
-                print "Fixing cross-time relaxation variables with values from {}...".format(m.options.inputs_dir)
+                print "Fixing cross-time relaxation variables with values from {}...".format(source_dir)
             for c in get_period_constraints(m):
-                fix_var(m, getattr(m, relax_var_name(c)), m.options.inputs_dir)
+                fix_var(m, getattr(m, relax_var_name(c)), source_dir)
         m.Fix_Cross_Time_Relaxation_Variables = BuildAction(rule=rule)
 
     if m.options.no_standard_results:
@@ -237,6 +326,21 @@ def define_dynamic_components(m):
 # value, which Switch writes to the variable .tab files as ''. We watch for that
 # when setting up the DW model and ignore those instances.
 # It's a little brittle, but it seems to work.
+# Rows that are not relaxed because they have no price or allocated slack (see
+# relaxed_constraint_keys()) are handled the same way.
+
+def relaxed_keys(m, component):
+    """Return the native keys of the rows of component that are relaxed (see relax_constraint())."""
+    keys = dict(m.relaxed_constraints)[component.name]
+    if keys is None:
+        return list(component.keys())
+    return [
+        key for key in component.keys()
+        if tuple(str(i) for i in make_iterable(key)) in keys
+    ]
+
+def relax_price_name(constraint):
+    return relax_var_prefix + constraint.name + '_Price'
 
 def assign_cross_time_relaxation_prices(m):
     # Assign costs to the cross-time relaxation variables (used to discover how each
@@ -246,37 +350,134 @@ def assign_cross_time_relaxation_prices(m):
     # by the '--save-cross-time-duals' option. The values also have the same sign
     # and magnitude as those, i.e., discounted cost per unit of relaxation (implicitly
     # per period).
-    if m.options.verbose:
-        print "Assigning prices to cross-time relaxation variables from {}...".format(m.options.cross_time_relaxation_price_file)
+    # The prices are stored in mutable parameters, so they can be updated in place
+    # for later rounds (see set_cross_time_relaxation_prices()) without rebuilding
+    # the model.
+    for component in get_period_constraints(m):
+        setattr(
+            m, relax_price_name(component),
+            Param(component.index_set(), mutable=True, default=0.0)
+        )
+    m.Assign_Cross_Time_Relaxation_Prices = BuildAction(
+        rule=lambda m: set_cross_time_relaxation_prices(
+            m, m.options.cross_time_relaxation_price_file
+        )
+    )
     def cost_rule(m):
-        with open(m.options.cross_time_relaxation_price_file) as f:
-            # read all values from the file
-            rows = [r.strip().split('\t') for r in f]
-            price_dict = {tuple(r[:-1]): float(r[-1]) for r in rows}
-        total_cost = 0.0
+        terms = []
         for component in get_period_constraints(m):
-            var_name = relax_var_name(component)
-            component_name = component.name
-            for key, c in component.items():
-                k = (component_name,) + tuple(str(i) for i in make_iterable(key))
-                price = price_dict[k]
-                var = getattr(m, var_name)[key]  # matching relaxation var
-                total_cost += price * var
-        return m.SystemCost + total_cost
+            price = getattr(m, relax_price_name(component))
+            var = getattr(m, relax_var_name(component))  # matching relaxation vars
+            terms.extend(price[key] * var[key] for key in relaxed_keys(m, component))
+        # build the sum in one step, rather than nesting one addition per term
+        return m.SystemCost + quicksum(terms)
     # note: we create a new objective function so that the standard reporting
     # methods will ignore these extra costs, and also to avoid all the discounting
     # that Switch normally does to costs (we want to use raw dual*slack values)
     m.System_Cost_With_Relaxations = Objective(rule=cost_rule, sense=minimize)
     m.Minimize_System_Cost.deactivate()
 
+def set_cross_time_relaxation_prices(m, price_file):
+    """
+    Set prices for the cross-time relaxation variables from price_file. This is
+    called during model construction and can be called again later to apply new
+    prices to an existing model instance.
+    """
+    if m.options.verbose:
+        print "Assigning prices to cross-time relaxation variables from {}...".format(price_file)
+    price_hash, price_dict = read_price_file(price_file)
+    # note which prices were used (reported with the relaxation bid)
+    m.relaxation_price_hash = price_hash
+    for price, keys in relaxation_price_keys(m):
+        for k, key in keys.items():
+            price[key] = price_dict[k]
+
+def read_price_file(price_file):
+    """
+    Return the hash of price_file and a dict of the prices in it, with
+    key=(constraint name, index1, ..., indexn) as strings. The file is only
+    parsed again if it has changed since the last call.
+    """
+    with open(price_file) as f:
+        data = f.read()
+    price_hash = hashlib.sha1(data).hexdigest()
+    if price_file_cache[0] != price_hash:
+        rows = [r.strip().split('\t') for r in data.splitlines()]
+        price_file_cache[:] = [price_hash, {tuple(r[:-1]): float(r[-1]) for r in rows}]
+    return price_hash, price_file_cache[1]
+
+def relaxation_price_keys(m):
+    """
+    Return a list with one (price component, dict) pair for each relaxed
+    constraint, where the dict maps the constraint's keys as written in the
+    price file to its native index. This is built the first time prices are
+    assigned to a model and reused for later prices.
+    """
+    if not hasattr(m, 'relaxation_price_keys'):
+        m.relaxation_price_keys = [
+            (
+                getattr(m, relax_price_name(component)),
+                {
+                    (component.name,) + tuple(str(i) for i in make_iterable(key)): key
+                    for key in relaxed_keys(m, component)
+                }
+            )
+            for component in get_period_constraints(m)
+        ]
+    return m.relaxation_price_keys
+
+def pre_solve(m):
+    # note when the solution starts (see define_components())
+    m.solve_start_usage = usage()
+    set_warm_start_options(m)
+
+def set_warm_start_options(m):
+    """
+    If requested, add options to the solver options string to start from the
+    basis saved by the last solution of this model (if any) and save the final
+    basis for next time. Between rounds of the cross-time allocation loop, the
+    slice models only differ in the prices on the relaxation variables, so the
+    last optimal basis is still primal feasible. This is called before each
+    solution (also by slice_worker.py when it re-solves an existing model).
+    """
+    if not m.options.warm_start_basis:
+        return
+    if m.options.solver != 'cplexamp':
+        print "WARNING: --warm-start-basis is not supported for solver {}; ignoring it.".format(m.options.solver)
+        return
+    if not hasattr(m, 'base_solver_options_string'):
+        m.base_solver_options_string = m.options.solver_options_string or ''
+    basis_file = os.path.abspath(os.path.join(m.options.outputs_dir, 'warm_start.bas'))
+    options = [m.base_solver_options_string]
+    if os.path.exists(basis_file):
+        if m.options.verbose:
+            print "Starting from basis in {}.".format(basis_file)
+        options.append('readbasis=' + basis_file)
+    options.append('writebasis=' + basis_file)
+    m.options.solver_options_string = ' '.join(o for o in options if o)
+
 def post_solve(m, outputs_dir):
+    post_solve_start_usage = usage()
     # save any requested data
     if not m.options.no_cross_time_duals:
         # these will be applied as prices for variables.
         # each constraint/variable has different indexing, so write them in variable-length,
         # tab-separated format, with variable name, then indexes, then values
+        constraints = get_period_constraints(m)
+        if m.options.discover_cross_time_constraints:
+            # add any others found in the model to the known ones
+            known = {c.name for c in constraints}
+            new = [c for c in discover_period_constraints(m) if c.name not in known]
+            constraints.extend(new)
+            print "Found {} cross-time constraints{}.".format(
+                len(constraints),
+                " (not in period_constraint_data: {})".format(', '.join(c.name for c in new))
+                if new else ''
+            )
+            with open(os.path.join(m.options.outputs_dir, 'cross_time_constraints.txt'), 'w') as f:
+                f.write(''.join(c.name + '\n' for c in constraints))
         with open(os.path.join(m.options.outputs_dir, 'cross_time_duals.tab'), 'w') as f:
-            for component in get_period_constraints(m):
+            for component in constraints:
                 constraint_name = component.name
                 # note: we assume every item is indexed; otherwise we need to branch here on c.is_indexed()
                 for key, c in component.items():
@@ -289,12 +490,38 @@ def post_solve(m, outputs_dir):
                 "The --save-relaxation-bid option cannot be used without "
                 "the --add-cross-time-relaxation-variables option."
             )
-        with open(os.path.join(m.options.outputs_dir, 'relaxation_bid.tab'), 'w') as f:
+        # write atomically, so a partial bid is never left behind if this job is killed
+        bid_file = os.path.join(m.options.outputs_dir, 'relaxation_bid.tab')
+        with atomic_open(bid_file) as f:
             for constraint in get_period_constraints(m):
                 var_component = getattr(m, relax_var_name(constraint))
                 for key, var_obj in var_component.items():
                     if var_obj.value is not None:   # ignore relaxation variables for skipped constraints
                         row = (constraint.name,) + tuple(make_iterable(key)) + (value(var_obj),)
-                    f.write('\t'.join(map(str, row)) + '\n')
+                        f.write('\t'.join(map(str, row)) + '\n')
             # also save total cost
             f.write('SystemCost\t{}\n'.format(value(m.SystemCost)))
+        # save time, CPU and peak memory used to build and solve the model and
+        # write the results (see dw_trace.py)
+        trace = dict(
+            host=os.uname()[1],
+            phases=dict(
+                slice_build=dict(
+                    measure(m.build_start_usage, m.solve_start_usage),
+                    # False if a persistent worker only updated the prices
+                    constructed=getattr(m, 'model_constructed', True)
+                ),
+                slice_solve=measure(m.solve_start_usage, post_solve_start_usage),
+                slice_post_solve=measure(post_solve_start_usage, usage()),
+            )
+        )
+        trace_file = os.path.join(m.options.outputs_dir, 'slice_trace.json')
+        with atomic_open(trace_file) as f:
+            json.dump(trace, f)
+        # mark the bid as complete (see --relaxation-bid-tag)
+        done_file = os.path.join(m.options.outputs_dir, 'relaxation_bid_done.json')
+        with atomic_open(done_file) as f:
+            json.dump(dict(
+                tag=m.options.relaxation_bid_tag,
+                price_hash=getattr(m, 'relaxation_price_hash', None)
+            ), f)
@@ -0,0 +1,239 @@
+"""
+Compact storage for the bids received from the slices in each round of the
+cross-time allocation loop (see solve_loop.py).
+
+Each round is saved as a separate .npz file holding a slices x constraints
+array of slack used by each slice, a vector of system costs for the slices,
+and the weighted average of both across all slices. The slice names and
+constraint keys (constraint name, index1, ..., indexn) that identify the rows
+and columns are saved once in index.json. So adding a round only writes that
+round's data, and the final slack allocation can be calculated with a few
+vectorized operations instead of re-parsing every bid from every round.
+
+The smallest and largest slack reported by each slice across all rounds, and
+the slices' costs in the latest round, are also kept up to date in
+slack_range.npz, so they can be checked each round without reloading every
+round (see reusable_bids() in solve_loop.py).
+
+Rounds that have been pruned from the master problem (see dw_master.py) are
+moved to the archive subdirectory (compressed), so they no longer count as
+active rounds but can still be loaded for the final allocation.
+"""
+import os, glob, json
+import numpy as np
+from file_utils import atomic_open
+
+class BidStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.index_file = os.path.join(path, 'index.json')
+        self.slack_range_file = os.path.join(path, 'slack_range.npz')
+        self.archive_path = os.path.join(path, 'archive')
+        if not os.path.exists(self.archive_path):
+            os.makedirs(self.archive_path)
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            self.slices = index['slices']
+            self.keys = [tuple(k) for k in index['keys']]
+        else:
+            self.slices = []
+            self.keys = []
+        self.key_pos = {k: i for i, k in enumerate(self.keys)}
+
+    def round_file(self, round):
+        return os.path.join(self.path, 'round_{:04d}.npz'.format(round))
+
+    def archive_file(self, round):
+        return os.path.join(self.archive_path, 'round_{:04d}.npz'.format(round))
+
+    def reset(self):
+        """Remove all saved rounds (e.g., when restarting from scratch)."""
+        for f in (
+            glob.glob(os.path.join(self.path, 'round_*.npz'))
+            + glob.glob(os.path.join(self.archive_path, 'round_*.npz'))
+        ):
+            os.remove(f)
+        for f in [self.index_file, self.slack_range_file]:
+            if os.path.exists(f):
+                os.remove(f)
+        self.slices = []
+        self.keys = []
+        self.key_pos = {}
+
+    def write_index(self):
+        with atomic_open(self.index_file) as f:
+            json.dump(dict(slices=self.slices, keys=self.keys), f)
+
+    def column_positions(self, keys):
+        """
+        Return positions of the specified constraint keys in the store,
+        adding any new keys to the index.
+        """
+        new_keys = [k for k in keys if k not in self.key_pos]
+        if new_keys:
+            for k in new_keys:
+                self.key_pos[k] = len(self.keys)
+                self.keys.append(k)
+            self.write_index()
+        return np.array([self.key_pos[k] for k in keys], dtype=int)
+
+    def append_round(
+        self, round, slices, keys, slice_slack, slice_cost, weights, prices=None, name=None,
+        mipgap=None, time_limited=False, clustered=False
+    ):
+        """
+        Save bids from one round. slices is a list of slice names, keys is a
+        list of constraint keys, slice_slack is a len(slices) x len(keys)
+        array of slack used by each slice, slice_cost is a vector of system
+        costs for each slice and weights is a vector of weights for each slice
+        (e.g., number of days represented). prices (if specified) is a dict
+        of the relaxation prices that the slices were given, with
+        key=constraint key. If name is specified, the data are saved in
+        <name>.npz instead of as a numbered round. If the slices were solved
+        to a looser MIP gap than usual, it is given by mipgap, and
+        time_limited shows whether they also had a time limit. clustered shows
+        that only cluster representatives were solved, and the other slices
+        were given their representatives' bids.
+        """
+        if not self.slices:
+            self.slices = list(slices)
+            self.write_index()
+        elif list(slices) != self.slices:
+            raise ValueError(
+                'The slices in round {} do not match the slices in {}.'.format(round, self.path)
+            )
+        cols = self.column_positions(keys)
+        full_slack = np.zeros((len(self.slices), len(self.keys)))
+        full_slack[:, cols] = slice_slack
+        weights = np.asarray(weights, dtype=float)
+        data = dict(
+            round=np.array(round),
+            slice_slack=full_slack,
+            slice_cost=np.asarray(slice_cost, dtype=float),
+            weights=weights,
+            slack=weights.dot(full_slack) / weights.sum(),
+            cost=np.array(weights.dot(slice_cost) / weights.sum()),
+        )
+        if prices is not None:
+            data['prices'] = np.array([prices.get(k, 0.0) for k in self.keys])
+        if mipgap is not None:
+            data['slice_mipgap'] = np.array(mipgap)
+            data['time_limited'] = np.array(time_limited)
+        if clustered:
+            data['clustered'] = np.array(True)
+        file = self.round_file(round) if name is None else os.path.join(self.path, name + '.npz')
+        with atomic_open(file, 'wb') as f:
+            np.savez(f, **data)
+        if name is None and not clustered:
+            # clustered rounds copy bids to slices that weren't solved, so
+            # they don't show what those slices would do
+            self.update_slack_range(round, full_slack, data['slice_cost'])
+
+    def update_slack_range(self, round, slice_slack, slice_cost):
+        """Add the slack and cost from one round to the summary in slack_range.npz."""
+        current = self.slack_range()
+        if current is None:
+            low, high, cost, latest = slice_slack, slice_slack, slice_cost, round
+        else:
+            low = np.minimum(current['low'], slice_slack)
+            high = np.maximum(current['high'], slice_slack)
+            # rounds may be replayed out of order after a restart
+            if round >= current['round']:
+                cost, latest = slice_cost, round
+            else:
+                cost, latest = current['slice_cost'], current['round']
+        self.save_slack_range(low, high, cost, latest)
+
+    def save_slack_range(self, low, high, slice_cost, round):
+        with atomic_open(self.slack_range_file, 'wb') as f:
+            np.savez(
+                f, low=low, high=high, slice_cost=np.asarray(slice_cost, dtype=float),
+                round=np.array(round)
+            )
+
+    def slack_range(self):
+        """
+        Return a dict with slices x constraints arrays of the smallest (low)
+        and largest (high) slack reported by each slice in all rounds so far,
+        and the slices' costs (slice_cost) in the latest round, or None if
+        there are no rounds yet. Clustered rounds are left out.
+        """
+        if not os.path.exists(self.slack_range_file):
+            # store saved before the summary was kept; build it once from the rounds
+            low = high = cost = latest = None
+            for r in sorted(set(self.rounds()) | set(self.archived_rounds())):
+                data = self.load_round(r)
+                if 'clustered' in data:
+                    continue
+                slack = data['slice_slack']
+                low = slack if low is None else np.minimum(low, slack)
+                high = slack if high is None else np.maximum(high, slack)
+                cost, latest = data['slice_cost'], r
+            if latest is None:
+                return None
+            self.save_slack_range(low, high, cost, latest)
+        with np.load(self.slack_range_file) as data:
+            result = {k: data[k] for k in data.files}
+        # constraints added later had zero slack in the earlier rounds
+        extra = len(self.keys) - result['low'].shape[1]
+        if extra > 0:
+            for k in ['low', 'high']:
+                result[k] = np.hstack([result[k], np.zeros((result[k].shape[0], extra))])
+        return result
+
+    def rounds(self):
+        """Return a sorted list of all active (not archived) rounds saved so far."""
+        return self.list_rounds(self.path)
+
+    def archived_rounds(self):
+        """Return a sorted list of all archived rounds."""
+        return self.list_rounds(self.archive_path)
+
+    def list_rounds(self, path):
+        return sorted(
+            int(os.path.basename(f)[len('round_'):-len('.npz')])
+            for f in glob.glob(os.path.join(path, 'round_*.npz'))
+        )
+
+    def archive_round(self, round):
+        """Move a round that is no longer used by the master problem to the archive."""
+        with np.load(self.round_file(round)) as data:
+            saved = {k: data[k] for k in data.files}
+        with atomic_open(self.archive_file(round), 'wb') as f:
+            np.savez_compressed(f, **saved)
+        os.remove(self.round_file(round))
+
+    def load_round(self, round):
+        """
+        Return a dict of arrays for the specified round (active or archived),
+        padded to include any constraint keys that were added to the index
+        after it was saved.
+        """
+        file = self.round_file(round)
+        if not os.path.exists(file):
+            file = self.archive_file(round)
+        with np.load(file) as data:
+            result = {k: data[k] for k in data.files}
+        extra = len(self.keys) - result['slack'].shape[0]
+        if extra > 0:
+            result['slack'] = np.concatenate([result['slack'], np.zeros(extra)])
+            if 'prices' in result:
+                result['prices'] = np.concatenate([result['prices'], np.zeros(extra)])
+            result['slice_slack'] = np.hstack(
+                [result['slice_slack'], np.zeros((result['slice_slack'].shape[0], extra))]
+            )
+        return result
+
+    def weighted_slice_slack(self, round_weights):
+        """
+        Return a slices x constraints array showing the weighted sum of the
+        slack used by each slice across all rounds, using the weights in
+        round_weights (dict with key=round, value=weight). Rounds with zero
+        weight are skipped, and archived rounds may be included.
+        """
+        total = np.zeros((len(self.slices), len(self.keys)))
+        for r, w in round_weights.items():
+            if w != 0.0:
+                total += w * self.load_round(r)['slice_slack']
+        return total
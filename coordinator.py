@@ -0,0 +1,202 @@
+"""
+In-memory task coordinator for persistent slice workers (solve_loop.py
+--coordinator), used instead of the file-based queue in task_queue.py.
+
+The coordinator runs in a background thread inside solve_loop.py and holds
+the tasks, claims and results in memory. Workers (slice_worker.py
+--coordinator <host>:<port>) connect over a socket with
+multiprocessing.connection, pull tasks and push results (including the
+relaxation bid) back directly, so a round doesn't need any small files on the
+shared filesystem, and results are available to solve_loop.py as soon as
+they arrive.
+
+Coordinator (server side) and CoordinatorClient (worker side) have the same
+methods as task_queue.TaskQueue, so either can be used by solve_loop.py and
+slice_worker.py. Connections are authenticated with a random key, which is
+saved in a file that only the current user can read (this is normally on a
+filesystem shared with the workers).
+"""
+from __future__ import print_function
+
+import os, time, socket, threading
+from multiprocessing.connection import Listener, Client
+from collections import OrderedDict
+
+def write_authkey(file):
+    """Create a new random key in file (readable only by this user) and return it."""
+    key = os.urandom(32)
+    if os.path.exists(file):
+        os.remove(file)
+    fd = os.open(file, os.O_WRONLY | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def read_authkey(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+def parse_address(address):
+    """Convert '<host>:<port>' into a (host, port) tuple."""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+class Coordinator(object):
+    """
+    Task queue held in memory and served to workers over a socket. Tasks are
+    dicts with an 'id' key, as for task_queue.add_tasks().
+    """
+    def __init__(self, authkey_file, host=None, port=0):
+        self.lock = threading.Lock()
+        # tasks waiting to be claimed, in the order they were added
+        self.tasks = OrderedDict()
+        # running has key=task id, value=(task, worker)
+        self.running = {}
+        # results has key=task id, value=result dict
+        self.results = {}
+        self.workers = {}
+        self.stopped = False
+        self.listener = Listener(('', port), authkey=write_authkey(authkey_file))
+        self.address = '{}:{}'.format(host or socket.gethostname(), self.listener.address[1])
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        # accept connections from workers, each handled in its own thread
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.stopped:
+                    return
+                # e.g., failed authentication; keep listening
+                continue
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    # methods that workers may call (see CoordinatorClient)
+    remote_methods = {
+        'register_worker', 'waiting_tasks', 'claim_task', 'finish_task', 'stop_requested'
+    }
+
+    def handle(self, conn):
+        # answer requests from one worker until it disconnects
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, IOError):
+                conn.close()
+                return
+            if method in self.remote_methods:
+                try:
+                    response = ('ok', getattr(self, method)(*args))
+                except Exception as e:
+                    response = ('error', repr(e))
+            else:
+                response = ('error', 'Unknown method {}.'.format(method))
+            conn.send(response)
+
+    def close(self):
+        self.stopped = True
+        self.listener.close()
+
+    # same interface as task_queue.TaskQueue
+    def init_queue(self):
+        with self.lock:
+            self.tasks.clear()
+            self.running.clear()
+            self.results.clear()
+            self.workers.clear()
+            self.stopped = False
+
+    def register_worker(self, worker, info):
+        with self.lock:
+            self.workers[worker] = info
+
+    def registered_workers(self):
+        with self.lock:
+            return dict(self.workers)
+
+    def add_tasks(self, tasks):
+        with self.lock:
+            for task in tasks:
+                self.results.pop(task['id'], None)
+                self.tasks[task['id']] = task
+
+    def waiting_tasks(self):
+        with self.lock:
+            return sorted(self.tasks)
+
+    def claim_task(self, task_id, worker):
+        with self.lock:
+            task = self.tasks.pop(task_id, None)
+            if task is not None:
+                self.running[task_id] = (task, worker)
+            return task
+
+    def withdraw_task(self, task_id):
+        with self.lock:
+            return self.tasks.pop(task_id, None) is not None
+
+    def finish_task(self, task, worker, result):
+        with self.lock:
+            self.results[task['id']] = dict(result, id=task['id'], worker=worker)
+            self.running.pop(task['id'], None)
+
+    def finished_tasks(self):
+        with self.lock:
+            return dict(self.results)
+
+    def remove_result(self, task_id):
+        with self.lock:
+            del self.results[task_id]
+
+    def wait_for_tasks(self, task_ids, poll_interval=1.0, check=None):
+        task_ids = set(task_ids)
+        while True:
+            results = {k: v for k, v in self.finished_tasks().items() if k in task_ids}
+            if len(results) == len(task_ids):
+                return results
+            if check is not None:
+                check()
+            time.sleep(poll_interval)
+
+    def request_stop(self):
+        with self.lock:
+            self.stopped = True
+
+    def stop_requested(self):
+        return self.stopped
+
+class CoordinatorClient(object):
+    """Connection from a worker to a Coordinator, with the same methods as task_queue.TaskQueue."""
+    def __init__(self, address, authkey_file):
+        self.conn = Client(parse_address(address), authkey=read_authkey(authkey_file))
+
+    def call(self, method, *args):
+        self.conn.send((method, args))
+        status, value = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError('Error from coordinator in {}: {}'.format(method, value))
+        return value
+
+    def register_worker(self, worker, info):
+        return self.call('register_worker', worker, info)
+
+    def waiting_tasks(self):
+        return self.call('waiting_tasks')
+
+    def claim_task(self, task_id, worker):
+        return self.call('claim_task', task_id, worker)
+
+    def finish_task(self, task, worker, result):
+        return self.call('finish_task', task, worker, result)
+
+    def stop_requested(self):
+        try:
+            return self.call('stop_requested')
+        except (EOFError, IOError):
+            # coordinator has exited
+            return True
@@ -0,0 +1,40 @@
+"""
+Bounds on the total cost of the cross-time allocation problem, used by
+solve_loop.py to decide when the allocation loop has converged.
+
+The master problem solution is a feasible mix of slice solutions, so its cost
+(including the penalty for any unallocated slack) is an upper bound on the
+optimal cost. The Lagrangian value from any round of slice solutions is a
+lower bound, but only if each slice found its optimal solution at the prices
+given to it. Slices are solved by a MIP solver that stops within a relative
+gap of the optimum, so the Lagrangian value is reduced by that gap to keep the
+bound valid.
+"""
+import numpy as np
+
+def lagrangian_value(data, default_mipgap=0.0):
+    """
+    Return a lower bound on the total cost from one round of bids (a dict of
+    arrays from BidStore.load_round()): the weighted average of slice costs
+    plus the cost of the slack used at the prices sent to the slices, reduced
+    by the MIP gap the slices were solved to. This is the gap saved with the
+    round if the slices were deliberately solved to a looser gap than usual,
+    otherwise default_mipgap (the gap in the standard solver options).
+    """
+    value = float(data['cost']) + float(data['prices'].dot(data['slack']))
+    mipgap = float(data['slice_mipgap']) if 'slice_mipgap' in data else default_mipgap
+    if mipgap:
+        # each slice's optimal value may be lower than the one found by up to
+        # mipgap times the absolute value of its objective
+        objective = data['slice_cost'] + data['slice_slack'].dot(data['prices'])
+        value -= mipgap * float(data['weights'].dot(np.abs(objective)) / data['weights'].sum())
+    return value
+
+def relative_gap(upper_bound, lower_bound):
+    """
+    Return the gap between the upper and lower bounds as a fraction of the
+    upper bound, or None if there is no lower bound yet.
+    """
+    if lower_bound is None:
+        return None
+    return (upper_bound - lower_bound) / abs(upper_bound) if upper_bound else 0.0
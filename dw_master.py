@@ -0,0 +1,357 @@
+"""
+In-memory Dantzig-Wolfe master problem for the cross-time allocation loop in
+solve_loop.py.
+
+The master problem chooses a convex combination of the average bids (system
+cost and slack usage for each cross-time constraint) received from the slices
+so far, with a steep charge for any net relaxation of the cross-time
+constraints. The dual values of the relaxation constraints become the prices
+for the next round of slice solutions.
+
+Rather than rebuilding this model from the bid file every iteration, we keep
+it in memory and add each new round as a column. If Pyomo has a persistent
+interface for the solver named in options.txt, the solver also keeps its copy
+of the model between iterations, so each re-solve starts from the last optimal
+basis inside this process instead of writing a new problem file and starting a
+new solver process. Persistent interfaces take options under their own
+names (e.g., mip_tolerances_mipgap for cplex_persistent, which looks up each
+option in the cplex Python API), so they are given separately from the
+AMPL-style options in options.txt.
+
+To keep the master problem small on long runs, rounds can be pruned (see
+prune()) if their weight has been zero for several iterations or if there are
+more than a set number of them, and new rounds that nearly duplicate an
+existing one are not added. The caller is responsible for archiving the bids
+for these rounds (see BidStore.archive_round()).
+"""
+from __future__ import print_function
+
+from pyomo.environ import *
+from pyomo.opt import SolverStatus, TerminationCondition
+
+# persistent interfaces to use for the solvers that may be named in options.txt
+persistent_solvers = {
+    'cplex': 'cplex_persistent',
+    'cplexamp': 'cplex_persistent',
+    'gurobi': 'gurobi_persistent',
+    'gurobi_ampl': 'gurobi_persistent',
+}
+
+def get_persistent_solver(solver_name):
+    """
+    Return a persistent Pyomo interface for the specified solver, or None if
+    there isn't one or its Python bindings aren't installed.
+    """
+    persistent_name = persistent_solvers.get(solver_name)
+    if persistent_name is None:
+        return None
+    solver = SolverFactory(persistent_name)
+    try:
+        available = solver.available(exception_flag=False)
+    except Exception:
+        # e.g., UnknownSolver in older versions of Pyomo
+        available = False
+    return solver if available else None
+
+class MasterProblem(object):
+    """
+    Restricted master problem for the cross-time slack allocation. Bids are
+    added with add_round() and the model is (re)solved with solve(); after
+    that, prices(), weights() and relaxation() report the solution.
+    """
+    def __init__(
+        self, relaxation_cost, solver, solver_io=None, options_string='',
+        persistent_options_string=None, dedup_tolerance=None
+    ):
+        """
+        relaxation_cost is a dict with key=(constraint name, index1, ..., indexn)
+        and value=cost per unit of upward or downward relaxation of that
+        constraint in the master problem. solver, solver_io and options_string
+        are used to solve the model if no persistent interface is available
+        for this solver; otherwise persistent_options_string (if given) is
+        passed to the persistent interface, using its option names. If dedup_tolerance is specified, new rounds whose cost
+        and slack are all within this relative tolerance of an existing round
+        are not added.
+        """
+        self.relaxation_cost = relaxation_cost
+        self.dedup_tolerance = dedup_tolerance
+        self.solver_name = solver
+        self.solver_io = solver_io
+        self.options_string = options_string
+        self.persistent_options_string = persistent_options_string
+        # rounds included in the model, in the order they were added
+        self.rounds = []
+        # bids dict has key=round, value=(system cost, slack dict)
+        self.bids = {}
+        # constraint keys, in the same order as dw.CONSTRAINTS
+        self.keys = None
+        # weight variable for each round (added to dw.Weight as needed)
+        self.weight_vars = {}
+        # number of consecutive solutions in which each round had zero weight
+        self.zero_weight_age = {}
+        self.model = None
+        self.solver = None
+        self.persistent = False
+
+    def add_round(self, round, cost, slack):
+        """
+        Add the bid from one round of slice solutions to the master problem.
+        slack is a dict with key=(constraint name, index1, ..., indexn) and
+        value=average slack used by the slices for that constraint. Returns
+        False if the round was not added because it duplicates an existing one.
+        """
+        if round in self.bids:
+            raise ValueError('Round {} has already been added to the master problem.'.format(round))
+        if self.dedup_tolerance is not None and self.find_duplicate(cost, slack) is not None:
+            return False
+        self.bids[round] = (cost, slack)
+        self.rounds.append(round)
+        self.zero_weight_age[round] = 0
+        if self.model is not None:
+            # model already exists; just add a column for this round
+            self.add_column(round)
+        return True
+
+    def find_duplicate(self, cost, slack):
+        """Return an existing round with nearly the same cost and slack, or None."""
+        tol = self.dedup_tolerance
+        def close(a, b):
+            return abs(a - b) <= tol * max(abs(a), abs(b), 1.0)
+        for r in self.rounds:
+            c, s = self.bids[r]
+            if close(c, cost) and all(
+                close(s.get(k, 0.0), slack.get(k, 0.0)) for k in set(s) | set(slack)
+            ):
+                return r
+        return None
+
+    def prune(self, max_zero_weight_age=None, max_rounds=None, tolerance=1e-9):
+        """
+        Update the count of consecutive solutions with zero weight for each
+        round, then remove rounds that have had zero weight for more than
+        max_zero_weight_age solutions, and if there are more than max_rounds
+        rounds, remove the ones that have had zero weight the longest (oldest
+        first). Rounds with non-zero weight in the current solution are never
+        removed, so the current solution and prices are unaffected. Returns a
+        list of the rounds that were removed; the model is rebuilt without
+        them the next time it is solved.
+        """
+        weights = self.weights()
+        for r in self.rounds:
+            if weights[r] > tolerance:
+                self.zero_weight_age[r] = 0
+            else:
+                self.zero_weight_age[r] = self.zero_weight_age.get(r, 0) + 1
+        candidates = sorted(
+            (r for r in self.rounds if weights[r] <= tolerance),
+            key=lambda r: (-self.zero_weight_age[r], r)
+        )
+        remove = set()
+        if max_zero_weight_age is not None:
+            remove.update(r for r in candidates if self.zero_weight_age[r] > max_zero_weight_age)
+        if max_rounds is not None:
+            for r in candidates:
+                if len(self.rounds) - len(remove) <= max_rounds:
+                    break
+                remove.add(r)
+        self.remove_rounds(remove)
+        return sorted(remove)
+
+    def remove_rounds(self, rounds):
+        """Remove the specified rounds; the model is rebuilt without them at the next solve."""
+        remove = set(rounds)
+        if remove:
+            self.rounds = [r for r in self.rounds if r not in remove]
+            for r in remove:
+                del self.bids[r]
+                del self.zero_weight_age[r]
+                self.weight_vars.pop(r, None)
+            # rebuild the model (and the solver's copy of it) at the next solve
+            self.model = None
+            self.solver = None
+
+    def build(self):
+        # construct the model from all the rounds received so far
+        # (the constraint list is taken from the first bid)
+        self.keys = sorted(self.bids[self.rounds[0]][1].keys())
+        dw = ConcreteModel()
+        # constraints are indexed by position in self.keys, since keys
+        # can have different numbers of indexes
+        dw.CONSTRAINTS = Set(initialize=range(len(self.keys)), ordered=True)
+        # cost per unit of upward or downward relaxation; these are also the
+        # upper and lower bounds on the duals of Calculate_Relaxation, and may be
+        # adjusted via set_price_bounds() to stabilize the duals
+        dw.relax_up_cost = Param(
+            dw.CONSTRAINTS, mutable=True,
+            initialize=lambda dw, i: self.relaxation_cost[self.keys[i]]
+        )
+        dw.relax_down_cost = Param(
+            dw.CONSTRAINTS, mutable=True,
+            initialize=lambda dw, i: self.relaxation_cost[self.keys[i]]
+        )
+        dw.Weight = VarList(domain=PercentFraction)
+        self.weight_vars = {r: dw.Weight.add() for r in self.rounds}
+        dw.Use_Convex_Weights = Constraint(
+            expr=sum(self.weight_vars[r] for r in self.rounds) == 1.0
+        )
+        # choose amount of up and down relaxation to do (we charge for both directions)
+        dw.RelaxUp = Var(dw.CONSTRAINTS, within=NonNegativeReals)
+        dw.RelaxDown = Var(dw.CONSTRAINTS, within=NonNegativeReals)
+        # note: this is written with everything on the left side so that new
+        # columns can be added to the body of the constraint
+        dw.Calculate_Relaxation = Constraint(
+            dw.CONSTRAINTS,
+            rule=lambda dw, i:
+                dw.RelaxUp[i] - dw.RelaxDown[i]
+                - sum(
+                    self.weight_vars[r] * self.bids[r][1].get(self.keys[i], 0.0)
+                    for r in self.rounds
+                )
+                == 0.0
+        )
+        # charge for system cost and relaxation
+        dw.Objective = Objective(
+            expr=
+                sum(self.weight_vars[r] * self.bids[r][0] for r in self.rounds)
+                + sum(dw.RelaxUp[i] * dw.relax_up_cost[i] for i in dw.CONSTRAINTS)
+                + sum(dw.RelaxDown[i] * dw.relax_down_cost[i] for i in dw.CONSTRAINTS),
+            sense=minimize
+        )
+        dw.dual = Suffix(direction=Suffix.IMPORT)
+        dw.iis = Suffix(direction=Suffix.IMPORT) # in case of infeasible models
+        self.model = dw
+
+        self.solver = get_persistent_solver(self.solver_name)
+        self.persistent = self.solver is not None
+        if self.persistent:
+            self.solver.set_instance(dw)
+        else:
+            print(
+                "WARNING: no persistent interface is available for solver {}, so the "
+                "master problem will be written to a file and solved by a new solver "
+                "process in every iteration.".format(self.solver_name)
+            )
+            self.solver = SolverFactory(self.solver_name, solver_io=self.solver_io)
+
+    def add_column(self, round):
+        # add a weight variable for this round to the existing model
+        dw = self.model
+        cost, slack = self.bids[round]
+        w = self.weight_vars[round] = dw.Weight.add()
+        constraints = [dw.Use_Convex_Weights]
+        coefficients = [1.0]
+        for i, k in enumerate(self.keys):
+            s = slack.get(k, 0.0)
+            if s != 0.0:
+                constraints.append(dw.Calculate_Relaxation[i])
+                coefficients.append(-s)
+        if self.persistent:
+            # updates both the Pyomo model and the solver's copy of it
+            self.solver.add_column(dw, w, cost, constraints, coefficients)
+        else:
+            dw.Objective.expr += cost * w
+            for c, coef in zip(constraints, coefficients):
+                c.set_value(c.body + coef * w == value(c.upper))
+
+    def set_price_bounds(self, lower=None, upper=None):
+        """
+        Restrict the duals of the relaxation constraints to lie between lower
+        and upper (dicts with key=constraint key), by adjusting the cost of
+        upward and downward relaxation. If not specified, the normal
+        relaxation cost is used in both directions.
+        """
+        if self.model is None:
+            self.build()
+        dw = self.model
+        for i, k in enumerate(self.keys):
+            dw.relax_up_cost[i] = self.relaxation_cost[k] if upper is None else upper[k]
+            dw.relax_down_cost[i] = self.relaxation_cost[k] if lower is None else -lower[k]
+        if self.persistent:
+            # send the revised objective to the solver
+            self.solver.set_objective(dw.Objective)
+
+    def solve(self):
+        if self.model is None:
+            self.build()
+        print("Solving Dantzig-Wolfe master problem with {} rounds{}..."
+            .format(len(self.rounds), ' (persistent solver)' if self.persistent else ''))
+        if self.persistent:
+            # the solver re-optimizes from its previous basis after new columns are added
+            results = self.solver.solve(
+                options_string=self.persistent_options_string or '', load_solutions=False
+            )
+        else:
+            # Setup solver identically to Switch; we could use different settings,
+            # but this is an easy way to get workable ones.
+            results = self.solver.solve(
+                self.model, options_string=self.options_string, load_solutions=False
+            )
+        check_results(self.model, results, self.solver_name)
+        if self.persistent:
+            self.solver.load_vars()
+            self.solver.load_duals()
+        else:
+            self.model.solutions.load_from(results)
+
+    def prices(self):
+        """
+        Return dict of current dual values for relaxed constraints, with
+        key=(constraint name, index1, ..., indexn).
+        """
+        dw = self.model
+        return {k: dw.dual[dw.Calculate_Relaxation[i]] for i, k in enumerate(self.keys)}
+
+    def weights(self):
+        """Return dict of current weights for all rounds, with key=round."""
+        return {r: value(w) for r, w in self.weight_vars.items()}
+
+    def relaxation(self):
+        """Return dict of net relaxation for each constraint key."""
+        dw = self.model
+        return {k: value(dw.RelaxUp[i] - dw.RelaxDown[i]) for i, k in enumerate(self.keys)}
+
+    def objective_value(self):
+        return value(self.model.Objective)
+
+    def penalized_value(self):
+        """
+        Return the cost of the current mix of bids, including the standard
+        charge for any net relaxation (even if the relaxation costs have been
+        adjusted via set_price_bounds()). This is an upper bound on the cost
+        of the full problem.
+        """
+        return (
+            sum(self.bids[r][0] * value(w) for r, w in self.weight_vars.items())
+            + sum(
+                self.relaxation_cost[k] * abs(v)
+                for k, v in self.relaxation().items()
+            )
+        )
+
+    def abs_relaxation(self):
+        """Return total unallocated slack (up or down) across all constraints."""
+        dw = self.model
+        return sum(value(dw.RelaxUp[i] + dw.RelaxDown[i]) for i in dw.CONSTRAINTS)
+
+def check_results(model, results, solver_name):
+    if (
+        results.solver.status in {SolverStatus.ok, SolverStatus.warning} and
+        results.solver.termination_condition == TerminationCondition.optimal
+    ):
+        return
+    elif (results.solver.termination_condition == TerminationCondition.infeasible):
+        if hasattr(model, "iis") and len(model.iis) > 0:
+            print("Model was infeasible; irreducibly inconsistent set (IIS) returned by solver:")
+            print("\n".join(c.name for c in model.iis))
+        else:
+            print("Model was infeasible; if the solver can generate an irreducibly inconsistent set (IIS),")
+            print("more information may be available by setting the appropriate flags in the ")
+            print('solver_options_string and calling this script with "--suffixes iis".')
+        raise RuntimeError("Infeasible model")
+    else:
+        print("Solver terminated abnormally.")
+        print("  Solver Status: {}".format(results.solver.status))
+        print("  Termination Condition: {}".format(results.solver.termination_condition))
+        if solver_name == 'glpk' and results.solver.termination_condition == TerminationCondition.other:
+            print("Hint: glpk has been known to classify infeasible problems as 'other'.")
+        raise RuntimeError("Solver failed to find an optimal solution.")
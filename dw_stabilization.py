@@ -0,0 +1,125 @@
+"""
+Dual stabilization for the cross-time allocation loop in solve_loop.py.
+
+The raw duals from the Dantzig-Wolfe master problem tend to oscillate from one
+round to the next, so it can take many rounds of slice solutions to converge.
+These methods keep the prices sent to the slices near the best prices found so
+far (the "stability center"), i.e., the prices that gave the highest Lagrangian
+value (weighted average of slice cost + price * slack).
+
+Available modes:
+    none:    send the master duals to the slices unchanged
+    wentges: send a weighted average of the stability center and the master
+             duals (Wentges smoothing)
+    boxstep: limit the master duals to a box around the stability center,
+             which moves whenever a round improves on the best Lagrangian value
+    bundle:  like boxstep, but only move the center if the improvement is at
+             least a fixed share of the improvement predicted by the master
+             problem ("serious step"); the box grows after serious steps and
+             shrinks after null steps (a trust-region bundle method)
+"""
+import os, json
+from file_utils import atomic_open
+
+stabilization_modes = ['none', 'wentges', 'boxstep', 'bundle']
+
+class Stabilizer(object):
+    def __init__(
+        self, mode='none', alpha=0.5, step=0.5, min_step=1.0,
+        serious_step_fraction=0.1, state_file=None,
+        min_step_fraction=0.01, max_step_fraction=10.0
+    ):
+        """
+        alpha is the weight on the stability center for Wentges smoothing. step
+        is the half-width of the box for boxstep and bundle modes, as a
+        fraction of the price at the center (or min_step if that is larger).
+        serious_step_fraction is the share of the predicted improvement needed
+        to move the center in bundle mode. state_file (if specified) is used
+        to save the box size between runs of the loop. In bundle mode, step
+        is kept between min_step_fraction and max_step_fraction, so repeated
+        null steps can't freeze the prices and repeated serious steps can't
+        remove the box.
+        """
+        if mode not in stabilization_modes:
+            raise ValueError('Unknown stabilization mode {}.'.format(mode))
+        self.mode = mode
+        self.alpha = alpha
+        self.step = step
+        self.min_step = min_step
+        self.serious_step_fraction = serious_step_fraction
+        self.min_step_fraction = min_step_fraction
+        self.max_step_fraction = max_step_fraction
+        self.state_file = state_file
+        # prices, Lagrangian value and round number at the stability center
+        self.center = None
+        self.center_value = None
+        self.center_round = None
+        # objective value from the most recent solution of the master problem
+        self.predicted_value = None
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as f:
+                self.step = self.clamp_step(json.load(f)['step'])
+
+    def add_round(self, round, lagrangian_value, prices, replay=False):
+        """
+        Update the stability center based on the Lagrangian value found
+        by solving the slices with the specified prices in one round. If
+        replay is True, the round is being reloaded after a restart, so only
+        the center is updated, not the step size.
+        """
+        if self.center is None:
+            self.move_center(round, lagrangian_value, prices)
+        elif self.mode == 'bundle' and not replay and self.predicted_value is not None:
+            predicted = self.predicted_value - self.center_value
+            if lagrangian_value - self.center_value >= self.serious_step_fraction * predicted:
+                # serious step
+                self.move_center(round, lagrangian_value, prices)
+                self.step = self.clamp_step(self.step * 2.0)
+            else:
+                # null step
+                self.step = self.clamp_step(self.step * 0.5)
+            self.save_state()
+        elif lagrangian_value > self.center_value:
+            self.move_center(round, lagrangian_value, prices)
+
+    def clamp_step(self, step):
+        return min(max(step, self.min_step_fraction), self.max_step_fraction)
+
+    def move_center(self, round, lagrangian_value, prices):
+        self.center = prices
+        self.center_value = lagrangian_value
+        self.center_round = round
+
+    def save_state(self):
+        if self.state_file is not None:
+            # write atomically, so a crash can't corrupt it
+            with atomic_open(self.state_file) as f:
+                json.dump(dict(step=self.step), f)
+
+    def price_bounds(self, keys, max_price):
+        """
+        Return dicts of lower and upper bounds for the master problem duals
+        (with key=constraint key), or (None, None) if they should not be
+        restricted. max_price is a dict showing the normal bound on the
+        absolute value of each price.
+        """
+        if self.mode not in {'boxstep', 'bundle'} or self.center is None:
+            return None, None
+        lower = {}
+        upper = {}
+        for k in keys:
+            c = self.center.get(k, 0.0)
+            width = self.step * max(abs(c), self.min_step)
+            lower[k] = max(-max_price[k], c - width)
+            upper[k] = min(max_price[k], c + width)
+        return lower, upper
+
+    def smooth(self, master_prices):
+        """Return prices to send to the slices, based on the master problem duals."""
+        if self.mode == 'wentges' and self.center is not None:
+            return {
+                k: self.alpha * self.center.get(k, v) + (1.0 - self.alpha) * v
+                for k, v in master_prices.items()
+            }
+        else:
+            return master_prices
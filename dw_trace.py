@@ -0,0 +1,167 @@
+"""
+Phase-level timing and tracing for the cross-time allocation loop
+(solve_loop.py) and the slice models (allocate_period_constraints.py).
+
+Each phase of the loop (master solution, slice solutions, bid aggregation,
+slack allocation, etc.) and each phase of each slice solution (model
+construction, solver, post-solve writing) is recorded as one JSON object per
+line in a trace file, with wall time, CPU time and peak memory (RSS), e.g.:
+
+    {"run": 1539129470.2, "iteration": 3, "phase": "master_solve", "wall": 12.4,
+     "cpu": 11.9, "max_rss_mb": 2150.3, "child_max_rss_mb": 0.0, ...}
+
+CPU time includes child processes that have finished (e.g., the solver, or
+mpirun and the processes it waited for on this node), and child_max_rss_mb
+is the peak RSS of the largest of these. Peak RSS values are high-water marks
+for the whole process, so rss_mb and start_rss_mb (current RSS at the end and
+start of the phase, on Linux) are also recorded, to show how much memory a
+phase added (e.g., a slice model; see slice_memory.py). Work done on other
+nodes is only visible through the per-slice records.
+
+To summarize where the time goes across iterations, run
+
+    python dw_trace.py [inputs/dw/trace.jsonl]
+"""
+from __future__ import print_function
+
+import os, sys, time, json, argparse, resource, contextlib
+
+# ru_maxrss is reported in kB on Linux but bytes on macOS
+rss_units_per_mb = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+
+def current_rss_mb():
+    """Return the current RSS of this process in MB, or None if not available (non-Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+def usage():
+    """
+    Return a snapshot of resource use: (wall clock time, CPU time for this
+    process and its finished children, peak RSS of this process in MB, peak
+    RSS of the largest finished child in MB, current RSS of this process in MB).
+    """
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        time.time(),
+        s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime,
+        s.ru_maxrss / rss_units_per_mb,
+        c.ru_maxrss / rss_units_per_mb,
+        current_rss_mb()
+    )
+
+def measure(start, end):
+    """Return a dict of resources used between two usage() snapshots."""
+    return dict(
+        time=start[0], wall=end[0] - start[0], cpu=end[1] - start[1],
+        max_rss_mb=end[2], child_max_rss_mb=end[3],
+        start_rss_mb=start[4], rss_mb=end[4]
+    )
+
+class Tracer(object):
+    """
+    Write trace records to a JSON lines file. Any keyword arguments are
+    included in every record (e.g., run=<start time>).
+    """
+    def __init__(self, file, **context):
+        self.file = file
+        self.context = context
+        self.context.setdefault('host', os.uname()[1])
+        self.context.setdefault('pid', os.getpid())
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """Record the resources used by the code in a `with` block."""
+        start = usage()
+        try:
+            yield
+        finally:
+            self.record(phase=name, **dict(fields, **measure(start, usage())))
+
+    def record(self, **fields):
+        """Add a record (e.g., one reported by a slice) to the trace file."""
+        rec = dict(self.context, **fields)
+        # write each record with a single call, so it is never split up
+        with open(self.file, 'a') as f:
+            f.write(json.dumps(rec, sort_keys=True) + '\n')
+
+def read_trace(file):
+    records = []
+    with open(file) as f:
+        for row in f:
+            try:
+                records.append(json.loads(row))
+            except ValueError:
+                # partial row written when the loop was interrupted
+                pass
+    return records
+
+def report(records, top_slices=10):
+    """Print a summary of time spent in each phase, overall and by iteration."""
+    if not records:
+        print("No trace records found.")
+        return
+    phases = []
+    for r in records:
+        if r['phase'] not in phases:
+            phases.append(r['phase'])
+
+    print("Totals by phase:")
+    print('{:<20}{:>8}{:>14}{:>12}{:>14}{:>12}'.format(
+        'phase', 'count', 'wall (s)', 'mean (s)', 'cpu (s)', 'peak (MB)'
+    ))
+    for p in phases:
+        recs = [r for r in records if r['phase'] == p]
+        wall = sum(r['wall'] for r in recs)
+        print('{:<20}{:>8}{:>14,.1f}{:>12,.2f}{:>14,.1f}{:>12,.0f}'.format(
+            p, len(recs), wall, wall / len(recs), sum(r['cpu'] for r in recs),
+            max(max(r['max_rss_mb'], r['child_max_rss_mb']) for r in recs)
+        ))
+
+    print("")
+    print("Wall time (s) by iteration (slice phases are summed across slices):")
+    print('{:<10}'.format('iteration') + ''.join('{:>18}'.format(p[:17]) for p in phases))
+    iterations = sorted(set(r['iteration'] for r in records if r.get('iteration') is not None))
+    for i in iterations:
+        totals = {p: 0.0 for p in phases}
+        for r in records:
+            if r.get('iteration') == i:
+                totals[r['phase']] += r['wall']
+        print('{:<10}'.format(i) + ''.join('{:>18,.1f}'.format(totals[p]) for p in phases))
+
+    slice_recs = [r for r in records if r.get('slice') is not None]
+    if slice_recs:
+        print("")
+        print("Slowest slices (mean wall time per solution, all phases):")
+        totals = {}
+        counts = {}
+        for r in slice_recs:
+            totals[r['slice']] = totals.get(r['slice'], 0.0) + r['wall']
+            if r['phase'] == 'slice_solve':
+                counts[r['slice']] = counts.get(r['slice'], 0) + 1
+        mean = {s: t / max(counts.get(s, 1), 1) for s, t in totals.items()}
+        for s in sorted(mean, key=lambda s: -mean[s])[:top_slices]:
+            print('{:<20}{:>12,.1f}'.format(s, mean[s]))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Summarize a trace file written by solve_loop.py.'
+    )
+    parser.add_argument('trace_file', nargs='?', default=os.path.join('inputs', 'dw', 'trace.jsonl'))
+    parser.add_argument('--run', choices=['last', 'all'], default='last',
+        help='Report on the last run of solve_loop.py only (default) or all runs in the file.')
+    parser.add_argument('--top-slices', type=int, default=10,
+        help='Number of slowest slices to show.')
+    args = parser.parse_args(args)
+    records = read_trace(args.trace_file)
+    if args.run == 'last' and records:
+        last_run = max(r.get('run', 0) for r in records)
+        records = [r for r in records if r.get('run', 0) == last_run]
+    report(records, args.top_slices)
+
+if __name__ == '__main__':
+    main()
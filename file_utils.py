@@ -0,0 +1,42 @@
+"""
+File helpers shared by the cross-time allocation loop (solve_loop.py), the
+slice models (allocate_period_constraints.py) and the slice workers.
+
+Many of the files used by the loop are read by other processes (possibly on
+other nodes) while they are being replaced, or must survive the job being
+killed part-way through, so they are always written to a temporary file
+first and then renamed, which is atomic. This also has helpers for the
+tab-separated rows used in many of these files.
+"""
+import os, contextlib
+
+@contextlib.contextmanager
+def atomic_open(file, mode='w'):
+    """
+    Open a temporary file for writing in place of file, and rename it to
+    file when the `with` block finishes, so readers never see a partially
+    written file. If the block fails, the temporary file is removed and file
+    is left unchanged. The temporary name includes the process id, so
+    several processes can safely write the same file.
+    """
+    temp_file = '{}.{}.tmp'.format(file, os.getpid())
+    try:
+        with open(temp_file, mode) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    os.rename(temp_file, file)
+
+# helper functions to parse rows separated with tabs and terminated with newlines
+def tsv(vals):
+    return '\t'.join(map(str, vals)) + '\n'
+def split_tsv(row):
+    """Return a tuple of all items in tab-separated, newline-terminated row."""
+    return tuple(row.strip('\n').split('\t'))
+
+def write_file_atomic(file, data):
+    """Replace the contents of file with data (a string), atomically."""
+    with atomic_open(file) as f:
+        f.write(data)
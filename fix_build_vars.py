@@ -107,6 +107,8 @@ def fix_var(m, var, source_dir):
 # in all slices, they will also be met for the average of all slices.)
 #
 # TODO: we need to dualize any constraints that apply across timepoints, e.g., these:
+# (now found with allocate_period_constraints.discover_period_constraints(), which
+# keeps the ones whose rows use variables from more than one timepoint)
 # [
 #     c.name
 #     for c in m.component_objects(Constraint)
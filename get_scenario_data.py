@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-import sys, os, argparse
+import sys, os, shutil, argparse
 from textwrap import dedent
 
 import switch_model.hawaii.scenario_data as scenario_data
+import slice_groups
 
 ###########################
 # Scenario Definitions
@@ -168,7 +169,12 @@ parser.add_argument('--skip-ev-bids', action='store_true', default=False,
     help='Skip writing EV charging bids file (for faster execution)')
 # default is daily slice samples for all but 4 days in 2007-08
 parser.add_argument('--slice-count', type=int, default=727,
-    help='Number of slices to generate for post-optimization evaluation.')
+    help='Number of one-day slices to generate for post-optimization evaluation.')
+parser.add_argument('--days-per-slice', type=int, default=1,
+    help='Number of days to combine into each slice (fewer, larger subproblems); '
+         'see slice_groups.py.')
+parser.add_argument('--slice-grouping', choices=slice_groups.grouping_strategies, default='stride',
+    help='How to choose the days to combine into each slice, if --days-per-slice > 1.')
 parser.add_argument('--tiny-only', action='store_true', default=False,
     help='Only prepare inputs for the tiny scenario for testing.')
 
@@ -382,12 +388,32 @@ for a in alt_args:
 n_slices = cmd_line_args.slice_count
 scen_ids = range(n_slices)
 n_digits = 3
+# one-day slices are used directly, or saved separately and then combined
+# into multi-day slices
+grouped = cmd_line_args.days_per_slice > 1
+day_subdir = 'slice_days' if grouped else 'slices'
+groups = None
 for a in alt_args:
     for i in scen_ids:
         tag = str(i).zfill(n_digits)
         slice_args = dict(
             time_sample='slice_5_1_'+tag,
-            inputs_subdir=os.path.join(a.get('inputs_subdir', ''), 'slices', tag)
+            inputs_subdir=os.path.join(a.get('inputs_subdir', ''), day_subdir, tag)
         )
         active_args = dict(args.items() + a.items() + slice_args.items())
         scenario_data.write_tables(**active_args)
+    if grouped:
+        base_dir = os.path.join(args['inputs_dir'], a.get('inputs_subdir', ''))
+        day_dirs = [os.path.join(base_dir, day_subdir, str(i).zfill(n_digits)) for i in scen_ids]
+        if groups is None:
+            # use the same groups for all scenarios
+            groups = slice_groups.group_days(
+                day_dirs, cmd_line_args.days_per_slice, cmd_line_args.slice_grouping
+            )
+        print "Combining {} days into {} slices in {}".format(
+            len(day_dirs), len(groups), os.path.join(base_dir, 'slices')
+        )
+        # remove any slices left from a different grouping
+        if os.path.exists(os.path.join(base_dir, 'slices')):
+            shutil.rmtree(os.path.join(base_dir, 'slices'))
+        slice_groups.write_groups(day_dirs, groups, os.path.join(base_dir, 'slices'), n_digits)
@@ -0,0 +1,134 @@
+"""
+Persistent cache of slice solutions for the cross-time allocation loop
+(solve_loop.py --slice-cache-dir).
+
+Each entry holds the relaxation bid (slack used for each cross-time
+constraint, and the total cost) from one slice solution, saved under a hash
+of everything that determines that solution: the slice's inputs, the build
+variables it is fixed to, the Switch version and code, the Switch arguments
+and solver options, the relaxation prices, and the local modules and options
+file. If the loop is re-run with the same inputs (e.g., after a crash or a
+change to an unrelated script), slices with a matching entry reuse it
+instead of being solved again. The final evaluation (with the allocated
+slack) is not cached, since it is run for its detailed outputs, which the
+cache doesn't hold.
+
+Entries are saved as small JSON files, one per solution, and the cache is
+trimmed to a maximum size by removing the least recently used entries. The
+cache directory can be shared by several loops (e.g., from
+solve_loop_scenarios.py), since entries are written atomically and never
+changed afterwards.
+"""
+import os, glob, json, time, hashlib
+from file_utils import atomic_open
+
+def hash_files(files, root=None):
+    """
+    Return a SHA-1 hash of the names (relative to root, if given) and
+    contents of the specified files. Missing files are hashed as missing.
+    """
+    h = hashlib.sha1()
+    for file in sorted(files):
+        name = file if root is None else os.path.relpath(file, root)
+        h.update(name.encode('utf-8') + b'\0')
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                h.update(f.read())
+        else:
+            h.update(b'<missing>')
+        h.update(b'\0')
+    return h.hexdigest()
+
+def hash_dir(dir):
+    """Return a SHA-1 hash of the names and contents of all files in dir (recursively)."""
+    files = [
+        os.path.join(path, f)
+        for path, dirs, file_names in os.walk(dir)
+        for f in file_names
+    ]
+    return hash_files(files, root=dir)
+
+def hash_code(dir):
+    """
+    Return a SHA-1 hash of the names and contents of the Python source files
+    in dir (recursively), e.g., an installed package. Compiled files are left
+    out, since they are rewritten without any change in the code.
+    """
+    files = [
+        os.path.join(path, f)
+        for path, dirs, file_names in os.walk(dir)
+        for f in file_names
+        if f.endswith('.py')
+    ]
+    return hash_files(files, root=dir)
+
+def cache_key(*parts):
+    """Return a hash identifying a slice solution, based on strings or hashes given as parts."""
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(('' if p is None else p).encode('utf-8') + b'\0')
+    return h.hexdigest()
+
+class SliceCache(object):
+    """Slice solutions saved in dir, up to max_mb megabytes."""
+    def __init__(self, dir, max_mb):
+        self.dir = dir
+        self.max_bytes = max_mb * 1024 * 1024
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+
+    def entry_file(self, key):
+        # spread entries among subdirectories, so none gets too large
+        return os.path.join(self.dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Return the entry for key (a dict with the slice name and its bid, as
+        a list of rows of strings), or None if there isn't one.
+        """
+        file = self.entry_file(key)
+        try:
+            with open(file) as f:
+                entry = json.load(f)
+            # mark as recently used
+            os.utime(file, None)
+        except (IOError, OSError, ValueError):
+            # missing, removed by another process or partially written
+            return None
+        return entry
+
+    def put(self, key, slice, bid):
+        """Save the bid (list of rows of strings, including SystemCost) for a slice solution."""
+        file = self.entry_file(key)
+        if not os.path.exists(os.path.dirname(file)):
+            try:
+                os.makedirs(os.path.dirname(file))
+            except OSError:
+                # created by another process in the meantime
+                pass
+        cost = [row[-1] for row in bid if row[0] == 'SystemCost']
+        with atomic_open(file) as f:
+            json.dump(dict(
+                slice=slice, created=time.time(),
+                cost=float(cost[0]) if cost else None,
+                bid=[list(row) for row in bid]
+            ), f)
+
+    def trim(self):
+        """Remove the least recently used entries until the cache fits in max_mb."""
+        entries = []
+        for file in glob.glob(os.path.join(self.dir, '*', '*.json')):
+            try:
+                s = os.stat(file)
+            except OSError:
+                continue
+            entries.append((s.st_mtime, s.st_size, file))
+        total = sum(size for used, size, file in entries)
+        for used, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,147 @@
+"""
+Group similar slices into clusters, so that early rounds of the cross-time
+allocation loop can solve one representative slice from each cluster instead
+of all of them (solve_loop.py --cluster-slices).
+
+Each slice is described by its load, variable capacity factor and EV load
+profiles (loads.tab, variable_capacity_factors.tab and ev_bau_load.tab), in
+timepoint order within the slice. Each of these three blocks is scaled to the
+same total variance, so none dominates, and the slices are clustered with
+k-means. The representative of each cluster is the member closest to its
+center; during clustered rounds, every member of the cluster is given the
+representative's bid, so the representative effectively carries the weight
+of the whole cluster.
+
+All slices must have the same number of timepoints (e.g., one-day slices).
+"""
+import os
+import numpy as np
+
+# input tables used to compare slices; the last column holds the values
+profile_files = ['loads.tab', 'variable_capacity_factors.tab', 'ev_bau_load.tab']
+
+def read_profile(slice_dir, file, timepoints):
+    """
+    Return the values from the last column of file (in slice_dir) as a
+    vector, sorted by the other key columns and then by the position of the
+    timepoint in the slice. Returns an empty vector if the file doesn't exist.
+    """
+    path = os.path.join(slice_dir, file)
+    if not os.path.exists(path):
+        return np.zeros(0)
+    with open(path) as f:
+        headers = f.readline().rstrip('\n').split('\t')
+        rows = [r.rstrip('\n').split('\t') for r in f]
+    tp_col = [h.lower() for h in headers].index('timepoint')
+    rows.sort(key=lambda r: (r[:tp_col] + r[tp_col+1:-1], timepoints[r[tp_col]]))
+    return np.array([float(r[-1]) for r in rows])
+
+def slice_profiles(slices_dir, slices):
+    """
+    Return a list with one array per profile file, each with one row per
+    slice (in the same order as slices).
+    """
+    blocks = [[] for f in profile_files]
+    for s in slices:
+        slice_dir = os.path.join(slices_dir, s)
+        with open(os.path.join(slice_dir, 'timepoints.tab')) as f:
+            next(f)
+            timepoints = {r.split('\t')[0]: i for i, r in enumerate(f)}
+        for block, file in zip(blocks, profile_files):
+            block.append(read_profile(slice_dir, file, timepoints))
+    arrays = []
+    for file, block in zip(profile_files, blocks):
+        if len(set(len(p) for p in block)) > 1:
+            raise ValueError(
+                'Slices can only be clustered if they all have the same number of '
+                'rows in {}.'.format(file)
+            )
+        arrays.append(np.array(block))
+    return arrays
+
+def scaled_features(blocks):
+    """
+    Combine the profile blocks into one feature matrix, with each block
+    centered and scaled to unit total variance.
+    """
+    features = []
+    for b in blocks:
+        if b.shape[1] == 0:
+            continue
+        b = b - b.mean(axis=0)
+        scale = np.sqrt((b ** 2).sum() / b.shape[0])
+        features.append(b / (scale or 1.0))
+    return np.hstack(features)
+
+def kmeans(x, k, iterations=100, seed=0):
+    """
+    Cluster the rows of x into k groups with Lloyd's algorithm (k-means++
+    starting points). Returns a vector with the cluster number of each row
+    and an array of cluster centers.
+    """
+    rng = np.random.RandomState(seed)
+    centers = [x[rng.randint(len(x))]]
+    dist = ((x - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        if dist.sum() == 0:
+            # fewer distinct slices than clusters
+            break
+        centers.append(x[rng.choice(len(x), p=dist / dist.sum())])
+        dist = np.minimum(dist, ((x - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+    labels = None
+    x_norm = (x ** 2).sum(axis=1)
+    for i in range(iterations):
+        # squared distance from each row to each center, without building a
+        # rows x centers x features array
+        dist = x_norm[:, np.newaxis] - 2 * x.dot(centers.T) + (centers ** 2).sum(axis=1)
+        new_labels = dist.argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for c in range(len(centers)):
+            if (labels == c).any():
+                centers[c] = x[labels == c].mean(axis=0)
+    return labels, centers
+
+def cluster_slices(slices_dir, slices, n_clusters):
+    """
+    Return a dict with key=slice and value=representative slice for its
+    cluster (representatives map to themselves).
+    """
+    x = scaled_features(slice_profiles(slices_dir, slices))
+    labels, centers = kmeans(x, n_clusters)
+    representative = {}
+    for c in range(len(centers)):
+        members = np.flatnonzero(labels == c)
+        if len(members) == 0:
+            continue
+        rep = members[((x[members] - centers[c]) ** 2).sum(axis=1).argmin()]
+        for m in members:
+            representative[slices[m]] = slices[rep]
+    return representative
+
+def clustering_error(slack, cost, weights, pairs, member_weight):
+    """
+    Estimate how much using representatives' bids changes the weighted average
+    bid. slack is a slices x constraints array and cost and weights are
+    vectors for the same slices. pairs is a list of (member, representative)
+    positions for members whose own bids are known (all members, or a
+    sample), and member_weight is the total weight of all the slices that
+    are not representatives. Returns (cost error, slack error), as a fraction
+    of the average cost and of the total absolute average slack. These are
+    upper bounds on the error if pairs includes all members; otherwise they
+    are scaled up from the sample.
+    """
+    if not pairs:
+        return None, None
+    member, rep = [np.array(p) for p in zip(*pairs)]
+    w = weights[member]
+    # average absolute difference per unit of weight in the sample, applied
+    # to all the members' weight, as a share of the total weight
+    share = member_weight / w.sum() / weights.sum()
+    cost_error = share * (w * np.abs(cost[rep] - cost[member])).sum()
+    slack_error = share * (w[:, np.newaxis] * np.abs(slack[rep] - slack[member])).sum()
+    avg_cost = abs(weights.dot(cost)) / weights.sum()
+    avg_slack = np.abs(weights.dot(slack)).sum() / weights.sum()
+    return cost_error / (avg_cost or 1.0), slack_error / (avg_slack or 1.0)
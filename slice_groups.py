@@ -0,0 +1,168 @@
+"""
+Combine one-day slice models into multi-day slices for the cross-time
+allocation loop (see get_scenario_data.py and solve_loop.py).
+
+One-day slices give hundreds of tiny subproblems whose fixed overhead
+(startup, model construction, file I/O) exceeds their solve time. Grouping
+several days into each slice trades subproblem count for size, so the number
+of slices can be matched to the number of cores available.
+
+Each group is a weighted set of days: the time-indexed tables of the day
+slices (timeseries.tab, timepoints.tab and any table with a TIMEPOINT or
+TIMESERIES column) are concatenated, and ts_scale_to_period is divided by the
+number of days in the group, so the group as a whole still represents one
+full period. All other inputs must be identical across the days and are
+copied from the first one. The number of days represented by the group is
+saved in slice_weight.txt, which solve_loop.py uses to weight the bids from
+each slice.
+
+Grouping strategies:
+    stride:   day i goes in group i % n_groups, so each group spans the
+              whole calendar
+    calendar: days are sorted by day of month (then date) and split into
+              consecutive groups, e.g., all the 1st-of-month days together
+    balanced: days are ranked by net load (load minus renewable output) and
+              dealt out to the groups in serpentine order, so each group
+              resembles the overall distribution of days
+"""
+from __future__ import print_function
+
+import os, glob, shutil
+
+grouping_strategies = ['stride', 'calendar', 'balanced']
+
+# columns that show a table is indexed by time, so it should be concatenated
+# across days rather than copied
+time_columns = {'timepoint', 'timepoint_id', 'timeseries'}
+
+def read_tab(file):
+    with open(file) as f:
+        rows = [r.rstrip('\n').split('\t') for r in f]
+    return rows[0], rows[1:]
+
+def write_tab(file, headers, rows):
+    with open(file, 'w') as f:
+        f.writelines('\t'.join(map(str, r)) + '\n' for r in [headers] + rows)
+
+def is_time_indexed(file):
+    if not file.endswith('.tab'):
+        return False
+    with open(file) as f:
+        headers = f.readline().rstrip('\n').split('\t')
+    return any(h.lower() in time_columns for h in headers)
+
+def day_date(day_dir):
+    """Return (month, day of month, timestamp) for the first timepoint in a day slice."""
+    headers, rows = read_tab(os.path.join(day_dir, 'timepoints.tab'))
+    # timestamps look like 2020-01-02-00:00 (period year, but historical month and day)
+    timestamp = rows[0][headers.index('timestamp')]
+    year, month, day = timestamp.split('-')[:3]
+    return int(month), int(day), rows[0][headers.index('timepoint_id')]
+
+def day_net_load(day_dir):
+    """Return average load and average renewable capacity factor for a day slice."""
+    headers, rows = read_tab(os.path.join(day_dir, 'loads.tab'))
+    load = mean([float(r[-1]) for r in rows])
+    cf_file = os.path.join(day_dir, 'variable_capacity_factors.tab')
+    if os.path.exists(cf_file):
+        headers, rows = read_tab(cf_file)
+        cf = mean([float(r[-1]) for r in rows])
+    else:
+        cf = 0.0
+    return load, cf
+
+def mean(vals):
+    return sum(vals) / float(len(vals)) if vals else 0.0
+
+def standardize(vals):
+    m = mean(vals)
+    sd = mean([(v - m) ** 2 for v in vals]) ** 0.5
+    return [(v - m) / (sd or 1.0) for v in vals]
+
+def group_days(day_dirs, days_per_slice, strategy='stride'):
+    """
+    Return a list of groups of days, each a list of positions in day_dirs,
+    with days_per_slice days in each group (except possibly the last ones).
+    """
+    if strategy not in grouping_strategies:
+        raise ValueError('Unknown slice grouping strategy {}.'.format(strategy))
+    n_days = len(day_dirs)
+    n_groups = (n_days + days_per_slice - 1) // days_per_slice
+    if strategy == 'stride':
+        return [list(range(g, n_days, n_groups)) for g in range(n_groups)]
+    elif strategy == 'calendar':
+        dates = [day_date(d) for d in day_dirs]
+        order = sorted(range(n_days), key=lambda i: (dates[i][1], dates[i][0], dates[i][2]))
+        return [order[i:i+days_per_slice] for i in range(0, n_days, days_per_slice)]
+    else:  # balanced
+        load, cf = zip(*[day_net_load(d) for d in day_dirs])
+        # standardize both measures, so neither dominates
+        score = [l - c for l, c in zip(standardize(load), standardize(cf))]
+        groups = [[] for g in range(n_groups)]
+        for i, day in enumerate(sorted(range(n_days), key=lambda d: score[d])):
+            # serpentine order: 0, 1, ..., n-1, n-1, ..., 1, 0, 0, 1, ...
+            g = i % n_groups
+            if (i // n_groups) % 2 == 1:
+                g = n_groups - 1 - g
+            groups[g].append(day)
+        return [sorted(g) for g in groups]
+
+def write_group(day_dirs, dest_dir):
+    """
+    Combine the inputs for the day slices in day_dirs into a single slice in
+    dest_dir, with equal weight on each day.
+    """
+    n_days = len(day_dirs)
+    if os.path.exists(dest_dir):
+        shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+    for file in sorted(glob.glob(os.path.join(day_dirs[0], '*'))):
+        name = os.path.basename(file)
+        if is_time_indexed(file):
+            headers, rows = read_tab(file)
+            for d in day_dirs[1:]:
+                h, r = read_tab(os.path.join(d, name))
+                if h != headers:
+                    raise ValueError('Columns of {} differ between {} and {}.'.format(name, day_dirs[0], d))
+                rows.extend(r)
+            if name == 'timeseries.tab':
+                # each day was scaled up to represent the whole period; now
+                # they each represent their share of it
+                col = headers.index('ts_scale_to_period')
+                for r in rows:
+                    r[col] = float(r[col]) / n_days
+                ids = [r[0] for r in rows]
+                if len(set(ids)) < len(ids):
+                    raise ValueError('Duplicate timeseries in {}.'.format(', '.join(day_dirs)))
+            write_tab(os.path.join(dest_dir, name), headers, rows)
+        else:
+            # should be the same for all days
+            with open(file) as f:
+                data = f.read()
+            for d in day_dirs[1:]:
+                with open(os.path.join(d, name)) as f:
+                    if f.read() != data:
+                        raise ValueError(
+                            '{} differs between {} and {} and is not indexed by '
+                            'timepoint or timeseries, so slices cannot be grouped.'
+                            .format(name, day_dirs[0], d)
+                        )
+            shutil.copy(file, dest_dir)
+    with open(os.path.join(dest_dir, 'slice_weight.txt'), 'w') as f:
+        f.write('{}\n'.format(n_days))
+
+def write_groups(day_dirs, groups, slices_dir, n_digits=3):
+    """
+    Write grouped slices to <slices_dir>/<group number>, and record the days in
+    each group in <slices_dir>/slice_groups.tab.
+    """
+    for g, days in enumerate(groups):
+        write_group([day_dirs[d] for d in days], os.path.join(slices_dir, str(g).zfill(n_digits)))
+    write_tab(
+        os.path.join(slices_dir, 'slice_groups.tab'),
+        ['slice', 'day_slices'],
+        [
+            [str(g).zfill(n_digits), ','.join(os.path.basename(day_dirs[d]) for d in days)]
+            for g, days in enumerate(groups)
+        ]
+    )
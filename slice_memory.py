@@ -0,0 +1,189 @@
+"""
+Estimate the memory needed by each slice model and choose how many slice
+workers to run on each node within a memory budget (see --node-memory in
+solve_loop.py).
+
+The memory for a slice has two parts: the Pyomo model held by the Python
+process (roughly proportional to the number of timepoints times the number
+of generation projects, plus the EV charging bids and variable capacity
+factors) and the peak memory used by the solver while solving it. Each is
+predicted from the sizes of the slice's input tables with a linear model.
+Until there are measurements, rough default coefficients are used; after
+that, the coefficients are calibrated against the memory recorded in the
+trace file (see dw_trace.py): the growth in RSS while each model was built,
+and the peak RSS of the solver process. Peak RSS is a high-water mark for
+each process, so the estimates tend to be conservative.
+
+To see the estimates and the suggested packing, run e.g.
+
+    python slice_memory.py --node-memory 120000 --cores-per-node 24
+"""
+from __future__ import print_function
+
+import os, math, argparse
+import numpy as np
+from dw_trace import read_trace
+
+# sizes that drive the size of a slice model
+feature_names = [
+    'constant', 'timepoints', 'timepoint_projects', 'ev_charging_bids',
+    'variable_capacity_factors'
+]
+# rough MB per unit of each feature for the model and the solver, used until
+# enough measurements are available
+default_model_coefficients = np.array([20.0, 0.5, 0.02, 0.002, 0.002])
+default_solver_coefficients = np.array([30.0, 0.5, 0.01, 0.001, 0.001])
+# memory used by a worker process before building any models (Python, Pyomo
+# and Switch), if not measured
+default_base_mb = 400.0
+
+def count_rows(file):
+    """Return the number of data rows in a .tab file (0 if it doesn't exist)."""
+    if not os.path.exists(file):
+        return 0
+    with open(file) as f:
+        return max(sum(1 for row in f) - 1, 0)
+
+def slice_features(slice_dir):
+    """Return a vector of the sizes that drive the memory used by the model for slice_dir."""
+    timepoints = count_rows(os.path.join(slice_dir, 'timepoints.tab'))
+    projects = count_rows(os.path.join(slice_dir, 'generation_projects_info.tab'))
+    return np.array([
+        1.0, timepoints, timepoints * projects,
+        count_rows(os.path.join(slice_dir, 'ev_charging_bids.tab')),
+        count_rows(os.path.join(slice_dir, 'variable_capacity_factors.tab')),
+    ], dtype=float)
+
+def fit_coefficients(features, measured, default):
+    """
+    Return coefficients to predict the measured values (MB) from the features.
+    With enough measurements, this uses least squares (with no negative
+    coefficients); with only a few, it scales the default coefficients.
+    """
+    if not measured:
+        return default
+    x = np.array(features)
+    y = np.array(measured)
+    if len(y) >= 2 * x.shape[1]:
+        coefficients = np.maximum(np.linalg.lstsq(x, y, rcond=-1)[0], 0.0)
+        # use the fit unless it predicts no memory for some of the measured slices
+        if np.all(x.dot(coefficients) > 0):
+            return coefficients
+    return default * np.median(y / x.dot(default))
+
+def read_measurements(trace_file):
+    """
+    Return a dict with key=slice and value=list of (model MB, solver MB) for
+    each time its model was built, and the smallest RSS measured before
+    building a model (or None), based on the records in trace_file.
+    """
+    if not os.path.exists(trace_file):
+        return {}, None
+    builds = {}
+    solver = {}
+    for r in read_trace(trace_file):
+        if r.get('slice') is None:
+            continue
+        key = (r.get('run'), r.get('iteration'), r['slice'])
+        if r['phase'] == 'slice_build' and r.get('constructed', True) and r.get('rss_mb') is not None:
+            builds[key] = (r['start_rss_mb'], r['rss_mb'] - r['start_rss_mb'])
+        elif r['phase'] == 'slice_solve':
+            solver[key] = r['child_max_rss_mb']
+    measurements = {}
+    for key, (start, model_mb) in builds.items():
+        if key in solver:
+            measurements.setdefault(key[2], []).append((max(model_mb, 0.0), solver[key]))
+    base_mb = min(start for start, model_mb in builds.values()) if builds else None
+    return measurements, base_mb
+
+class MemoryEstimator(object):
+    """Estimates of model and solver memory (MB) for each slice in slices_dir."""
+    def __init__(self, slices_dir, slices, trace_file=None):
+        self.slices = list(slices)
+        self.features = {s: slice_features(os.path.join(slices_dir, s)) for s in self.slices}
+        measurements, base_mb = read_measurements(trace_file) if trace_file else ({}, None)
+        self.base_mb = default_base_mb if base_mb is None else base_mb
+        x = []
+        model = []
+        solver = []
+        for s, values in measurements.items():
+            if s in self.features:
+                for model_mb, solver_mb in values:
+                    x.append(self.features[s])
+                    model.append(model_mb)
+                    solver.append(solver_mb)
+        self.n_measurements = len(x)
+        self.model_coefficients = fit_coefficients(x, model, default_model_coefficients)
+        self.solver_coefficients = fit_coefficients(x, solver, default_solver_coefficients)
+
+    def model_mb(self, slice):
+        return float(self.features[slice].dot(self.model_coefficients))
+
+    def solver_mb(self, slice):
+        return float(self.features[slice].dot(self.solver_coefficients))
+
+    def worker_mb(self, slices_per_worker, persistent):
+        """
+        Return the memory needed by one worker. Persistent workers keep all
+        their models, so this allows for the largest slices_per_worker models;
+        otherwise each worker only holds one model at a time.
+        """
+        models = sorted((self.model_mb(s) for s in self.slices), reverse=True)
+        solvers = [self.solver_mb(s) for s in self.slices]
+        if persistent:
+            return self.base_mb + sum(models[:slices_per_worker]) + max(solvers)
+        return self.base_mb + max(self.model_mb(s) + self.solver_mb(s) for s in self.slices)
+
+    def workers_per_node(self, node_memory_mb, cores_per_node, nodes=1, persistent=False, margin=1.2):
+        """
+        Return the largest number of workers per node (up to cores_per_node)
+        whose estimated memory, times margin, fits in node_memory_mb, and the
+        memory needed by each worker. If even one worker per node doesn't fit,
+        returns 0 and the memory that one worker would need.
+        """
+        for k in range(cores_per_node, 0, -1):
+            slices_per_worker = int(math.ceil(len(self.slices) / float(k * nodes)))
+            need = margin * self.worker_mb(slices_per_worker, persistent)
+            if k * need <= node_memory_mb:
+                return k, need
+        return 0, need
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Estimate memory for slice models and suggest how many workers to run per node.'
+    )
+    parser.add_argument('--slices-dir', default=os.path.join('inputs', 'slices'))
+    parser.add_argument('--trace-file', default=os.path.join('inputs', 'dw', 'trace.jsonl'),
+        help='Trace file with measurements from earlier runs (see dw_trace.py).')
+    parser.add_argument('--node-memory', type=float, required=True,
+        help='Memory available for slice workers on each node (MB).')
+    parser.add_argument('--cores-per-node', type=int, required=True)
+    parser.add_argument('--nodes', type=int, default=1)
+    parser.add_argument('--persistent-workers', action='store_true', default=False,
+        help='Workers keep all their models in memory (solve_loop.py --persistent-workers).')
+    parser.add_argument('--memory-margin', type=float, default=1.2,
+        help='Safety factor applied to the estimates.')
+    args = parser.parse_args(args)
+
+    slices = sorted(
+        d for d in os.listdir(args.slices_dir)
+        if os.path.exists(os.path.join(args.slices_dir, d, 'switch_inputs_version.txt'))
+    )
+    est = MemoryEstimator(args.slices_dir, slices, args.trace_file)
+    print("Calibrated with {} measurement(s); base worker memory {:,.0f} MB.".format(
+        est.n_measurements, est.base_mb
+    ))
+    print('{:<12}{:>14}{:>14}'.format('slice', 'model (MB)', 'solver (MB)'))
+    for s in slices:
+        print('{:<12}{:>14,.0f}{:>14,.0f}'.format(s, est.model_mb(s), est.solver_mb(s)))
+    k, need = est.workers_per_node(
+        args.node_memory, args.cores_per_node, args.nodes,
+        args.persistent_workers, args.memory_margin
+    )
+    if k == 0:
+        print("One worker needs about {:,.0f} MB, which does not fit in --node-memory.".format(need))
+    else:
+        print("Run {} worker(s) per node, using up to {:,.0f} MB each.".format(k, need))
+
+if __name__ == '__main__':
+    main()
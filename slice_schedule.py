@@ -0,0 +1,142 @@
+"""
+Runtime-history-aware scheduling of slice solutions for the cross-time
+allocation loop (solve_loop.py).
+
+The time to build and solve each slice is recorded every iteration in a .tab
+file. Before each round, the slices are ordered longest-first, so that hard
+slices start early instead of setting the wall time of the whole round when
+they happen to be drawn last (longest-processing-time-first list scheduling).
+For persistent workers, which each keep their own models, the slices are
+also packed onto the available MPI ranks longest-first, giving each one to
+the rank that would finish it soonest. This accounts for the time to rebuild
+a model on a new rank and for hosts that have been running slower than the
+others.
+"""
+import os
+from file_utils import tsv
+
+class SliceTimes(object):
+    """History of build and solve times for each slice, saved in a .tab file."""
+    columns = ['iteration', 'slice', 'host', 'rank', 'build_time', 'solve_time']
+
+    def __init__(self, file):
+        self.file = file
+        # history has key=slice, value=list of (iteration, host, rank, build_time, solve_time)
+        self.history = {}
+        if os.path.exists(file):
+            with open(file) as f:
+                rows = [r for r in f][1:]
+            for row in rows:
+                try:
+                    iteration, slice, host, rank, build_time, solve_time = row.rstrip('\n').split('\t')
+                    times = (
+                        int(iteration), host, None if rank == '.' else int(rank),
+                        float(build_time), float(solve_time)
+                    )
+                except ValueError:
+                    # partial row written when the loop was interrupted
+                    continue
+                self.history.setdefault(slice, []).append(times)
+
+    def record(self, iteration, slice, host, rank, build_time, solve_time):
+        """Save the times for one slice solution; rank may be None if not known."""
+        self.history.setdefault(slice, []).append(
+            (iteration, host, rank, build_time, solve_time)
+        )
+        data = tsv([
+            iteration, slice, host, '.' if rank is None else rank,
+            build_time, solve_time
+        ])
+        if not os.path.exists(self.file):
+            data = tsv(self.columns) + data
+        # write each record with a single call, so it is never split up
+        with open(self.file, 'a') as f:
+            f.write(data)
+
+    def last_rank(self, slice):
+        """Return the rank that most recently solved this slice, or None."""
+        hist = self.history.get(slice)
+        return hist[-1][2] if hist else None
+
+    def host_speed(self):
+        """
+        Return a dict showing how slow each host is relative to the others
+        (1.0 = normal, 2.0 = takes twice as long). This is based on how much
+        the solve times for the slices most recently solved on each host
+        changed since their previous solution, relative to the change for all
+        slices (so a general increase in difficulty isn't blamed on a host).
+        """
+        totals = {}
+        all_latest = all_prev = 0.0
+        for hist in self.history.values():
+            if len(hist) < 2:
+                continue
+            latest, prev = hist[-1][4], hist[-2][4]
+            t = totals.setdefault(hist[-1][1], [0.0, 0.0])
+            t[0] += latest
+            t[1] += prev
+            all_latest += latest
+            all_prev += prev
+        if not all_latest or not all_prev:
+            return {}
+        overall = all_latest / all_prev
+        return {
+            host: (latest / prev) / overall
+            for host, (latest, prev) in totals.items()
+            if latest and prev
+        }
+
+    def base_times(self, slices):
+        """
+        Return a dict with key=slice and value=(build_time, solve_time) on a
+        normal-speed host, based on the most recent solution of each slice.
+        Slices with no history are given the average times of the others.
+        """
+        speed = self.host_speed()
+        times = {}
+        for s in slices:
+            hist = self.history.get(s)
+            if hist:
+                iteration, host, rank, build_time, solve_time = hist[-1]
+                factor = speed.get(host, 1.0)
+                times[s] = (build_time / factor, solve_time / factor)
+        if times:
+            default = tuple(
+                sum(t[i] for t in times.values()) / len(times) for i in range(2)
+            )
+        else:
+            default = (1.0, 1.0)
+        for s in slices:
+            times.setdefault(s, default)
+        return times
+
+    def longest_first(self, slices):
+        """Return the slices in order from longest to shortest build + solve time."""
+        times = self.base_times(slices)
+        return sorted(slices, key=lambda s: -sum(times[s]))
+
+    def assign_ranks(self, slices, ranks):
+        """
+        Assign slices to persistent workers. ranks is a dict with key=rank and
+        value=host name (or None if not known). Slices are taken longest-first
+        and each is given to the rank that would finish it soonest, counting
+        the time to build the model if that rank doesn't already have it and
+        the relative speed of each host. Returns a dict with key=slice and
+        value=rank, and the expected wall time for the round.
+        """
+        times = self.base_times(slices)
+        speed = self.host_speed()
+        rank_speed = {r: speed.get(h, 1.0) for r, h in ranks.items()}
+        loads = {r: 0.0 for r in ranks}
+        assignment = {}
+        for s in sorted(slices, key=lambda s: -times[s][1]):
+            build_time, solve_time = times[s]
+            current = self.last_rank(s)
+            best = None
+            for r in ranks:
+                t = rank_speed[r] * (solve_time + (0.0 if r == current else build_time))
+                if best is None or loads[r] + t < best[0]:
+                    best = (loads[r] + t, r)
+            loads[best[1]] = best[0]
+            assignment[s] = best[1]
+        return assignment, max(loads.values()) if loads else 0.0
@@ -0,0 +1,245 @@
+"""
+Persistent worker for solving slice models in the cross-time allocation loop
+(solve_loop.py --persistent-workers).
+
+`switch solve-scenarios` re-imports Switch, re-reads the inputs and rebuilds
+every slice model in every round, even though only the relaxation prices
+change between rounds. Instead, each copy of this script (usually one per MPI
+rank, launched via `mpirun python slice_worker.py --queue-dir <dir>`) claims
+tasks from a shared task queue (see task_queue.py), keeps the model instance
+for each slice it has solved, and on later rounds just updates the relaxation
+prices in place and re-solves.
+
+Tasks can also come from a coordinator running inside solve_loop.py, over a
+socket instead of the filesystem (--coordinator <host>:<port>; see
+coordinator.py). Workers can be started without mpirun by giving --rank and
+--size (solve_loop.py --local-workers does this).
+
+Each worker handles the tasks whose id starts with its MPI rank (modulo the
+number of ranks), so each model is normally only constructed once. solve_loop.py
+uses this to pack slices onto ranks based on their past solution times (see
+slice_schedule.py). With --steal-tasks (used for asynchronous iterations), a
+worker that has nothing else to do will also take tasks for other slices,
+preferring ones whose models it already has.
+
+Several copies of solve_loop.py (one per base scenario) can share the same
+pool of workers (see solve_loop_scenarios.py). Then the workers hold models
+for slices of several scenarios; use --max-models to limit how many each one
+keeps in memory.
+
+Tasks for the final evaluation (with final=True) are solved by running
+`switch solve` in a separate process instead: the models kept by the worker
+are built with --no-standard-results, which removes the standard Switch
+post_solve() functions for the whole process, but the final evaluation needs
+the standard outputs. This also means the loop doesn't need to start a
+second set of processes for the final evaluation.
+
+Switch and Pyomo are only imported when the first task arrives, so the
+workers register and start taking tasks as soon as they are launched.
+"""
+from __future__ import print_function
+
+import os, gc, sys, time, json, shlex, argparse, traceback, subprocess
+from collections import OrderedDict
+from dw_trace import usage
+import task_queue
+
+def get_rank_and_size():
+    """Return rank of this process and number of processes, as set by mpirun or slurm."""
+    for rank_var, size_var in [
+        ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+        ('PMI_RANK', 'PMI_SIZE'),
+        ('SLURM_PROCID', 'SLURM_NTASKS'),
+    ]:
+        if rank_var in os.environ and size_var in os.environ:
+            return int(os.environ[rank_var]), int(os.environ[size_var])
+    return 0, 1
+
+def build_slice_model(args):
+    """
+    Construct a model instance for one slice, using the standard options
+    from options.txt plus the specified argument string (same format as a
+    line in scenarios.txt).
+    """
+    import switch_model.solve
+    args = switch_model.solve.get_option_file_args() + shlex.split(args)
+    model = switch_model.solve.main(args=args, return_model=True)
+    instance = model.load_inputs()
+    # solver options given in the arguments, used unless a task overrides them
+    instance.default_solver_options_string = instance.options.solver_options_string
+    instance.pre_solve()
+    return instance
+
+def solve_task(models, task):
+    """
+    Solve the slice model for this task, reusing the model instance from an
+    earlier round if available, and return a dict of results.
+    """
+    import switch_model.solve
+    from allocate_period_constraints import (
+        set_cross_time_relaxation_prices, set_warm_start_options
+    )
+    start = usage()
+    # move to the end of the list of models, as the most recently used
+    instance = models.pop(task['slice'], None)
+    if instance is None or instance.worker_args != task['args']:
+        # first time for this slice (or settings have changed); build it
+        # (this reads prices from the file named in the arguments)
+        instance = build_slice_model(task['args'])
+        instance.worker_args = task['args']
+        instance.model_constructed = True
+        if task['price_file'] != instance.options.cross_time_relaxation_price_file:
+            set_cross_time_relaxation_prices(instance, task['price_file'])
+    else:
+        # only the prices have changed since the last round (the previous
+        # solution is also still in the model, so it is sent to the solver
+        # as the initial values of the variables)
+        set_cross_time_relaxation_prices(instance, task['price_file'])
+        instance.model_constructed = False
+    # use the solver options for this round (e.g., a looser MIP gap in early
+    # rounds; see solve_loop.py), then start from the basis saved last time
+    # (if requested)
+    solver_options = task.get('solver_options_string') or instance.default_solver_options_string
+    instance.options.solver_options_string = solver_options
+    instance.base_solver_options_string = solver_options
+    set_warm_start_options(instance)
+    # iteration, time and memory reported with the bid (see
+    # allocate_period_constraints.py); the build phase covers construction or
+    # just the price update, whichever was done this time
+    instance.options.relaxation_bid_tag = str(task.get('tag', task['iteration']))
+    instance.build_start_usage = start
+    instance.solve_start_usage = usage()
+    switch_model.solve.solve(instance)
+    # save relaxation bid, etc.
+    instance.post_solve()
+    # send the bid and trace back with the results, so the master doesn't
+    # need to read them while this slice may be solved again
+    with open(os.path.join(instance.options.outputs_dir, 'relaxation_bid.tab')) as f:
+        bid = [row.rstrip('\n').split('\t') for row in f]
+    with open(os.path.join(instance.options.outputs_dir, 'slice_trace.json')) as f:
+        trace = json.load(f)
+    models[task['slice']] = instance
+    return dict(iteration=task['iteration'], bid=bid, trace=trace)
+
+def solve_final_task(models, task):
+    """
+    Solve the slice model for a final-evaluation task in a fresh `switch solve`
+    process, so it writes the standard outputs, and return a dict of results.
+    """
+    # the loop for this slice is finished, so its model isn't needed any more
+    if models.pop(task['slice'], None) is not None:
+        gc.collect()
+    cmd = (
+        ['switch', 'solve'] + shlex.split(task['args'])
+        + ['--relaxation-bid-tag', str(task['tag'])]
+    )
+    return_code = subprocess.call(cmd)
+    if return_code:
+        raise RuntimeError(
+            'Command "{}" exited with code {}.'.format(' '.join(cmd), return_code)
+        )
+    with open(os.path.join(task['outputs_dir'], 'relaxation_bid.tab')) as f:
+        bid = [row.rstrip('\n').split('\t') for row in f]
+    with open(os.path.join(task['outputs_dir'], 'slice_trace.json')) as f:
+        trace = json.load(f)
+    return dict(iteration=task['iteration'], bid=bid, trace=trace)
+
+def drop_old_models(models, max_models):
+    """Discard the least recently used models until there are no more than max_models."""
+    if max_models is None or len(models) <= max_models:
+        return
+    while len(models) > max_models:
+        models.popitem(last=False)
+    # pyomo models have lots of reference cycles
+    gc.collect()
+
+def choose_tasks(task_ids, models, rank, size, steal):
+    """
+    Return the ids of the tasks this worker should try to claim, in order of
+    preference: its own slices first, then slices whose models it already has,
+    then (if steal is True) any other slices.
+    """
+    own = []
+    held = []
+    other = []
+    for task_id in task_ids:
+        # task ids are <index>_<slice name>
+        index, slice = task_id.split('_', 1)
+        if int(index) % size == rank:
+            own.append(task_id)
+        elif slice in models:
+            held.append(task_id)
+        elif steal:
+            other.append(task_id)
+    if own:
+        return own
+    else:
+        return held + other
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue-dir', default=None,
+        help='Directory holding the task queue shared with solve_loop.py.')
+    parser.add_argument('--coordinator', default=None,
+        help='Get tasks from the coordinator at <host>:<port> (see coordinator.py) '
+             'instead of a queue directory.')
+    parser.add_argument('--authkey-file', default=None,
+        help='File holding the key used to connect to the coordinator.')
+    parser.add_argument('--rank', type=int, default=None,
+        help='Rank of this worker, if not started by mpirun or slurm (requires --size).')
+    parser.add_argument('--size', type=int, default=None,
+        help='Total number of workers, if not started by mpirun or slurm.')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+        help='Number of seconds to wait between checks for new tasks.')
+    parser.add_argument('--steal-tasks', action='store_true', default=False,
+        help="Take tasks for other workers' slices when there are none for this worker.")
+    parser.add_argument('--max-models', type=int, default=None,
+        help='Maximum number of slice models to keep in memory; the least recently '
+             'used ones are discarded first (default is no limit).')
+    args = parser.parse_args(args)
+    if (args.queue_dir is None) == (args.coordinator is None):
+        parser.error('Exactly one of --queue-dir or --coordinator must be specified.')
+    if (args.rank is None) != (args.size is None):
+        parser.error('--rank and --size must be used together.')
+
+    if args.coordinator is None:
+        queue = task_queue.TaskQueue(args.queue_dir)
+    else:
+        from coordinator import CoordinatorClient
+        queue = CoordinatorClient(args.coordinator, args.authkey_file)
+
+    if args.rank is None:
+        rank, size = get_rank_and_size()
+    else:
+        rank, size = args.rank, args.size
+    worker = '{}_{}'.format(os.uname()[1], rank)
+    # models dict has key=slice name, value=model instance, in order from
+    # least to most recently used
+    models = OrderedDict()
+    # tell solve_loop.py how many workers there are and where they are running
+    queue.register_worker(worker, dict(rank=rank, size=size, host=os.uname()[1]))
+    print("Slice worker {} (rank {} of {}) waiting for tasks.".format(worker, rank, size))
+    while not queue.stop_requested():
+        claimed = False
+        waiting = queue.waiting_tasks()
+        for task_id in choose_tasks(waiting, models, rank, size, args.steal_tasks):
+            task = queue.claim_task(task_id, worker)
+            if task is None:
+                continue
+            claimed = True
+            try:
+                if task.get('final'):
+                    result = solve_final_task(models, task)
+                else:
+                    result = solve_task(models, task)
+            except Exception:
+                traceback.print_exc()
+                result = dict(iteration=task['iteration'], error=traceback.format_exc())
+            result.update(rank=rank, host=os.uname()[1])
+            queue.finish_task(task, worker, result)
+            drop_old_models(models, args.max_models)
+        if not claimed:
+            time.sleep(args.poll_interval)
+
+if __name__ == '__main__':
+    main()
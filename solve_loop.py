@@ -1,9 +1,7 @@
 """
 TODO:
 - if a job array number is passed, make solver steps use that row from scenarios.txt, otherwise default
-- save evaluation scenarios in files called scenarios_eval_<scen_name>.txt
-- save outputs in <outputs_dir>/slices/n, where <outputs_dir> comes from base model, e.g., outputs/high_oil
-- save slice inputs in <inputs_dir>/slices/n (not inputs/slices)
+  (--scenario <name> does this by name; see solve_loop_scenarios.py to run many at once)
 """
 # process:
 # - solve main model
@@ -34,34 +32,292 @@ TODO:
 
 # This is expected to run on a server, with access to some number of nodes and cores via mpirun
 
-import os, sys, shutil, glob, pipes
-import switch_model.solve
-from allocate_period_constraints import get_period_constraints, relax_var_name
-from pyomo.environ import *
-from pyomo.opt import SolverStatus, TerminationCondition
-import pyutilib.subprocess  # handy for running scripts with streaming output
+import os, re, sys, time, json, binascii, shutil, glob, math, pipes, shlex, hashlib, argparse, subprocess
+from bid_store import BidStore
+from dw_stabilization import Stabilizer, stabilization_modes
+from dw_bounds import lagrangian_value, relative_gap
+from slice_schedule import SliceTimes
+from dw_trace import Tracer
+from file_utils import atomic_open, write_file_atomic, tsv, split_tsv
+from slice_cache import SliceCache, hash_files, hash_dir, hash_code, cache_key
+from slice_clusters import cluster_slices, clustering_error
+import numpy as np
+import task_queue
+# note: Switch, Pyomo (via dw_master) and pyutilib are only imported when
+# needed, so this script starts quickly when it is restarted
 
-# setup dummy model (with no data) so we can read standard settings as needed
-args = switch_model.solve.get_option_file_args()
-m = switch_model.solve.main(args=args, return_model=True)
+parser = argparse.ArgumentParser()
+parser.add_argument('--scenario', default=None,
+    help='Name of a construction scenario in --scenario-list to evaluate. Its '
+         'arguments are added to the ones in options.txt, slice inputs are read from '
+         '<inputs_dir>/slices, and DW files and slice outputs are saved in '
+         '<outputs_dir>/dw and <outputs_dir>/slices, so several scenarios can be '
+         'evaluated at the same time (see solve_loop_scenarios.py). By default, the '
+         'model in options.txt is used, with inputs/slices and inputs/dw.')
+parser.add_argument('--scenario-list', default='scenarios.txt',
+    help='File listing the construction scenarios (written by get_scenario_data.py), '
+         'used with --scenario.')
+parser.add_argument('--worker-queue-dir', default=None,
+    help='Send slices to a pool of slice workers that is already running with this '
+         'task queue directory (e.g., shared with the loops for other scenarios by '
+         'solve_loop_scenarios.py) instead of starting one. Implies --persistent-workers.')
+parser.add_argument('--coordinator', action='store_true', default=False,
+    help='Hand out slices to persistent workers from a coordinator in this process, '
+         'over a socket (see coordinator.py), instead of the file-based task queue. '
+         'Implies --persistent-workers.')
+parser.add_argument('--local-workers', type=int, default=None,
+    help='Run this many persistent workers as local processes instead of using '
+         'mpirun (e.g., for testing on a workstation). Implies --persistent-workers.')
+parser.add_argument('--persistent-workers', action='store_true', default=False,
+    help='Solve slices with a pool of long-lived worker processes that keep their '
+         'models in memory between iterations (see slice_worker.py), instead of '
+         'running `switch solve-scenarios` from scratch each iteration.')
+parser.add_argument('--stabilization', choices=stabilization_modes, default='none',
+    help='Method to use to stabilize the relaxation prices sent to the slices '
+         '(see dw_stabilization.py).')
+parser.add_argument('--stabilization-alpha', type=float, default=0.5,
+    help='Weight on the best prices found so far when using Wentges smoothing.')
+parser.add_argument('--stabilization-step', type=float, default=0.5,
+    help='Initial half-width of the box around the best prices found so far '
+         'for boxstep or bundle stabilization, as a fraction of each price.')
+parser.add_argument('--stabilization-min-step', type=float, default=1.0,
+    help='Minimum half-width of the box around each price for boxstep or bundle '
+         'stabilization.')
+parser.add_argument('--stabilization-min-step-fraction', type=float, default=0.01,
+    help='Smallest half-width of the box (as a fraction of each price) that bundle '
+         'stabilization can shrink to after null steps.')
+parser.add_argument('--stabilization-max-step-fraction', type=float, default=10.0,
+    help='Largest half-width of the box (as a fraction of each price) that bundle '
+         'stabilization can grow to after serious steps.')
+parser.add_argument('--initial-prices', choices=['flat', 'base-duals', 'file', 'presolve'],
+    default='flat',
+    help='Relaxation prices for the first round: the same high price for every '
+         'constraint (flat); the duals from the base model (base-duals); prices from '
+         'an earlier run of a related scenario, given by --initial-price-file (file); '
+         'or duals from a smaller version of the base model, given by '
+         '--presolve-inputs-dir (presolve). Constraints with no information get the '
+         'base-model dual if available, otherwise the high price.')
+parser.add_argument('--initial-price-file', default=None,
+    help='With --initial-prices file, the relaxation_prices.tab file from an earlier '
+         'run of the loop for a related scenario, or the dw directory holding it.')
+parser.add_argument('--presolve-inputs-dir', default=None,
+    help='With --initial-prices presolve, inputs directory for a smaller version of '
+         'the base model (e.g., fewer timepoints per day), which is solved to get '
+         'initial prices.')
+parser.add_argument('--initial-price-scale', type=float, default=1.0,
+    help='Multiply duals by this factor to get initial prices (base-duals or presolve).')
+parser.add_argument('--initial-price-floor', type=float, default=1.0,
+    help='Minimum initial price for constraints whose dual is zero (not binding in '
+         'the base model), so slices do not treat their slack as free.')
+parser.add_argument('--discover-cross-time-constraints', action='store_true', default=False,
+    help='Also relax cross-time constraints found by scanning the base model for '
+         'constraints indexed by period whose rows use variables from more than one '
+         'timepoint or timeseries, in addition to the list in '
+         'allocate_period_constraints.py. '
+         'Only applies when the base model is solved (i.e., if its '
+         'cross_time_duals.tab does not exist yet).')
+parser.add_argument('--relax-binding-only', action='store_true', default=False,
+    help='Only relax and price the cross-time constraint rows that are binding in '
+         'the base model (non-zero dual). Other rows must be met by each slice on its '
+         'own, which gives smaller master problems and bids, but may make slices '
+         'infeasible if a constraint is nearly binding.')
+parser.add_argument('--binding-dual-tolerance', type=float, default=1e-6,
+    help='With --relax-binding-only, treat rows whose dual in the base model is no '
+         'larger than this (in absolute value) as non-binding.')
+parser.add_argument('--master-solver-options', default=None,
+    help='Options for the persistent solver interface used for the master problem, '
+         'if one is available (see dw_master.py), using its option names, e.g., '
+         '"threads=8 mip_tolerances_mipgap=1e-6" for cplex_persistent. The '
+         'AMPL-style --solver-options-string from options.txt is only used when the '
+         'master problem is solved by a separate solver process.')
+parser.add_argument('--gap-tolerance', type=float, default=0.001,
+    help='Stop iterating when the gap between the upper bound (from the master '
+         'problem) and the Lagrangian lower bound (from the slices) is less than '
+         'this fraction of the upper bound (see also --slack-tolerance).')
+parser.add_argument('--slack-tolerance', type=float, default=100.0,
+    help='Also require the total unallocated cross-time slack in the master problem '
+         'to be less than this before stopping. (Battery slack never quite converges '
+         'to 0, maybe because it is nonbinding or max_relax * cost is within the '
+         "solver's optimization gap.)")
+parser.add_argument('--async-fraction', type=float, default=None,
+    help='Use asynchronous iterations with persistent workers: re-solve the master '
+         'problem as soon as this fraction of slices have reported new bids, '
+         'instead of waiting for all of them.')
+parser.add_argument('--async-sync-interval', type=int, default=5,
+    help='With --async-fraction, wait for all slices to be solved with the same '
+         'prices every this many iterations, to get a new lower bound.')
+parser.add_argument('--reuse-bid-tolerance', type=float, default=None,
+    help='Keep the previous bid from a slice instead of solving it again when the '
+         'most that re-solving could improve its Lagrangian value (the change in its '
+         'prices times the range of slack it has reported so far) is less than this '
+         'fraction of its cost. Rounds with reused bids do not give a lower bound.')
+parser.add_argument('--full-refresh-interval', type=int, default=5,
+    help='With --reuse-bid-tolerance, solve all the slices every this many '
+         'iterations (and in all iterations before the first of these).')
+parser.add_argument('--cluster-slices', type=int, default=None,
+    help='In early iterations, group the slices into this many clusters with similar '
+         'load, renewable and EV profiles and only solve one representative from each '
+         'cluster, giving its bid to the whole cluster (see slice_clusters.py). All '
+         'slices are solved once the prices stabilize, and in the final evaluation.')
+parser.add_argument('--cluster-price-change', type=float, default=0.05,
+    help='With --cluster-slices, solve all slices once the total change in prices '
+         'from one iteration to the next is less than this fraction of the total.')
+parser.add_argument('--cluster-max-iterations', type=int, default=10,
+    help='With --cluster-slices, solve all slices from this iteration on, even if '
+         'the prices have not stabilized.')
+parser.add_argument('--cluster-check-slices', type=int, default=4,
+    help='With --cluster-slices, also solve this many other members of the clusters '
+         'in each clustered round (different ones each time), to estimate the error '
+         'caused by clustering.')
+parser.add_argument('--warm-start-slices', action='store_true', default=False,
+    help='Start each slice solution from the basis saved by the previous round '
+         '(see --warm-start-basis in allocate_period_constraints.py).')
+parser.add_argument('--column-max-age', type=int, default=None,
+    help='Remove rounds from the master problem after their weight has been zero '
+         'for more than this many iterations (they are kept in the bid archive).')
+parser.add_argument('--max-columns', type=int, default=None,
+    help='Maximum number of rounds to keep in the master problem; rounds that have '
+         'had zero weight the longest are removed first.')
+parser.add_argument('--column-dedup-tolerance', type=float, default=None,
+    help='Skip new rounds whose cost and slack are all within this relative '
+         'tolerance of a round already in the master problem.')
+parser.add_argument('--slice-mipgap-max', type=float, default=None,
+    help='Solve slices inexactly in early iterations: use this relative MIP gap '
+         'until there is a lower bound, then --slice-gap-fraction times the gap '
+         'between the upper and lower bounds (which is large while the master '
+         'problem still needs penalized slack), until that is no looser than the '
+         'standard solver options. The final evaluation always uses the standard '
+         'options. (Uses cplexamp option names.)')
+parser.add_argument('--slice-gap-fraction', type=float, default=0.1,
+    help='With --slice-mipgap-max, fraction of the current upper/lower bound gap to '
+         'use as the MIP gap for the slices.')
+parser.add_argument('--slice-time-limit', type=float, default=None,
+    help='With --slice-mipgap-max, also limit inexact slice solutions to this many '
+         'seconds. Time-limited rounds do not give a lower bound, so the limit is '
+         'only used when the previous round did.')
+parser.add_argument('--slice-cache-dir', default=None,
+    help='Save slice solutions in this directory, keyed by a hash of their inputs, '
+         'build variables, options and relaxation prices, and reuse them instead of '
+         'solving slices again when the loop is re-run with the same inputs (see '
+         'slice_cache.py). The final evaluation is always solved, since it is run '
+         'for its detailed outputs.')
+parser.add_argument('--slice-cache-size', type=float, default=2000.0,
+    help='Maximum size of the slice cache (MB); the least recently used solutions '
+         'are removed first.')
+parser.add_argument('--node-memory', type=float, default=None,
+    help='Memory (MB) available for slice workers on each node. If given, mpirun '
+         'starts only as many slice workers on each node as fit in this much memory, '
+         'based on the estimated size of each slice model (see slice_memory.py), '
+         'instead of one per core. (Uses OpenMPI --map-by.)')
+parser.add_argument('--cores-per-node', type=int, default=None,
+    help='Maximum number of slice workers to run on each node with --node-memory '
+         '(default is $SLURM_CPUS_ON_NODE or the number of cores on this node).')
+parser.add_argument('--memory-margin', type=float, default=1.2,
+    help='Safety factor applied to the memory estimates for --node-memory.')
+cmd_line_args = parser.parse_args()
+if cmd_line_args.worker_queue_dir is not None:
+    if cmd_line_args.coordinator or cmd_line_args.local_workers:
+        parser.error('--worker-queue-dir cannot be used with --coordinator or --local-workers.')
+    cmd_line_args.persistent_workers = True
+if cmd_line_args.coordinator or cmd_line_args.local_workers:
+    cmd_line_args.persistent_workers = True
+if cmd_line_args.async_fraction is not None:
+    if not cmd_line_args.persistent_workers:
+        parser.error('--async-fraction requires --persistent-workers.')
+    if not 0.0 < cmd_line_args.async_fraction <= 1.0:
+        parser.error('--async-fraction must be greater than 0 and no more than 1.')
+if cmd_line_args.initial_prices == 'file' and cmd_line_args.initial_price_file is None:
+    parser.error('--initial-prices file requires --initial-price-file.')
+if cmd_line_args.initial_prices == 'presolve' and cmd_line_args.presolve_inputs_dir is None:
+    parser.error('--initial-prices presolve requires --presolve-inputs-dir.')
+
+def get_scenario_args(scenario, scenario_list):
+    """Return the argument string for the named scenario in the scenario list file."""
+    with open(scenario_list) as f:
+        for line in f:
+            args = shlex.split(line, comments=True)
+            if (
+                '--scenario-name' in args
+                and args[args.index('--scenario-name') + 1] == scenario
+            ):
+                return line.strip()
+    raise ValueError('Scenario {} was not found in {}.'.format(scenario, scenario_list))
+
+# arguments for the base (construction) model, added to the ones in options.txt
+# (slice arguments come after these, so they override the inputs and outputs dirs)
+if cmd_line_args.scenario is None:
+    base_scenario_args = ''
+else:
+    base_scenario_args = get_scenario_args(
+        cmd_line_args.scenario, cmd_line_args.scenario_list
+    ) + ' '
+
+def read_base_options(extra_args):
+    """
+    Return the standard Switch settings used by this script (inputs and outputs
+    dirs and solver settings) from options.txt, followed by extra_args. This
+    follows the same rules as switch_model.solve.get_option_file_args() and
+    uses the same defaults as Switch, but doesn't import Switch or construct a
+    model, which takes a long time. Other arguments are ignored.
+    """
+    args = []
+    if os.path.exists('options.txt'):
+        with open('options.txt') as f:
+            args.extend(shlex.split(f.read(), comments=True))
+    args.extend(extra_args)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--inputs-dir', default='inputs')
+    parser.add_argument('--outputs-dir', default='outputs')
+    parser.add_argument('--solver', default='glpk')
+    parser.add_argument('--solver-io', default=None)
+    parser.add_argument('--solver-options-string', default=None)
+    options, other_args = parser.parse_known_args(args)
+    return options
+
+# read standard settings for the base model
+base_options = read_base_options(shlex.split(base_scenario_args))
 
 # solver options for multi-thread (main model) and single-thread solutions
 # we assume the existing arguments are suited for a multi-threaded solve,
 # and construct a single-threaded option string based on them (may only work with cplexamp)
-solver_options_multi_thread = m.options.solver_options_string
-solver_options_single_thread = m.options.solver_options_string + ' threads=1'
+solver_options_multi_thread = base_options.solver_options_string or ''
+solver_options_single_thread = solver_options_multi_thread + ' threads=1'
+# MIP gap for exact slice solutions (see choose_slice_tolerance()); 1e-4 is the cplex default
+base_slice_mipgap = float(
+    (re.findall(r'\bmipgap=([0-9.eE+-]+)', solver_options_single_thread) or [1e-4])[-1]
+)
 
-base_dual_price_file = os.path.join(m.options.outputs_dir, 'cross_time_duals.tab')
-dw_dir = 'inputs/dw'  # any way to derive this from the base model?
-slices_dir = 'inputs/slices'
+base_dual_price_file = os.path.join(base_options.outputs_dir, 'cross_time_duals.tab')
+if cmd_line_args.scenario is None:
+    dw_dir = 'inputs/dw'  # any way to derive this from the base model?
+    slices_dir = 'inputs/slices'
+    slice_outputs_dir = 'outputs'
+    # final allocation of slack to each slice is saved in its inputs dir
+    allocation_dir = slices_dir
+else:
+    # several base scenarios may use the same inputs dir (and slices), so
+    # everything that depends on the base model's solution goes in its own
+    # outputs dir
+    dw_dir = os.path.join(base_options.outputs_dir, 'dw')
+    slices_dir = os.path.join(base_options.inputs_dir, 'slices')
+    slice_outputs_dir = os.path.join(base_options.outputs_dir, 'slices')
+    allocation_dir = os.path.join(dw_dir, 'allocation')
 
 # total cost and slack for relaxation variables in the most recent solution
 # of the slices (saved by each slice in its own outputs directory)
 relaxation_bid_file = 'relaxation_bid.tab'
-# record of all bids from all slices in all iteration rounds
-slice_bid_file = os.path.join(dw_dir, 'cross_time_allocation_bids_per_slice.tab')
-# record of average bids across all slices in all iteration rounds
-bid_file = os.path.join(dw_dir, 'cross_time_allocation_bids.tab')
+# marker showing which round the bid belongs to (also in the slice outputs
+# directory), used to skip finished slices when a round is restarted
+relaxation_bid_done_file = 'relaxation_bid_done.json'
+# random id for the current run of the loop (from iteration 0 on), included in
+# the tags in these markers, so bids left from an earlier run (e.g., before
+# the inputs changed) are never mistaken for bids from this one, even if the
+# prices are the same
+run_id_file = os.path.join(dw_dir, 'run_id.txt')
+run_id = []
+# record of all bids from all slices in all iteration rounds, and weighted
+# average bids across all slices (see bid_store.py)
+bid_store_dir = os.path.join(dw_dir, 'bids')
 
 # DW-generated elements that are shared between slices
 # Note: all DW-generated stuff is in one dir;
@@ -69,26 +325,169 @@ bid_file = os.path.join(dw_dir, 'cross_time_allocation_bids.tab')
 # TODO: put per-slice data in here too?
 slice_price_file = os.path.join(dw_dir, 'relaxation_prices.tab')
 
+# list of slices and queue directory for `switch solve-scenarios`
+slice_list_file = os.path.join(dw_dir, 'slice_scenarios.txt')
+slice_queue_dir = os.path.join(dw_dir, 'scenario_queue')
+
+# queue for passing slice solutions to persistent workers, if used; this may
+# be shared with loops for other base scenarios, if --worker-queue-dir is given
+worker_queue_dir = cmd_line_args.worker_queue_dir or os.path.join(dw_dir, 'task_queue')
+# task queue (task_queue.TaskQueue or coordinator.Coordinator) and worker
+# processes, created by start_worker_pool()
+work_queue = None
+worker_pool = None
+worker_pool_joined = False
+# key used to authenticate workers with the coordinator (--coordinator)
+coordinator_key_file = os.path.join(dw_dir, 'coordinator.key')
+# prices used in each iteration; tasks refer to these rather than
+# slice_price_file, because with asynchronous iterations some slices may
+# still be solving with older prices when new ones are written
+iteration_price_dir = os.path.join(dw_dir, 'prices')
+# most recent bid from each slice, with key=slice name and value=(iteration
+# of the prices used, list of rows from the relaxation bid file)
+slice_bids = {}
+# slices currently queued or solving, with key=slice name and value=task
+# (includes the iteration of the prices given to them)
+slice_tasks = {}
+
+# outputs from the smaller model solved for --initial-prices presolve
+presolve_outputs_dir = os.path.join(dw_dir, 'presolve')
+
+# record of the stabilization applied to the prices in each round
+stabilization_log_file = os.path.join(dw_dir, 'stabilization_log.tab')
+stabilization_state_file = os.path.join(dw_dir, 'stabilization_state.json')
+
+# history of upper and lower bounds on the total cost
+bounds_file = os.path.join(dw_dir, 'bounds.tab')
+# MIP gap and time limit used for the slices in each iteration (see
+# choose_slice_tolerance())
+slice_tolerance_file = os.path.join(dw_dir, 'slice_tolerances.json')
+# Lagrangian value for each round (see dw_bounds.lagrangian_value())
+lagrangian_values = {}
+
+# number of iterations each round in the master problem has had zero weight
+# (see MasterProblem.prune()), saved so it survives a restart
+column_age_file = os.path.join(dw_dir, 'column_ages.json')
+# rounds that have been read from the bid store since (re)starting
+loaded_rounds = set()
+
+# representative of each slice's cluster (see get_slice_clusters()), the
+# iteration when we started solving all the slices (see clustered_round()),
+# and the estimated error in the bids caused by clustering, for --cluster-slices
+slice_cluster_file = os.path.join(dw_dir, 'slice_clusters.json')
+slice_representatives = None
+cluster_state_file = os.path.join(dw_dir, 'cluster_state.json')
+cluster_error_file = os.path.join(dw_dir, 'cluster_error.tab')
+# rounds where only cluster representatives were solved
+clustered_rounds = set()
+
+# weight of each slice when calculating average bids (see get_slice_weights())
+slice_weights = None
+
+# build and solve times for each slice in each iteration, used to start the
+# slowest slices first (see slice_schedule.py); these are kept between runs
+slice_times_file = os.path.join(dw_dir, 'slice_times.tab')
+slice_times = None
+
+# wall time, CPU time and peak memory for each phase of each iteration and for
+# each slice solution, as JSON lines (see dw_trace.py; summarize with
+# `python dw_trace.py`); records from each run of this script are tagged with
+# its start time
+trace_file = os.path.join(dw_dir, 'trace.jsonl')
+tracer = Tracer(trace_file, run=time.time())
+
+# solutions from earlier runs that can be reused (see slice_cache.py)
+slice_cache = (
+    None if cmd_line_args.slice_cache_dir is None
+    else SliceCache(cmd_line_args.slice_cache_dir, cmd_line_args.slice_cache_size)
+)
+# local files that affect the slice solutions, besides their own inputs
+slice_code_files = [
+    'options.txt', 'modules.txt', 'allocate_period_constraints.py', 'fix_build_vars.py'
+]
+# hash of the inputs for each slice that don't change during a run (see slice_cache_key())
+slice_input_hashes = {}
+
+# Dantzig-Wolfe master problem; this is created the first time it is needed
+# (loading all bids saved so far), then kept in memory and extended with each
+# new round of bids (see dw_master.py).
+master = None
+stabilizer = None
+
 # setup scenarios for slice-solving
 # (assume every valid switch subdir in the slices dir is a scenario)
 scenarios = sorted([
-    p.split('/')[-2] for p in glob.glob('inputs/slices/*/switch_inputs_version.txt')
+    p.split(os.path.sep)[-2]
+    for p in glob.glob(os.path.join(slices_dir, '*', 'switch_inputs_version.txt'))
 ])
-with open('scenarios.txt', 'w') as f:
-    f.writelines(
+def solver_options_args(solver_options):
+    return '--solver-options-string {} '.format(pipes.quote(solver_options))
+slice_base_args = {
+    s:
+        base_scenario_args +
         '--scenario-name {s} --inputs-dir {sd}/{s} '
-        '--outputs-dir outputs/{s} '
+        '--outputs-dir {od}/{s} '
         '--include-module fix_build_vars --fix-build-vars-source-dir {bd} '
         # '--no-cross-time-duals ' # not needed for slice solutions but interesting for diagnosis
-        '--solver-options-string {so} ' # restrict to one thread so we can run many per node
-        '\n'
-        .format(
-            s=s, sd=slices_dir, bd=m.options.outputs_dir
-            so=pipes.quote(solver_options_single_thread)
+        .format(s=s, sd=slices_dir, od=slice_outputs_dir, bd=base_options.outputs_dir)
+    for s in scenarios
+}
+slice_args = {
+    # restrict to one thread so we can run many per node
+    s: slice_base_args[s] + solver_options_args(solver_options_single_thread)
+    for s in scenarios
+}
+def write_scenario_list(slices, final=False, solver_options=None):
+    # solve-scenarios takes scenarios from this file in order; solver_options
+    # (if given) replaces the standard single-thread options for this round
+    with open(slice_list_file, 'w') as f:
+        f.writelines(
+            slice_base_args[s]
+            + solver_options_args(solver_options or solver_options_single_thread)
+            + (final_slice_args(s) if final else '') + '\n'
+            for s in slices
         )
-        for s in scenarios
+
+def slice_allocation_dir(slice):
+    return os.path.join(allocation_dir, slice)
+
+def final_slice_args(slice):
+    """Extra arguments used for the final evaluation of each slice, with allocated slack."""
+    return (
+        '--add-cross-time-relaxation-variables '
+        '--fix-cross-time-relaxation-variables '
+        '--cross-time-relaxation-dir {} '
+        '--save-relaxation-bid '
+        .format(pipes.quote(slice_allocation_dir(slice)))
     )
 
+def slice_task_key(slice):
+    """
+    Name used for a slice in the persistent workers' task queue, which may be
+    shared with loops for other base scenarios.
+    """
+    if cmd_line_args.scenario is None:
+        return slice
+    return '{}.{}'.format(cmd_line_args.scenario, slice)
+
+# arguments for `switch solve-scenarios`
+solve_scenarios_args = '--scenario-list {} --scenario-queue {} '.format(
+    pipes.quote(slice_list_file), pipes.quote(slice_queue_dir)
+)
+
+# extra arguments used when solving slices to get bids for the master problem
+bid_args = (
+    '--add-cross-time-relaxation-variables '
+    '--cross-time-relaxation-price-file {pf} '
+    '--save-relaxation-bid '
+    '--no-standard-results --no-save-solution '  # avoid unnecessary disk access
+    '--quiet --no-stream-solver '  # avoid unnecessary log files
+    .format(pf=slice_price_file)
+)
+if cmd_line_args.warm_start_slices:
+    # not used for the final evaluation, which has a different model
+    bid_args += '--warm-start-basis '
+
 if not os.path.exists(dw_dir):
     os.makedirs(dw_dir)
 
@@ -111,7 +510,7 @@ if not os.path.exists(dw_dir):
 
 
 # Note: solve_slices_with_duals() stores relaxation values per slice after each
-# round, and aggregates up from there to write the bid_file for solve_master_model().
+# round, and aggregates up from there to save bids in the bid store for solve_master_model().
 # Then solve_master_model writes generic files for relaxation prices and bid weights.
 # Eventually solve_slices_with_fixed_relaxation uses the bid weights and granular
 # bid data to write slack allocations for each slice.
@@ -120,15 +519,20 @@ def main():
     if not os.path.exists(base_dual_price_file):
         # Solve main model and store initial dual values of constraints
         # (not actually used, but they tell us which constraints are in play)
-        solve_build_model()
+        with trace_phase('build_model'):
+            solve_build_model()
 
     # main loop
     # can be restarted anytime, since state is saved on disk.
     # delete inputs/dw or just inputs/dw/iteration_step.txt to restart from scratch
+    # if the last run stopped while solving the slices, finish that round first
+    resuming = resume_round()
     while True:
         # calculate and store relaxation prices and/or slack allocation for
         # individual slices (uses small Dantzig-Wolfe model for "supply" of slack)
-        if solve_master_model():
+        if resuming:
+            resuming = False
+        elif solve_master_model():
             # returns True when converged
             break
 
@@ -145,6 +549,8 @@ def main():
     # After convergence, find final results
     solve_slices_with_fixed_relaxation()
 
+    stop_worker_pool()
+
 # note: if a particular index of a constraint is set to Constraint.Skip, then
 # Pyomo leaves it out of constraint.items(), so assign_cross_time_relaxation_prices()
 # (below) won't look for a price for it and the post_solve() code (further below)
@@ -164,8 +570,7 @@ def update_iteration_count():
     print("="*80)
     print("Finished iteration {} of cross-time constraint allocation model.".format(cur_count))
     print("="*80)
-    with open(os.path.join(dw_dir, 'iteration_step.txt'), 'w') as f:
-        f.write(str(cur_count + 1))
+    write_file_atomic(os.path.join(dw_dir, 'iteration_step.txt'), str(cur_count + 1))
 
 def get_iteration_count():
     try:
@@ -175,266 +580,1331 @@ def get_iteration_count():
         # no counter file in place
         return 0
 
+def iteration_price_file(iteration):
+    return os.path.join(iteration_price_dir, 'relaxation_prices_{:04d}.tab'.format(iteration))
+
+def save_iteration_prices():
+    """
+    Keep a copy of the prices for the current iteration, which can be used to
+    resume the round if the loop is interrupted, and by slices that start
+    late (with asynchronous iterations).
+    """
+    if not os.path.exists(iteration_price_dir):
+        os.makedirs(iteration_price_dir)
+    with open(slice_price_file) as f:
+        write_file_atomic(iteration_price_file(get_iteration_count()), f.read())
+
+def resume_round():
+    """
+    If the loop was interrupted while solving the slices, restore the prices
+    that were being used and return True, so the round can be finished
+    without re-solving the master problem (which might give different
+    prices). Slices that already finished will be skipped (see slice_done()).
+    """
+    iteration = get_iteration_count()
+    price_file = iteration_price_file(iteration)
+    if not os.path.exists(price_file):
+        return False
+    bid_store = BidStore(bid_store_dir)
+    if iteration in bid_store.rounds() or iteration in bid_store.archived_rounds():
+        # the round was finished (the iteration count is normally updated
+        # right after this, but the loop may have stopped in between)
+        return False
+    print("Resuming iteration {} with prices from {}.".format(iteration, price_file))
+    with open(price_file) as f:
+        write_file_atomic(slice_price_file, f.read())
+    return True
+
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def get_run_id(new=False):
+    """Return the id of the current run of the loop, starting a new run if requested or needed."""
+    if not new and not run_id:
+        try:
+            with open(run_id_file) as f:
+                run_id.append(f.read().strip())
+        except IOError:
+            new = True
+    if new:
+        run_id[:] = [binascii.hexlify(os.urandom(8)).decode('ascii')]
+        write_file_atomic(run_id_file, run_id[0])
+    return run_id[0]
+
+def round_tag(tag):
+    """Return the tag for the relaxation bid marker for a round (iteration number or 'final_<n>')."""
+    return '{}:{}'.format(get_run_id(), tag)
+
+def slice_done(slice, tag, price_hash):
+    """
+    Return True if the slice has already saved a bid in this run for the round
+    identified by tag (iteration number or 'final_<n>'), using prices with the
+    specified hash.
+    """
+    try:
+        with open(os.path.join(slice_outputs_dir, slice, relaxation_bid_done_file)) as f:
+            marker = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return (
+        marker.get('tag') == round_tag(tag) and marker.get('price_hash') == price_hash
+        and os.path.exists(os.path.join(slice_outputs_dir, slice, relaxation_bid_file))
+    )
+
+def unfinished_slices(tag, price_file=None, slices=None):
+    """
+    Return a list of the slices (default is all) that haven't saved a bid for
+    this round yet.
+    """
+    if slices is None:
+        slices = scenarios
+    price_hash = None if price_file is None else file_hash(price_file)
+    unfinished = [s for s in slices if not slice_done(s, tag, price_hash)]
+    if len(unfinished) < len(slices):
+        print("Skipping {} slice(s) that were already solved in this round."
+            .format(len(slices) - len(unfinished)))
+    return unfinished
+
+def slice_cache_key(slice, args, solver_options=None, price_file=None):
+    """
+    Return the key for a slice solution in the slice cache: a hash of the
+    slice's inputs, the build variables it is fixed to (from the base model),
+    the Switch version and code, the local modules and options, the Switch
+    arguments and solver options, and the relaxation prices.
+    """
+    if slice not in slice_input_hashes:
+        if None not in slice_input_hashes:
+            # shared by all slices
+            import switch_model
+            from fix_build_vars import fix_vars
+            slice_input_hashes[None] = cache_key(
+                # only the build variables are read from the base model's
+                # outputs, so other changes there don't invalidate the cache
+                hash_files([
+                    os.path.join(base_options.outputs_dir, v + '.tab') for v in fix_vars
+                ]),
+                hash_files(slice_code_files),
+                getattr(switch_model, '__version__', None),
+                hash_code(os.path.dirname(switch_model.__file__))
+            )
+        slice_input_hashes[slice] = cache_key(
+            slice_input_hashes[None], hash_dir(os.path.join(slices_dir, slice))
+        )
+    return cache_key(
+        slice_input_hashes[slice], args, solver_options,
+        None if price_file is None else file_hash(price_file)
+    )
+
+def write_slice_bid(slice, bid, tag, price_hash=None):
+    """
+    Save a bid from the slice cache in the slice's outputs directory, marked as
+    done for the round identified by tag, as if the slice had just been solved.
+    """
+    outputs_dir = os.path.join(slice_outputs_dir, slice)
+    if not os.path.exists(outputs_dir):
+        os.makedirs(outputs_dir)
+    write_file_atomic(os.path.join(outputs_dir, relaxation_bid_file), ''.join(tsv(row) for row in bid))
+    write_file_atomic(
+        os.path.join(outputs_dir, relaxation_bid_done_file),
+        json.dumps(dict(tag=round_tag(tag), price_hash=price_hash))
+    )
+
+def restore_cached_slices(slices, keys, tag, price_hash=None):
+    """
+    Restore bids for any of the slices that have an entry in the slice cache
+    (keys is a dict with the cache key for each slice) and return a list of
+    the slices that still need to be solved.
+    """
+    if slice_cache is None:
+        return slices
+    remaining = []
+    for s in slices:
+        entry = slice_cache.get(keys[s])
+        if entry is None:
+            remaining.append(s)
+        else:
+            write_slice_bid(s, entry['bid'], tag, price_hash)
+    if len(remaining) < len(slices):
+        print("Reusing cached solutions for {} slice(s).".format(len(slices) - len(remaining)))
+    return remaining
+
+def save_cached_slices(slices, keys):
+    """Save the bids just reported by the slices in the slice cache."""
+    if slice_cache is None:
+        return
+    for s in slices:
+        with open(os.path.join(slice_outputs_dir, s, relaxation_bid_file)) as f:
+            slice_cache.put(keys[s], s, [split_tsv(row) for row in f])
+    slice_cache.trim()
+
+def slice_bid_iteration(slice):
+    """
+    Return the iteration whose prices were used for the slice's latest bid in
+    this run, or None if not known.
+    """
+    try:
+        with open(os.path.join(slice_outputs_dir, slice, relaxation_bid_done_file)) as f:
+            run, iteration = json.load(f).get('tag').rsplit(':', 1)
+        if run != get_run_id():
+            return None
+        return int(iteration)
+    except (IOError, ValueError, TypeError, AttributeError):
+        # no bid yet, from an earlier run or from a final evaluation
+        return None
+
+def reusable_bids(iteration):
+    """
+    Return a list of slices whose prices have changed so little since their
+    latest bid that they don't need to be solved again this round
+    (--reuse-bid-tolerance).
+
+    If a slice's previous solution (cost c_old, slack q_old) is kept at the new
+    prices instead of finding a new one (c_new, q_new), its Lagrangian value is
+    worse by (c_old + p_new.q_old) - (c_new + p_new.q_new). Since the old
+    solution was optimal at the old prices, this is no more than
+    (p_new - p_old).(q_old - q_new). We estimate the size of q_old - q_new for
+    each constraint by the range of slack the slice has reported in all rounds
+    so far.
+    """
+    tolerance = cmd_line_args.reuse_bid_tolerance
+    interval = cmd_line_args.full_refresh_interval
+    if tolerance is None or iteration < interval or iteration % interval == 0:
+        return []
+    bid_store = BidStore(bid_store_dir)
+    # running summary of all rounds, kept up to date by the bid store
+    summary = bid_store.slack_range()
+    if summary is None or bid_store.slices != scenarios:
+        return []
+    slack_range = summary['high'] - summary['low']
+    slice_cost = np.abs(summary['slice_cost'])
+    new_prices = read_relaxation_price_file(iteration_price_file(iteration))
+    # change in each price since each earlier iteration, as a vector
+    price_change = {}
+    reuse = []
+    for i, s in enumerate(scenarios):
+        prev = slice_bid_iteration(s)
+        if prev is None or prev >= iteration or not os.path.exists(iteration_price_file(prev)):
+            continue
+        if prev not in price_change:
+            old_prices = read_relaxation_price_file(iteration_price_file(prev))
+            price_change[prev] = np.array([
+                abs(new_prices.get(k, 0.0) - old_prices.get(k, 0.0)) for k in bid_store.keys
+            ])
+        if price_change[prev].dot(slack_range[i]) <= tolerance * slice_cost[i]:
+            reuse.append(s)
+    if reuse:
+        print("Reusing previous bids for {} of {} slices; their prices barely changed."
+            .format(len(reuse), len(scenarios)))
+    return reuse
+
+def get_slice_clusters():
+    """
+    Return a dict with key=slice and value=representative of its cluster (see
+    slice_clusters.py). The clusters are saved in slice_cluster_file, so they
+    are only calculated again if the slices or --cluster-slices change.
+    """
+    global slice_representatives
+    if slice_representatives is None:
+        n_clusters = cmd_line_args.cluster_slices
+        try:
+            with open(slice_cluster_file) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+        if saved.get('clusters') == n_clusters and sorted(saved.get('representative', {})) == scenarios:
+            slice_representatives = saved['representative']
+        else:
+            print("Grouping {} slices into {} clusters.".format(len(scenarios), n_clusters))
+            slice_representatives = cluster_slices(slices_dir, scenarios, n_clusters)
+            write_file_atomic(slice_cluster_file, json.dumps(
+                dict(clusters=n_clusters, representative=slice_representatives)
+            ))
+    return slice_representatives
+
+def use_clusters():
+    return (
+        cmd_line_args.cluster_slices is not None
+        and cmd_line_args.cluster_slices < len(scenarios)
+    )
+
+def clustering_finished():
+    """Return True if we have switched from clustered rounds to solving all slices."""
+    return use_clusters() and os.path.exists(cluster_state_file)
+
+def price_change(iteration):
+    """
+    Return the total absolute change in the prices since the previous
+    iteration, as a fraction of the total absolute prices in that iteration.
+    """
+    new = read_relaxation_price_file(iteration_price_file(iteration))
+    old = read_relaxation_price_file(iteration_price_file(iteration - 1))
+    total = sum(abs(v) for v in old.values())
+    change = sum(abs(new.get(k, 0.0) - old.get(k, 0.0)) for k in set(new) | set(old))
+    return change / total if total else float('inf')
+
+def clustered_round(iteration):
+    """
+    Return True if only cluster representatives should be solved in this
+    round (--cluster-slices). This stays True until the prices stabilize or
+    --cluster-max-iterations is reached; after that, all slices are solved.
+    """
+    if not use_clusters() or clustering_finished():
+        return False
+    if (
+        iteration >= cmd_line_args.cluster_max_iterations
+        or iteration >= 2 and price_change(iteration) <= cmd_line_args.cluster_price_change
+    ):
+        write_file_atomic(cluster_state_file, json.dumps(dict(all_slices_from=iteration)))
+        print("Solving all slices from iteration {} on, instead of cluster representatives."
+            .format(iteration))
+        return False
+    return True
+
+def cluster_bid_sources(iteration):
+    """
+    For a clustered round, return a dict showing which slice's bid to use for
+    each slice: its own for the cluster representatives and for a few other
+    slices that are solved to check the error (--cluster-check-slices), and
+    the representative's for the rest. Returns None if all slices should be
+    solved in this round.
+    """
+    if not clustered_round(iteration):
+        return None
+    representative = get_slice_clusters()
+    members = [s for s in scenarios if representative[s] != s]
+    n = min(cmd_line_args.cluster_check_slices, len(members))
+    # check different members in each round
+    checked = set(members[(iteration * n + i) % len(members)] for i in range(n))
+    return {
+        s: s if representative[s] == s or s in checked else representative[s]
+        for s in scenarios
+    }
+
+def report_cluster_error(keys, bids, bid_source=None):
+    """
+    Report how much using the representatives' bids changes the average bid,
+    based on the members that were solved in a clustered round (bid_source is
+    the dict from cluster_bid_sources()) or all members in a round where all
+    slices were solved (bid_source is None), and save it in cluster_error_file.
+    """
+    if not use_clusters():
+        return
+    representative = get_slice_clusters()
+    pos = {s: i for i, s in enumerate(scenarios)}
+    pairs = [
+        (pos[s], pos[representative[s]]) for s in scenarios
+        if representative[s] != s and (bid_source is None or bid_source[s] == s)
+    ]
+    weights = get_slice_weights()
+    member_weight = sum(weights[pos[s]] for s in scenarios if representative[s] != s)
+    cost_col = keys.index(('SystemCost',))
+    slack_cols = [i for i, k in enumerate(keys) if i != cost_col]
+    cost_error, slack_error = clustering_error(
+        bids[:, slack_cols], bids[:, cost_col], weights, pairs, member_weight
+    )
+    if cost_error is None:
+        return
+    print(
+        "Clustering {} the average slice cost by about {:.3%} and the slack by {:.3%} "
+        "(based on {} slice(s)).".format(
+            'changes' if bid_source is not None else 'would have changed',
+            cost_error, slack_error, len(pairs)
+        )
+    )
+    append_tsv_row(
+        cluster_error_file,
+        ['iteration', 'clustered', 'checked_slices', 'cost_error', 'slack_error'],
+        [get_iteration_count(), int(bid_source is not None), len(pairs), cost_error, slack_error]
+    )
+
+def trace_phase(name, **fields):
+    """Record time and memory used by a phase of the current iteration (use in a `with` block)."""
+    return tracer.phase(name, iteration=get_iteration_count(), **fields)
+
 def run(cmd):
     # run one instance of the specified command
+    import pyutilib.subprocess  # handy for running scripts with streaming output
     return_code, output = pyutilib.subprocess.run(cmd, tee=True)
     # args = shlex.split(cmd)
     # return_code = subprocess.call(args)
     if return_code:
         raise RuntimeError('Error while running command "{}".'.format(cmd))
 
+def mpirun_cmd():
+    """
+    Return the mpirun command to start slice workers: by default, one per core
+    in the current allocation, or with --node-memory, as many on each node as
+    fit in memory (based on the estimated size of each slice model,
+    calibrated against the trace from earlier runs).
+    """
+    if cmd_line_args.node_memory is None:
+        return 'mpirun '
+    import multiprocessing
+    from slice_memory import MemoryEstimator
+    cores = cmd_line_args.cores_per_node or int(
+        os.environ.get('SLURM_CPUS_ON_NODE', multiprocessing.cpu_count())
+    )
+    nodes = int(os.environ.get('SLURM_JOB_NUM_NODES', 1))
+    estimator = MemoryEstimator(slices_dir, scenarios, trace_file)
+    per_node, worker_mb = estimator.workers_per_node(
+        cmd_line_args.node_memory, cores, nodes,
+        persistent=cmd_line_args.persistent_workers,
+        margin=cmd_line_args.memory_margin
+    )
+    if per_node == 0:
+        raise RuntimeError(
+            "A slice worker is estimated to need {:,.0f} MB (including --memory-margin), "
+            "which does not fit in --node-memory {:,.0f} MB (estimated from {} "
+            "measurement(s)).".format(
+                worker_mb, cmd_line_args.node_memory, estimator.n_measurements
+            )
+        )
+    print(
+        "Running {} slice workers per node on {} node(s), using up to {:,.0f} MB each "
+        "(estimated from {} measurement(s)).".format(
+            per_node, nodes, worker_mb, estimator.n_measurements
+        )
+    )
+    return 'mpirun --map-by ppr:{}:node '.format(per_node)
+
 def mpi_run(cmd):
     # run one instance of `cmd` on each core in the current allocation
-    # (depends on mpi setup)
-    run('mpirun ' + cmd)
+    # (or as many as fit in memory with --node-memory; depends on mpi setup)
+    run(mpirun_cmd() + cmd)
 
 def solve_build_model():
     # solve main optimization model with current settings, and save dual values
     # (model will also automatically save build variables)
-    run('switch solve --save-cross-time-duals')
+    run('switch solve ' + base_scenario_args + '--save-cross-time-duals' + discover_args())
+
+def discover_args():
+    # arguments to find cross-time constraints automatically in the base model
+    # (or presolve model), if requested
+    return ' --discover-cross-time-constraints' if cmd_line_args.discover_cross_time_constraints else ''
+
+def cross_time_keys():
+    """
+    Return a list of the keys of the cross-time constraint rows to relax and
+    price in the slices, from the base model's duals: all rows, or with
+    --relax-binding-only, only the ones with a non-zero dual (or no dual).
+    """
+    duals = read_dual_file(base_dual_price_file)
+    if not cmd_line_args.relax_binding_only:
+        return list(duals)
+    return [
+        k for k, v in duals.items()
+        if v is None or abs(v) > cmd_line_args.binding_dual_tolerance
+    ]
 
 def solve_master_model():
+    global master, stabilizer
     high_prices = {
         # we assign a generic high dual price, since some of these have 0 dual in the
-        # main optimization model (nonbinding)
-        # k: 10*abs(v) for k, v in read_relaxation_price_file(base_dual_price_file).items()
-        k: 100000.0 for k, v in read_relaxation_price_file(base_dual_price_file).items()
+        # main optimization model (nonbinding); see initial_prices() for other options
+        k: 100000.0 for k in cross_time_keys()
     }
     iteration = get_iteration_count()
 
     if iteration == 0:
+        if cmd_line_args.relax_binding_only:
+            print("Relaxing {} of {} cross-time constraint rows (binding in the base model).".format(
+                len(high_prices), len(read_dual_file(base_dual_price_file))
+            ))
         # first round, bids from slice solutions are not available;
-        # just use generic prices
-        write_relaxation_price_file(slice_price_file, high_prices)
+        # use generic prices or estimates (see --initial-prices)
+        write_relaxation_price_file(slice_price_file, initial_prices(high_prices))
+        # start a new run, and clear logs, prices, warm-start bases and
+        # relaxation bid markers from any earlier runs
+        get_run_id(new=True)
+        for f in (
+            [
+                bounds_file, stabilization_log_file, stabilization_state_file,
+                column_age_file, slice_tolerance_file, cluster_state_file,
+                cluster_error_file
+            ]
+            + glob.glob(os.path.join(iteration_price_dir, '*.tab'))
+            + [os.path.join(slice_outputs_dir, s, 'warm_start.bas') for s in scenarios]
+            + [os.path.join(slice_outputs_dir, s, relaxation_bid_done_file) for s in scenarios]
+        ):
+            if os.path.exists(f):
+                os.remove(f)
+        save_iteration_prices()
+        set_slice_tolerance(iteration, None)
         return False
 
-    # read prior bids from slices (stored by solve_slices_with_duals())
-    with open(bid_file) as f:
-        rows = [row.strip('\n').split('\t') for row in f]
-    # each row is formatted like this:
-    # iteration round number, constraint name, index1, ..., indexn, quantity consumed
-    # or iteration round number, SystemCost, (no indexes), cost
-    # bids dict has key=(round, comma-separated constraint name, index1, ..., indexn),
-    # value=slack
-    bids = {}
-    costs = {}
-    for row in rows:
-        round = int(row[0])
-        key = ','.join(row[1:-1])  # convert to comma-separated string
-        val = float(row[-1])
-        if key == 'SystemCost':
-            costs[round] = val
-        else:
-            bids.setdefault(round, {})[key] = val
-
-    dw = ConcreteModel()
-    dw.ROUNDS = Set(initialize=sorted(costs.keys()))
-    dw.CONSTRAINTS = Set(initialize=sorted(bids[0].keys()), ordered=True)
-    dw.slack = Param(dw.ROUNDS, dw.CONSTRAINTS, rule=lambda m, r, c: bids[r][c])
-    dw.system_cost = Param(dw.ROUNDS, initialize=costs)
-    # apply a large cost for any upward slack (should be enough to prohibit it)
-    dw.relaxation_cost = Param(
-        dw.CONSTRAINTS, initialize=lambda m, c: 10 * high_prices[tuple(c.split(','))]
-    )
-    dw.Weight = Var(dw.ROUNDS, within=PercentFraction)
-    dw.Use_Convex_Weights = Constraint(
-        rule=lambda dw: sum(dw.Weight[r] for r in dw.ROUNDS) == 1.0
-    )
-    # choose amount of up and down relaxation to do (we charge for both directions)
-    dw.RelaxUp = Var(dw.CONSTRAINTS, within=NonNegativeReals)
-    dw.RelaxDown = Var(dw.CONSTRAINTS, within=NonNegativeReals)
-    dw.Calculate_Relaxation = Constraint(
-        dw.CONSTRAINTS,
-        rule=lambda dw, c:
-            dw.RelaxUp[c] - dw.RelaxDown[c]
-            == sum(dw.Weight[r] * dw.slack[r, c] for r in dw.ROUNDS)
-    )
-    # charge for system cost and relaxation
-    dw.Objective = Objective(
-        rule=lambda dw:
-            sum(dw.Weight[r] * dw.system_cost[r] for r in dw.ROUNDS)
-            + sum(dw.RelaxUp[c] * dw.relaxation_cost[c] for c in dw.CONSTRAINTS)
-            + sum(dw.RelaxDown[c] * dw.relaxation_cost[c] for c in dw.CONSTRAINTS),
-        sense=minimize
-    )
-    dw.dual = Suffix(direction=Suffix.IMPORT)
-    dw.iis = Suffix(direction=Suffix.IMPORT) # in case of infeasible models
+    bid_store = BidStore(bid_store_dir)
+    replay = master is None
+    if master is None:
+        # first time through since (re)starting (this also imports Pyomo)
+        from dw_master import MasterProblem
+        master = MasterProblem(
+            # apply a large cost for any upward slack (should be enough to prohibit it)
+            relaxation_cost={k: 10 * v for k, v in high_prices.items()},
+            solver=base_options.solver,
+            solver_io=base_options.solver_io,
+            options_string=solver_options_multi_thread,
+            persistent_options_string=cmd_line_args.master_solver_options,
+            dedup_tolerance=cmd_line_args.column_dedup_tolerance
+        )
+        stabilizer = Stabilizer(
+            mode=cmd_line_args.stabilization,
+            alpha=cmd_line_args.stabilization_alpha,
+            step=cmd_line_args.stabilization_step,
+            min_step=cmd_line_args.stabilization_min_step,
+            min_step_fraction=cmd_line_args.stabilization_min_step_fraction,
+            max_step_fraction=cmd_line_args.stabilization_max_step_fraction,
+            state_file=stabilization_state_file
+        )
+
+    # add any new bids from slices (stored by solve_slices_with_duals()); after
+    # (re)starting, this loads all prior rounds. Archived rounds are not added
+    # to the master problem, but still count toward the lower bound.
+    with trace_phase('master_load_bids'):
+        active_rounds = set(bid_store.rounds())
+        for round in sorted(active_rounds | set(bid_store.archived_rounds())):
+            if round in loaded_rounds:
+                continue
+            loaded_rounds.add(round)
+            data = bid_store.load_round(round)
+            if data.get('clustered', False):
+                clustered_rounds.add(round)
+            if round in active_rounds:
+                slack = dict(zip(bid_store.keys, data['slack'].tolist()))
+                if not master.add_round(round, float(data['cost']), slack):
+                    print("Round {} duplicates an earlier round; archiving it.".format(round))
+                    bid_store.archive_round(round)
+            if 'prices' in data:
+                prices = dict(zip(bid_store.keys, data['prices'].tolist()))
+                # slices in standard rounds are solved to the MIP gap in options.txt
+                value = lagrangian_value(data, base_slice_mipgap)
+                if not data.get('time_limited', False):
+                    # slices may not have reached their MIP gap otherwise
+                    lagrangian_values[round] = value
+                stabilizer.add_round(round, value, prices, replay=replay)
+        if clustering_finished():
+            # rounds with clustered slices are only approximate, so they are
+            # not used once there are rounds with all the slices
+            stale = [r for r in master.rounds if r in clustered_rounds]
+            if stale:
+                master.remove_rounds(stale)
+                for r in stale:
+                    bid_store.archive_round(r)
+                print("Archived {} round(s) that used clustered slices.".format(len(stale)))
+    if replay and os.path.exists(column_age_file):
+        with open(column_age_file) as f:
+            ages = json.load(f)
+        master.zero_weight_age.update(
+            (int(r), a) for r, a in ages.items() if int(r) in master.bids
+        )
 
-    solve_pyomo_model(dw)
+    # restrict master duals to the neighborhood of the best prices so far, if needed
+    master.set_price_bounds(*stabilizer.price_bounds(
+        master.relaxation_cost.keys(), master.relaxation_cost
+    ))
+    with trace_phase('master_solve', rounds=len(master.rounds)):
+        master.solve()
+    stabilizer.predicted_value = master.objective_value()
 
-    # create dictionary of current dual values for relaxed constraints
-    duals = {
-        tuple(idx.split(',')): dw.dual[obj]
-        for idx, obj in dw.Calculate_Relaxation.iteritems()
-    }
+    # create dictionary of current dual values for relaxed constraints,
+    # with smoothing if needed
+    duals = stabilizer.smooth(master.prices())
 
     write_relaxation_price_file(slice_price_file, duals)
+    save_iteration_prices()
 
     with open(os.path.join(
         dw_dir, 'expected_slack_{}.txt'.format(iteration)
     ), 'w') as f:
         f.writelines(
-            '{}: {}\n'.format(c, value(dw.RelaxUp[c] - dw.RelaxDown[c]))
-            for c in dw.CONSTRAINTS
+            '{}: {}\n'.format(','.join(c), v)
+            for c, v in sorted(master.relaxation().items())
         )
 
-    # With these sharp prices for relaxation in either direction, this should
-    # converge with minimal slack, so we use that as our convergence test.
-    abs_slack = sum(value(dw.RelaxUp[c] + dw.RelaxDown[c]) for c in dw.CONSTRAINTS)
-    if abs_slack < 100:
-        # for some reason the battery slack never converges to 0 (maybe because
-        # it's nonbinding or max_relax * cost is within the solver's optimization gap?).
+    abs_slack = master.abs_relaxation()
+    log_stabilization(iteration, abs_slack)
+
+    # The master solution's cost is an upper bound on the optimal cost and the
+    # best Lagrangian value is a lower bound (see dw_bounds.py).
+    upper_bound = master.penalized_value()
+    lower_bound = max(lagrangian_values.values()) if lagrangian_values else None
+    gap = relative_gap(upper_bound, lower_bound)
+    log_bounds(iteration, upper_bound, lower_bound, gap, abs_slack)
+
+    # the gap alone isn't enough: the master may still be using penalized slack
+    # that hasn't been allocated to any slice
+    if (
+        gap is not None and gap <= cmd_line_args.gap_tolerance
+        and abs_slack < cmd_line_args.slack_tolerance
+    ):
         converged = True
-        bid_weights = {round: value(weight) for round, weight in dw.Weight.items()}
-        allocate_slack_to_slices(bid_weights)
+        print(
+            "Converged after {} iterations; gap={:.4%}, unallocated cross-time slack={:,.0f}."
+            .format(iteration, gap, abs_slack)
+        )
+        bid_weights = master.weights()
+        with trace_phase('slack_allocation'):
+            allocate_slack_to_slices(bid_weights)
     else:
+        prune_master_columns(bid_store)
+        set_slice_tolerance(iteration, gap)
         converged = False
         print(
-            "Not converged after {} iterations; unallocated cross-time slack={:,.0f}."
-            .format(iteration, abs_slack)
+            "Not converged after {} iterations; gap={}, unallocated cross-time slack={:,.0f}."
+            .format(iteration, 'unknown' if gap is None else '{:.4%}'.format(gap), abs_slack)
         )
 
     return converged
 
+def prune_master_columns(bid_store):
+    """
+    Remove rounds from the master problem if they have had zero weight for too
+    long or there are too many of them, and move them to the bid archive.
+    """
+    pruned = master.prune(
+        max_zero_weight_age=cmd_line_args.column_max_age,
+        max_rounds=cmd_line_args.max_columns
+    )
+    for round in pruned:
+        bid_store.archive_round(round)
+    if pruned:
+        print("Archived {} round(s) from the master problem; {} remain active."
+            .format(len(pruned), len(master.rounds)))
+    with atomic_open(column_age_file) as f:
+        json.dump({str(r): a for r, a in master.zero_weight_age.items()}, f)
+
+def log_bounds(iteration, upper_bound, lower_bound, gap, abs_slack):
+    """Append the current bounds on total cost to the bounds file."""
+    latest = lagrangian_values[max(lagrangian_values)] if lagrangian_values else None
+    append_tsv_row(
+        bounds_file,
+        [
+            'iteration', 'latest_lagrangian_value', 'lower_bound', 'upper_bound',
+            'relative_gap', 'abs_slack'
+        ],
+        [
+            iteration,
+            '' if latest is None else latest,
+            '' if lower_bound is None else lower_bound,
+            upper_bound,
+            '' if gap is None else gap,
+            abs_slack
+        ]
+    )
+
+def choose_slice_tolerance(gap, previous_time_limit):
+    """
+    Return (mipgap, time limit) to use for the slices in the next round, or
+    (None, None) to solve them with the standard solver options. gap is the
+    current relative gap between the upper and lower bounds (None if there's
+    no lower bound yet) and previous_time_limit is the time limit used in the
+    previous round.
+    """
+    if cmd_line_args.slice_mipgap_max is None:
+        return None, None
+    if gap is None:
+        # use the loosest gap, but no time limit, so this round gives a bound
+        return cmd_line_args.slice_mipgap_max, None
+    mipgap = min(cmd_line_args.slice_mipgap_max, cmd_line_args.slice_gap_fraction * gap)
+    if mipgap <= base_slice_mipgap:
+        return None, None
+    # only limit the time if the previous round gave a lower bound, so the
+    # bound keeps improving
+    time_limit = cmd_line_args.slice_time_limit if previous_time_limit is None else None
+    return mipgap, time_limit
+
+def read_slice_tolerances():
+    if os.path.exists(slice_tolerance_file):
+        with open(slice_tolerance_file) as f:
+            return json.load(f)
+    return {}
+
+def set_slice_tolerance(iteration, gap):
+    """Choose and save the MIP gap and time limit for the slices in this iteration."""
+    tolerances = read_slice_tolerances()
+    previous = tolerances.get(str(iteration - 1), {}).get('time_limit')
+    mipgap, time_limit = choose_slice_tolerance(gap, previous)
+    if mipgap is not None:
+        print("Solving slices to a MIP gap of {:.4%}{} in iteration {}.".format(
+            mipgap, '' if time_limit is None else ' or {}s'.format(time_limit), iteration
+        ))
+    tolerances[str(iteration)] = dict(mipgap=mipgap, time_limit=time_limit)
+    write_file_atomic(slice_tolerance_file, json.dumps(tolerances))
+
+def get_slice_tolerance(iteration):
+    """Return the (mipgap, time limit) chosen for the slices in this iteration."""
+    t = read_slice_tolerances().get(str(iteration), {})
+    return t.get('mipgap'), t.get('time_limit')
+
+def slice_solver_options(iteration):
+    """
+    Return the solver options string for the slices in this iteration, or None
+    to use the standard one from slice_args.
+    """
+    mipgap, time_limit = get_slice_tolerance(iteration)
+    if mipgap is None:
+        return None
+    # later settings override the earlier ones
+    options = solver_options_single_thread + ' mipgap={}'.format(mipgap)
+    if time_limit is not None:
+        options += ' time={}'.format(time_limit)
+    return options
+
+def log_stabilization(iteration, abs_slack):
+    """
+    Record the unallocated slack after this iteration, how much it has shrunk
+    since the last one, and the state of the price stabilization.
+    """
+    prev_slack = None
+    if os.path.exists(stabilization_log_file):
+        with open(stabilization_log_file) as f:
+            rows = [split_tsv(r) for r in f][1:]
+        if rows:
+            prev_slack = float(rows[-1][2])
+    reduction = '' if prev_slack is None else prev_slack - abs_slack
+    append_tsv_row(
+        stabilization_log_file,
+        [
+            'iteration', 'mode', 'abs_slack', 'slack_reduction',
+            'center_round', 'center_value', 'step'
+        ],
+        [
+            iteration, stabilizer.mode, abs_slack, reduction,
+            stabilizer.center_round, stabilizer.center_value, stabilizer.step
+        ]
+    )
+    if prev_slack is not None:
+        print(
+            "Unallocated cross-time slack changed by {:,.0f} ({:.1%}) in iteration {} "
+            "({} stabilization)."
+            .format(
+                -reduction, -reduction / prev_slack if prev_slack else 0.0,
+                iteration, stabilizer.mode
+            )
+        )
+
 def allocate_slack_to_slices(bid_weights):
     """
     Calculate and store the allowed slack for all relaxation variables in all
     slices, using the supplied bid weights. Allowed values are stored in
-    variable.tab files in the inputs directory for each slice model.
-    """
-    # allowed dict has key=(slice, var), val=var subdict
-    # var subdict has key=idx, value=allowed slack
-    allowed = dict()
-    with open(slice_bid_file) as f:
-        for row in f:
-            items = split_tsv(row)
-            iteration = int(items[0])
-            slice = items[1]
-            var = items[2]
-            idx = items[3:-1]
-            val = float(items[-1])
-            var_dict = allowed.setdefault((slice, var), {})
-            var_dict[idx] = var_dict.get(idx, 0.0) + bid_weights[iteration] * val
-    for (slice, var), var_dict in allowed.items():
-        relax_var = 'Relax_' + var # ugh, but too hard to use relax_var_name() here
-        with open(os.path.join(slices_dir, slice, relax_var + '.tab'), 'w') as f:
+    variable.tab files in the allocation directory for each slice model
+    (normally its inputs directory).
+    """
+    bid_store = BidStore(bid_store_dir)
+    allowed = bid_store.weighted_slice_slack(bid_weights)
+    # group constraint keys (columns) by constraint name
+    var_cols = {}
+    for col, key in enumerate(bid_store.keys):
+        var_cols.setdefault(key[0], []).append(col)
+    for row, slice in enumerate(bid_store.slices):
+        if not os.path.exists(slice_allocation_dir(slice)):
+            os.makedirs(slice_allocation_dir(slice))
+        # remove allocations for constraints that are no longer relaxed (e.g.,
+        # from an earlier run), since the slice model reads all of them
+        for file in glob.glob(os.path.join(slice_allocation_dir(slice), 'Relax_*.tab')):
+            if os.path.basename(file)[len('Relax_'):-len('.tab')] not in var_cols:
+                os.remove(file)
+        for var, cols in var_cols.items():
+            relax_var = 'Relax_' + var # ugh, but too hard to use relax_var_name() here
             headers = (
-                ['INDEX_'+str(i) for i in range(1, len(var_dict.keys()[0]))]
+                ['INDEX_'+str(i) for i in range(1, len(bid_store.keys[cols[0]]))]
                 + [relax_var]
             )
-            f.write(tsv(headers))
-            f.writelines(tsv(k + (v,)) for k, v in sorted(var_dict.items()))
-
-# helper functions to parse rows separated with tabs and terminated with newlines
-# TODO: replace similar code with these in various places...
-def tsv(vals):
-    return '\t'.join(map(str, vals)) + '\n'
-def split_tsv(row):
-    """Return a tuple of all items in tab-separated, newline-terminated row."""
-    return tuple(row.strip('\n').split('\t'))
-
-def solve_pyomo_model(dw):
-    # Setup solver identically to Switch; we could use different settings,
-    # but this is an easy way to get workable ones.
-    solver = SolverFactory(m.options.solver, solver_io=m.options.solver_io)
-
-    print("Solving pyomo model...")
-    results = solver.solve(dw, options_string=solver_options_multi_thread)
-    dw.solutions.load_from(results)
+            write_file_atomic(
+                os.path.join(slice_allocation_dir(slice), relax_var + '.tab'),
+                tsv(headers) + ''.join(
+                    tsv(bid_store.keys[c][1:] + (allowed[row, c],)) for c in sorted(
+                        cols, key=lambda c: bid_store.keys[c]
+                    )
+                )
+            )
 
-    if (
-        results.solver.status in {SolverStatus.ok, SolverStatus.warning} and
-        results.solver.termination_condition == TerminationCondition.optimal
-    ):
-        return
-    elif (results.solver.termination_condition == TerminationCondition.infeasible):
-        if hasattr(model, "iis"):
-            print "Model was infeasible; irreducibly inconsistent set (IIS) returned by solver:"
-            print "\n".join(c.name for c in model.iis)
-        else:
-            print "Model was infeasible; if the solver can generate an irreducibly inconsistent set (IIS),"
-            print "more information may be available by setting the appropriate flags in the "
-            print 'solver_options_string and calling this script with "--suffixes iis".'
-        raise RuntimeError("Infeasible model")
+def append_tsv_row(file, headers, row):
+    """Add a row to a log file (creating it with headers if needed), atomically."""
+    if os.path.exists(file):
+        with open(file) as f:
+            data = f.read()
     else:
-        print "Solver terminated abnormally."
-        print "  Solver Status: ", results.solver.status
-        print "  Termination Condition: ", results.solver.termination_condition
-        if model.options.solver == 'glpk' and results.solver.termination_condition == TerminationCondition.other:
-            print "Hint: glpk has been known to classify infeasible problems as 'other'."
-        raise RuntimeError("Solver failed to find an optimal solution.")
-
+        data = tsv(headers)
+    write_file_atomic(file, data + tsv(row))
 
 def read_relaxation_price_file(file):
     with open(file) as f:
         rows = tuple(r.strip().split('\t') for r in f)
     return {tuple(r[:-1]): float(r[-1]) for r in rows}
 
+def read_dual_file(file):
+    """
+    Read a cross_time_duals.tab file. Returns a dict with key=constraint key
+    and value=dual value, or None if the solver didn't report one.
+    """
+    duals = {}
+    with open(file) as f:
+        for r in f:
+            row = r.rstrip('\n').split('\t')
+            try:
+                duals[tuple(row[:-1])] = float(row[-1])
+            except ValueError:
+                # written as None
+                duals[tuple(row[:-1])] = None
+    return duals
+
+def solve_presolve_model():
+    # solve a smaller version of the base model (--presolve-inputs-dir) to
+    # get duals for the cross-time constraints
+    run(
+        'switch solve ' + base_scenario_args
+        + '--inputs-dir {} --outputs-dir {} --save-cross-time-duals'.format(
+            pipes.quote(cmd_line_args.presolve_inputs_dir), pipes.quote(presolve_outputs_dir)
+        )
+        + discover_args()
+    )
+
+def initial_prices(high_prices):
+    """
+    Return relaxation prices for the first round, for the constraints in
+    high_prices (see --initial-prices). Duals are converted to prices with
+    --initial-price-scale and --initial-price-floor; constraints with no
+    information from the chosen source get the base model's dual, or if it
+    has none, the high price.
+    """
+    mode = cmd_line_args.initial_prices
+    prices = dict(high_prices)
+    if mode == 'flat':
+        return prices
+
+    def dual_prices(duals):
+        return {
+            # keep the sign of the dual, which depends on the direction of the constraint
+            k: math.copysign(
+                max(abs(v) * cmd_line_args.initial_price_scale, cmd_line_args.initial_price_floor),
+                v
+            )
+            for k, v in duals.items()
+            if k in prices and v is not None
+        }
+
+    sources = {k: 'high price' for k in prices}
+    new = dual_prices(read_dual_file(base_dual_price_file))
+    prices.update(new)
+    sources.update((k, 'base model duals') for k in new)
+    if mode == 'file':
+        file = cmd_line_args.initial_price_file
+        if os.path.isdir(file):
+            file = os.path.join(file, os.path.basename(slice_price_file))
+        new = {k: v for k, v in read_relaxation_price_file(file).items() if k in prices}
+        prices.update(new)
+        sources.update((k, file) for k in new)
+    elif mode == 'presolve':
+        with trace_phase('presolve'):
+            solve_presolve_model()
+        new = dual_prices(read_dual_file(os.path.join(presolve_outputs_dir, 'cross_time_duals.tab')))
+        prices.update(new)
+        sources.update((k, 'presolve duals') for k in new)
+    counts = {}
+    for src in sources.values():
+        counts[src] = counts.get(src, 0) + 1
+    print("Initial prices: " + ', '.join(
+        '{} from {}'.format(n, src) for src, n in sorted(counts.items())
+    ) + '.')
+    return prices
+
 def write_relaxation_price_file(file, duals):
-    with open(file, 'w') as f:
-        for key, value in duals.items():
-            row = key + (str(value),)
-            f.write('\t'.join(row) + '\n')
+    write_file_atomic(file, ''.join(
+        '\t'.join(key + (str(value),)) + '\n' for key, value in duals.items()
+    ))
 
 def solve_slices_with_duals():
     """
     Solve slice models using previously saved relaxation prices.
     Then calculate average cost and slack values across all the slices and store
-    in the bid_file.
+    in the bid store.
     """
     # solve all the slices, using relaxation prices
     # note: this will save relaxation values for each slice in standard
     # outputs/nnn/VarName.tab files.
-    if os.path.exists('scenario_queue'):
-        shutil.rmtree('scenario_queue')
-    mpi_run(
-        'switch solve-scenarios '
-        '--add-cross-time-relaxation-variables '
-        '--cross-time-relaxation-price-file {dd}/relaxation_prices.tab '
-        '--save-relaxation-bid '
-        '--no-standard-results --no-save-solution '  # avoid unnecessary disk access
-        '--quiet --no-stream-solver '  # avoid unnecessary log files
-        .format(dd=dw_dir)
+    if cmd_line_args.persistent_workers:
+        # workers send back their bids directly
+        solve_slices_with_worker_pool()
+    else:
+        # the queue only shows which slices have been started, so it is reset
+        # for each round; slices that finished before an interruption are
+        # left out of the list instead
+        if os.path.exists(slice_queue_dir):
+            shutil.rmtree(slice_queue_dir)
+        iteration = get_iteration_count()
+        solver_options = slice_solver_options(iteration)
+        # with --cluster-slices, early rounds only solve some of the slices
+        bid_source = cluster_bid_sources(iteration)
+        if bid_source is None:
+            slices = unfinished_slices(iteration, slice_price_file)
+            reused = set(reusable_bids(iteration))
+            slices = [s for s in slices if s not in reused]
+        else:
+            slices = unfinished_slices(iteration, slice_price_file, sorted(set(bid_source.values())))
+            reused = set()
+        cache_keys = {} if slice_cache is None else {
+            s: slice_cache_key(s, slice_args[s] + bid_args, solver_options, slice_price_file)
+            for s in slices
+        }
+        slices = restore_cached_slices(slices, cache_keys, iteration, file_hash(slice_price_file))
+        if slices:
+            # start the slowest slices first, so they don't hold up the end of the round
+            write_scenario_list(
+                get_slice_times().longest_first(slices), solver_options=solver_options
+            )
+            with trace_phase('slices', slices=len(slices)):
+                mpi_run(
+                    'switch solve-scenarios ' + solve_scenarios_args + bid_args
+                    + '--relaxation-bid-tag {} '.format(round_tag(iteration))
+                )
+            record_slice_traces(slices)
+            save_cached_slices(slices, cache_keys)
+        # save average values from the slack variable .tab files
+        with trace_phase('bid_aggregation'):
+            calculate_average_cost_and_slack(reused=bool(reused), bid_source=bid_source)
+
+def get_slice_times():
+    global slice_times
+    if slice_times is None:
+        slice_times = SliceTimes(slice_times_file)
+    return slice_times
+
+def record_slice_traces(slices, schedule=True):
+    """
+    Save the time and memory used by each slice, as reported in its outputs
+    directory (see allocate_period_constraints.py).
+    """
+    for s in slices:
+        with open(os.path.join(slice_outputs_dir, s, 'slice_trace.json')) as f:
+            record_slice_trace(get_iteration_count(), s, json.load(f), schedule=schedule)
+
+def record_slice_trace(iteration, slice, trace, rank=None, schedule=True):
+    """
+    Add the time and memory used by each phase of a slice solution to the
+    trace file and (if schedule is True) the build and solve times to the
+    slice time history used for scheduling.
+    """
+    phases = trace['phases']
+    for phase, usage in sorted(phases.items()):
+        tracer.record(
+            phase=phase, iteration=iteration, slice=slice, host=trace['host'],
+            rank=rank, **usage
+        )
+    if schedule:
+        get_slice_times().record(
+            iteration, slice, trace['host'], rank,
+            phases['slice_build']['wall'], phases['slice_solve']['wall']
+        )
+
+def assign_slices_to_workers():
+    """
+    Return a dict showing which persistent worker (MPI rank) should solve each
+    slice in this round, based on past build and solve times.
+    """
+    workers = work_queue.registered_workers()
+    if not workers:
+        # workers haven't started yet; they will share out the slices by
+        # position in the list, modulo the number of workers
+        return {s: i for i, s in enumerate(scenarios)}
+    size = list(workers.values())[0]['size']
+    ranks = {r: None for r in range(size)}
+    ranks.update({w['rank']: w['host'] for w in workers.values()})
+    owners, expected_time = get_slice_times().assign_ranks(scenarios, ranks)
+    print("Assigned slices to {} workers; expected time for this round is {:,.0f}s."
+        .format(size, expected_time))
+    return owners
+
+def solve_slices_with_worker_pool():
+    """
+    Solve slices with the current relaxation prices, using persistent workers
+    that keep their models in memory between iterations, and save the bids in
+    the bid store.
+
+    Normally this waits for all the slices to finish. With --async-fraction,
+    it only waits until that fraction of the slices have sent new bids, then
+    saves a round made of the latest bid from every slice. Slices that are
+    still solving finish with the older prices and are included in a later
+    round, and idle workers pick up slices with the new prices as soon as the
+    master problem has been solved again. Rounds with a mix of prices don't
+    give a Lagrangian bound, so in the first iteration and every
+    --async-sync-interval iterations, we wait for all slices to be solved with
+    the current prices.
+    """
+    start_worker_pool()
+    iteration = get_iteration_count()
+    # tasks use the copy of the prices for this iteration, since
+    # slice_price_file may be replaced before they start (asynchronous mode)
+    price_file = iteration_price_file(iteration)
+
+    # after an interruption, use the bids from slices that already finished
+    price_hash = file_hash(price_file)
+    for s in scenarios:
+        if s not in slice_tasks and s not in slice_bids and slice_done(s, iteration, price_hash):
+            with open(os.path.join(slice_outputs_dir, s, relaxation_bid_file)) as f:
+                slice_bids[s] = (iteration, [split_tsv(row) for row in f])
+
+    # with --cluster-slices, early rounds only solve some of the slices
+    bid_source = cluster_bid_sources(iteration)
+    round_slices = scenarios if bid_source is None else sorted(set(bid_source.values()))
+
+    # reuse solutions from the slice cache, if possible
+    if slice_cache is not None:
+        for s in round_slices:
+            if s in slice_tasks or (s in slice_bids and slice_bids[s][0] == iteration):
+                continue
+            entry = slice_cache.get(slice_cache_key(
+                s, slice_args[s] + bid_args, slice_solver_options(iteration), price_file
+            ))
+            if entry is not None:
+                write_slice_bid(s, entry['bid'], iteration, price_hash)
+                slice_bids[s] = (iteration, entry['bid'])
+                print("Reusing cached solution for slice {}.".format(s))
+
+    sync = (
+        bid_source is not None
+        or cmd_line_args.async_fraction is None
+        or iteration % cmd_line_args.async_sync_interval == 0
+        or len(slice_bids) < len(scenarios)
+    )
+    # slices that keep their bid from an earlier iteration
+    reused = set()
+    if sync:
+        needed = len(round_slices)
+        for s in (reusable_bids(iteration) if bid_source is None else []):
+            if s in slice_tasks:
+                continue
+            if s not in slice_bids:
+                # after a restart
+                with open(os.path.join(slice_outputs_dir, s, relaxation_bid_file)) as f:
+                    slice_bids[s] = (slice_bid_iteration(s), [split_tsv(row) for row in f])
+            reused.add(s)
+    else:
+        needed = int(math.ceil(cmd_line_args.async_fraction * len(scenarios)))
+
+    # task ids start with the rank of the worker that should take them
+    owners = assign_slices_to_workers()
+
+    def queue_slices(slices):
+        tasks = []
+        for s in slices:
+            if (
+                s in slice_tasks
+                and work_queue.withdraw_task(slice_tasks[s]['id'])
+            ):
+                # no worker has started this one yet; send the latest prices instead
+                del slice_tasks[s]
+            if s not in slice_tasks:
+                task = dict(
+                    id='{:04d}_{}'.format(owners[s], slice_task_key(s)),
+                    slice=slice_task_key(s), iteration=iteration, tag=round_tag(iteration),
+                    args=slice_args[s] + bid_args, price_file=price_file,
+                    # given separately, so workers don't rebuild the model when it changes
+                    solver_options_string=slice_solver_options(iteration)
+                )
+                if slice_cache is not None:
+                    task['cache_key'] = slice_cache_key(
+                        s, task['args'], task['solver_options_string'], price_file
+                    )
+                tasks.append(task)
+                slice_tasks[s] = task
+        work_queue.add_tasks(tasks)
+
+    finished = [
+        s for s in round_slices
+        if s in reused or (s in slice_bids and slice_bids[s][0] == iteration)
+    ]
+    queue_slices([s for s in round_slices if s not in finished])
+    received = len(finished)
+    with trace_phase('slices', slices=len(round_slices) - len(finished)):
+        while True:
+            task_slices = {t['id']: s for s, t in slice_tasks.items()}
+            for task_id, result in work_queue.finished_tasks().items():
+                if task_id not in task_slices:
+                    # task for another base scenario (shared queue)
+                    continue
+                s = task_slices[task_id]
+                if 'error' in result:
+                    print("Error solving task {} on worker {}:\n{}".format(
+                        task_id, result['worker'], result['error']
+                    ))
+                    raise RuntimeError(
+                        'Unable to solve slice {} in iteration {}.'.format(s, result['iteration'])
+                    )
+                work_queue.remove_result(task_id)
+                task = slice_tasks.pop(s)
+                if 'cache_key' in task:
+                    slice_cache.put(task['cache_key'], s, result['bid'])
+                slice_bids[s] = (result['iteration'], result['bid'])
+                record_slice_trace(result['iteration'], s, result['trace'], rank=result['rank'])
+                if sync and result['iteration'] != iteration:
+                    # finished with older prices; try again with the current ones
+                    queue_slices([s])
+                else:
+                    received += 1
+            if received >= needed:
+                break
+            check_worker_pool()
+            time.sleep(1.0)
+    if slice_cache is not None:
+        slice_cache.trim()
+
+    with trace_phase('bid_aggregation'):
+        # save a round made of the latest bid from each slice; these are only a
+        # valid basis for a Lagrangian bound if they all used the current prices
+        source = bid_source or {s: s for s in scenarios}
+        keys, bids = stack_relaxation_bids([
+            (
+                tuple('\t'.join(row[:-1]) for row in slice_bids[source[s]][1]),
+                tuple(row[-1] for row in slice_bids[source[s]][1])
+            )
+            for s in scenarios
+        ])
+        if bid_source is not None:
+            # clustered round; not a basis for a Lagrangian bound
+            prices = None
+        elif all(slice_bids[s][0] == iteration for s in scenarios):
+            prices = read_relaxation_price_file(price_file)
+        else:
+            prices = None
+            print(
+                "Saving bids from {} slices with prices from iterations {}-{}."
+                .format(len(scenarios), min(v[0] for v in slice_bids.values()), iteration)
+            )
+        save_relaxation_bids(keys, bids, prices, bid_source=bid_source)
+
+def solve_final_slices_with_worker_pool(slices, tag):
+    """
+    Solve the final models for the specified slices (with the allocated slack)
+    on the persistent workers, and wait for all of them to finish.
+    """
+    start_worker_pool()
+    # slices still being solved for an asynchronous round write to the same
+    # outputs directories, so let them finish first
+    for s, task in list(slice_tasks.items()):
+        if work_queue.withdraw_task(task['id']):
+            del slice_tasks[s]
+    task_ids = [task['id'] for task in slice_tasks.values()]
+    work_queue.wait_for_tasks(task_ids, check=check_worker_pool)
+    for task_id in task_ids:
+        work_queue.remove_result(task_id)
+    slice_tasks.clear()
+
+    # spread the final models across the workers, longest first
+    tasks = {
+        s: dict(
+            id='{:04d}_{}'.format(i, slice_task_key(s)),
+            slice=slice_task_key(s), iteration=get_iteration_count(),
+            tag=round_tag(tag), final=True,
+            args=slice_args[s] + final_slice_args(s),
+            outputs_dir=os.path.join(slice_outputs_dir, s)
+        )
+        for i, s in enumerate(get_slice_times().longest_first(slices))
+    }
+    work_queue.add_tasks(list(tasks.values()))
+    results = work_queue.wait_for_tasks(
+        [task['id'] for task in tasks.values()], check=check_worker_pool
     )
-    # save average values from the slack variable .tab files
-    calculate_average_cost_and_slack()
+    for s, task in sorted(tasks.items()):
+        result = results[task['id']]
+        if 'error' in result:
+            print("Error solving task {} on worker {}:\n{}".format(
+                task['id'], result['worker'], result['error']
+            ))
+            raise RuntimeError('Unable to solve final model for slice {}.'.format(s))
+        work_queue.remove_result(task['id'])
+        # these models differ from the ones solved during the loop, so their
+        # times are not used for scheduling
+        record_slice_trace(
+            result['iteration'], s, result['trace'], rank=result['rank'], schedule=False
+        )
+
+def start_worker_pool():
+    # launch one worker on each core in the current allocation (or the number
+    # of local processes given by --local-workers), if not already running, or
+    # join the shared pool given by --worker-queue-dir
+    global work_queue, worker_pool, worker_pool_joined
+    if worker_pool_joined:
+        return
+    worker_pool_joined = True
+    # forget any tasks from before a restart
+    slice_tasks.clear()
+    if cmd_line_args.worker_queue_dir is not None:
+        work_queue = task_queue.TaskQueue(worker_queue_dir)
+        # other loops are using the queue too, so only clear out our own tasks
+        keys = set(slice_task_key(s) for s in scenarios)
+        for task_id in work_queue.waiting_tasks():
+            if task_id.split('_', 1)[1] in keys:
+                work_queue.withdraw_task(task_id)
+        for task_id in work_queue.finished_tasks():
+            if task_id.split('_', 1)[1] in keys:
+                work_queue.remove_result(task_id)
+        print("Using shared slice workers with task queue {}.".format(worker_queue_dir))
+        return
+    if cmd_line_args.coordinator:
+        # hand out tasks from this process (see coordinator.py)
+        from coordinator import Coordinator
+        work_queue = Coordinator(
+            coordinator_key_file,
+            host='localhost' if cmd_line_args.local_workers else None
+        )
+        worker_args = '--coordinator {} --authkey-file {}'.format(
+            work_queue.address, pipes.quote(coordinator_key_file)
+        )
+    else:
+        work_queue = task_queue.TaskQueue(worker_queue_dir)
+        worker_args = '--queue-dir {}'.format(pipes.quote(worker_queue_dir))
+    work_queue.init_queue()
+    if cmd_line_args.async_fraction is not None:
+        # let idle workers take over slices that are waiting for busy ones
+        worker_args += ' --steal-tasks'
+    if cmd_line_args.local_workers:
+        worker_pool = [
+            subprocess.Popen(
+                'python slice_worker.py {} --rank {} --size {}'
+                .format(worker_args, rank, cmd_line_args.local_workers),
+                shell=True
+            )
+            for rank in range(cmd_line_args.local_workers)
+        ]
+        print("Started {} local slice workers.".format(len(worker_pool)))
+    else:
+        cmd = mpirun_cmd() + 'python slice_worker.py ' + worker_args
+        print("Starting slice workers: {}".format(cmd))
+        worker_pool = [subprocess.Popen(cmd, shell=True)]
+
+def check_worker_pool():
+    for proc in worker_pool or []:
+        if proc.poll() is not None:
+            raise RuntimeError(
+                'Slice workers exited unexpectedly with code {}.'.format(proc.returncode)
+            )
+    if cmd_line_args.worker_queue_dir is not None and work_queue.stop_requested():
+        raise RuntimeError('The shared slice workers have been stopped.')
+
+def stop_worker_pool():
+    # stop the workers if this script started them (a shared pool is left running)
+    global worker_pool, worker_pool_joined
+    if worker_pool is not None:
+        work_queue.request_stop()
+        for proc in worker_pool:
+            proc.wait()
+        worker_pool = None
+        if cmd_line_args.coordinator:
+            work_queue.close()
+    worker_pool_joined = False
 
-def calculate_average_cost_and_slack():
+def calculate_average_cost_and_slack(final=False, reused=False, bid_source=None):
     """
     Calculate average bid (slack usage and cost) for all recently solved slices.
-    Save bids for individual slices in slice_bid_file and weighted average bid
-    in bid_file.
+    Save bids for individual slices and weighted average bid in the bid store.
+    If final is True, the bids are saved separately from the rounds used by
+    the master problem. If reused is True, some bids are from earlier
+    iterations (see reusable_bids()). For clustered rounds, bid_source shows
+    which slice's bid to use for each slice (see cluster_bid_sources()).
     """
-    slice_slack = []
-    total_slack = dict()
-    total_days = 0
-    for s in scenarios:
-        with open(os.path.join(slices_dir, s, 'timeseries.tab')) as f:
-            day_count = len(f.readlines()) - 1
-        total_days += day_count
-        with open(os.path.join('outputs', s, relaxation_bid_file)) as f:
-            for row in f:
-                items = row.strip('\n').split('\t')
-                key = tuple(items[:-1])  # constraint name, idx values
-                slack = float(items[-1])
-                slice_slack.append((s,) + key + (slack,))
-                total_slack.setdefault(key, 0)
-                total_slack[key] += day_count * slack
-
-    averages = sorted(
-        key + (str(val/total_days),) for key, val in total_slack.items()
+    if bid_source is None:
+        keys, bids = read_relaxation_bids(scenarios)
+    else:
+        keys, bids = read_relaxation_bids([bid_source[s] for s in scenarios])
+    save_relaxation_bids(
+        keys, bids,
+        # record the prices used to get these bids, if they all used the same ones
+        prices=(
+            None if final or reused or bid_source is not None
+            else read_relaxation_price_file(slice_price_file)
+        ),
+        final=final, bid_source=bid_source
     )
+
+def save_relaxation_bids(keys, bids, prices, final=False, bid_source=None):
+    """
+    Save the bids from all slices in the bid store, as returned by
+    read_relaxation_bids(). prices is a dict of the relaxation prices used to
+    get these bids, or None if they were not all solved with the same prices.
+    bid_source is given for clustered rounds (see cluster_bid_sources()).
+    """
+    if not final:
+        report_cluster_error(keys, bids, bid_source)
+    cost_col = keys.index(('SystemCost',))
+    slack_cols = [i for i, k in enumerate(keys) if i != cost_col]
+    keys = [keys[i] for i in slack_cols]
+    slice_cost = bids[:, cost_col]
+    slack_matrix = bids[:, slack_cols]
+    day_counts = get_slice_weights()
+
     # save results
     iteration = get_iteration_count()
-    write_bid_file(slice_bid_file, sorted(slice_slack), iteration)
-    write_bid_file(bid_file, averages, iteration)
+    bid_store = BidStore(bid_store_dir)
+    if iteration == 0 and not final:
+        # in the first round, clear out any bids from earlier runs
+        bid_store.reset()
+    # note the tolerance if the slices were solved inexactly (see choose_slice_tolerance())
+    mipgap, time_limit = (None, None) if final else get_slice_tolerance(iteration)
+    bid_store.append_round(
+        iteration, scenarios, keys, slack_matrix, slice_cost, day_counts,
+        prices=prices, name='final' if final else None,
+        mipgap=mipgap, time_limited=time_limit is not None,
+        clustered=bid_source is not None
+    )
+
+def get_slice_weights():
+    """
+    Return a vector showing the weight of each slice (number of days it
+    represents). These are read once per run and then cached.
+    """
+    global slice_weights
+    if slice_weights is None:
+        day_counts = []
+        for s in scenarios:
+            weight_file = os.path.join(slices_dir, s, 'slice_weight.txt')
+            if os.path.exists(weight_file):
+                # multi-day slice (see slice_groups.py)
+                with open(weight_file) as f:
+                    day_counts.append(float(f.read().strip()))
+                continue
+            with open(os.path.join(slices_dir, s, 'timeseries.tab')) as f:
+                day_counts.append(sum(1 for row in f) - 1)
+        slice_weights = np.array(day_counts, dtype=float)
+    return slice_weights
 
-def write_bid_file(file, bids, iteration):
-    with open(file, 'a') as f:
-        if iteration == 0:
-            # in the first round, truncate the file if it exists already
-            f.seek(0)
-        f.writelines(tsv((iteration,) + row) for row in bids)
+def read_relaxation_bids(slices):
+    """
+    Read the most recent relaxation bids (slack and total cost) for all the
+    slices into a single array. Returns (keys, bids), where keys is a list of
+    (constraint name, index1, ..., indexn) tuples (including ('SystemCost',))
+    and bids is a len(slices) x len(keys) array.
+    """
+    # read the key and value columns from each file
+    cols = []
+    for s in slices:
+        with open(os.path.join(slice_outputs_dir, s, relaxation_bid_file)) as f:
+            cols.append(tuple(zip(*(row.rstrip('\n').rsplit('\t', 1) for row in f))))
+    return stack_relaxation_bids(cols)
+
+def stack_relaxation_bids(cols):
+    """
+    Combine bids from several slices into a single array. cols is a list with
+    one (keys, values) pair per slice, where keys is a tuple of tab-separated
+    constraint keys and values is a tuple of the corresponding values (as
+    strings). Returns (keys, bids) in the same format as read_relaxation_bids().
+    """
+    key_cols = [k for k, v in cols]
+    val_cols = [v for k, v in cols]
+    # keys are normally in the same order in every slice, so we can just
+    # stack the values
+    if all(k == key_cols[0] for k in key_cols):
+        keys = key_cols[0]
+        bids = np.array(val_cols).astype(float)
+    else:
+        # some slices report different constraints; use the union of all keys,
+        # with zero slack where a key is missing
+        keys = sorted(set(k for keys in key_cols for k in keys))
+        key_pos = {k: i for i, k in enumerate(keys)}
+        bids = np.zeros((len(cols), len(keys)))
+        for row, (k, v) in enumerate(zip(key_cols, val_cols)):
+            bids[row, [key_pos[x] for x in k]] = np.array(v).astype(float)
+    return [tuple(k.split('\t')) for k in keys], bids
 
 def solve_slices_with_fixed_relaxation():
     print("")
@@ -443,18 +1913,34 @@ def solve_slices_with_fixed_relaxation():
     print("Performing final model runs with fixed cross-time slack for each scenario.")
     print("="*80)
     print("")
-    if os.path.exists('scenario_queue'):
-        shutil.rmtree('scenario_queue')
-    # solve all the slices, using relaxation prices
-    mpi_run(
-        'switch solve-scenarios '
-        '--add-cross-time-relaxation-variables '
-        '--fix-cross-time-relaxation-variables '
-        '--save-relaxation-bid '
-    )
-    # save final costs and slack in the bid file (actually may be a bad idea
-    # since it shows a false bid that will mess up the plans if it re-runs?)
-    calculate_average_cost_and_slack()
+    # skip slices that finished before any interruption
+    tag = 'final_{}'.format(get_iteration_count())
+    # (the slice cache is not used here: it only holds the bids, but the final
+    # evaluation is run for its detailed outputs)
+    slices = unfinished_slices(tag)
+    if slices and cmd_line_args.persistent_workers:
+        # the workers run each final model in a fresh `switch solve` process,
+        # which writes the standard outputs (see slice_worker.py)
+        with trace_phase('final_slices', slices=len(slices)):
+            solve_final_slices_with_worker_pool(slices, tag)
+    elif slices:
+        if os.path.exists(slice_queue_dir):
+            shutil.rmtree(slice_queue_dir)
+        write_scenario_list(get_slice_times().longest_first(slices), final=True)
+        # solve all the slices, using the allocated slack
+        with trace_phase('final_slices', slices=len(slices)):
+            mpi_run(
+                'switch solve-scenarios ' + solve_scenarios_args
+                + '--relaxation-bid-tag {} '.format(round_tag(tag))
+            )
+        # these models differ from the ones solved during the loop, so their
+        # times are not used for scheduling
+        record_slice_traces(slices, schedule=False)
+    # save final costs and slack in the bid store (separately from the rounds
+    # used by the master problem, so they won't be mistaken for a real bid
+    # if the loop is re-run)
+    with trace_phase('final_bid_aggregation'):
+        calculate_average_cost_and_slack(final=True)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,129 @@
+"""
+Run the cross-time allocation loop (solve_loop.py) for several construction
+scenarios at the same time, sharing one pool of slice workers.
+
+Each scenario gets its own copy of solve_loop.py
+(`python solve_loop.py --scenario <name> --worker-queue-dir <queue>`), which
+keeps its DW files and slice outputs in that scenario's outputs directory
+(see --scenario in solve_loop.py). A single pool of persistent slice workers
+(slice_worker.py --steal-tasks) solves the slices for all of them. Workers
+take tasks for their own slices first and then any other waiting task, so
+while one scenario is solving its base model or master problem (or has
+converged), its share of the cores goes to the other scenarios.
+
+Usage (e.g., in a slurm job, like solve_loop.slurm):
+
+    python solve_loop_scenarios.py [--scenarios name1 name2 ...] [solve_loop.py arguments]
+
+Any arguments not recognized here are passed on to every copy of
+solve_loop.py. Output from each loop is saved in logs/solve_loop_<name>.log.
+"""
+from __future__ import print_function
+
+import os, sys, time, shlex, pipes, argparse, subprocess
+import task_queue
+
+def read_scenario_names(scenario_list):
+    """Return the names of all the scenarios in the scenario list file."""
+    names = []
+    with open(scenario_list) as f:
+        for line in f:
+            args = shlex.split(line, comments=True)
+            if '--scenario-name' in args:
+                names.append(args[args.index('--scenario-name') + 1])
+    return names
+
+def start_loop(scenario, args, loop_args):
+    """Start solve_loop.py for one scenario; returns the process and its log file."""
+    cmd = [
+        sys.executable, 'solve_loop.py',
+        '--scenario', scenario, '--scenario-list', args.scenario_list,
+        '--worker-queue-dir', args.queue_dir
+    ] + loop_args
+    log = open(os.path.join(args.logs_dir, 'solve_loop_{}.log'.format(scenario)), 'a')
+    print("Starting loop for scenario {}: {}".format(
+        scenario, ' '.join(pipes.quote(a) for a in cmd)
+    ))
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run solve_loop.py for several construction scenarios, sharing one pool of slice workers.'
+    )
+    parser.add_argument('--scenarios', nargs='+', default=None,
+        help='Names of scenarios to evaluate (default is all scenarios in --scenario-list).')
+    parser.add_argument('--scenario-list', default='scenarios.txt',
+        help='File listing the construction scenarios (written by get_scenario_data.py).')
+    parser.add_argument('--queue-dir', default=os.path.join('outputs', 'task_queue'),
+        help='Directory for the task queue shared by all the loops and workers.')
+    parser.add_argument('--logs-dir', default='logs',
+        help='Directory for the output from each loop.')
+    parser.add_argument('--max-concurrent', type=int, default=None,
+        help='Maximum number of loops to run at the same time (each one solves its '
+             'base model and master problem on this node); others start as these finish.')
+    parser.add_argument('--max-models', type=int, default=None,
+        help='Maximum number of slice models each worker keeps in memory (see slice_worker.py).')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+        help='Number of seconds to wait between checks on the loops and workers.')
+    args, loop_args = parser.parse_known_args(args)
+
+    all_scenarios = read_scenario_names(args.scenario_list)
+    if args.scenarios is None:
+        waiting = all_scenarios
+    else:
+        unknown = [s for s in args.scenarios if s not in all_scenarios]
+        if unknown:
+            parser.error('Scenario(s) not found in {}: {}'.format(args.scenario_list, ', '.join(unknown)))
+        waiting = list(args.scenarios)
+
+    if not os.path.exists(args.logs_dir):
+        os.makedirs(args.logs_dir)
+
+    task_queue.init_queue(args.queue_dir)
+    worker_cmd = 'mpirun python slice_worker.py --queue-dir {} --steal-tasks'.format(
+        pipes.quote(args.queue_dir)
+    )
+    if args.max_models is not None:
+        worker_cmd += ' --max-models {}'.format(args.max_models)
+    print("Starting slice workers: {}".format(worker_cmd))
+    workers = subprocess.Popen(worker_cmd, shell=True)
+
+    # running has key=scenario, value=(process, log file)
+    running = {}
+    failed = []
+    try:
+        while waiting or running:
+            while waiting and (args.max_concurrent is None or len(running) < args.max_concurrent):
+                s = waiting.pop(0)
+                running[s] = start_loop(s, args, loop_args)
+            for s, (proc, log) in list(running.items()):
+                if proc.poll() is not None:
+                    log.close()
+                    del running[s]
+                    if proc.returncode:
+                        print("Loop for scenario {} failed with code {}; see {}.".format(
+                            s, proc.returncode, log.name
+                        ))
+                        failed.append(s)
+                    else:
+                        print("Loop for scenario {} finished.".format(s))
+            if workers.poll() is not None:
+                raise RuntimeError(
+                    'Slice workers exited unexpectedly with code {}.'.format(workers.returncode)
+                )
+            time.sleep(args.poll_interval)
+    finally:
+        for s, (proc, log) in running.items():
+            print("Stopping loop for scenario {}.".format(s))
+            proc.terminate()
+            proc.wait()
+            log.close()
+        task_queue.request_stop(args.queue_dir)
+        workers.wait()
+
+    if failed:
+        print("Loops failed for scenario(s): {}".format(', '.join(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+File-based task queue for handing slice solutions to persistent worker
+processes (see slice_worker.py). This lives on a shared filesystem, so the
+master script and the workers can run on different nodes.
+
+Layout of the queue directory:
+    tasks/<task id>.json           tasks waiting to be claimed
+    running/<task id>.<worker>.json   tasks claimed by a worker
+    done/<task id>.json            results from finished tasks
+    workers/<worker>.json          rank, number of ranks and host of each worker
+    stop                           tells the workers to exit
+
+Workers claim tasks by renaming them from tasks/ to running/, which is atomic,
+so each task is only solved once. All files are written to a temporary name
+first and then renamed, so readers never see a partially written file.
+"""
+import os, json, time
+from file_utils import atomic_open
+
+def queue_subdir(queue_dir, name):
+    return os.path.join(queue_dir, name)
+
+def init_queue(queue_dir):
+    """
+    Create the queue directory if needed and clear any tasks, results or stop
+    request left from an earlier run.
+    """
+    for d in ['tasks', 'running', 'done', 'workers']:
+        path = queue_subdir(queue_dir, d)
+        if os.path.exists(path):
+            for f in os.listdir(path):
+                os.remove(os.path.join(path, f))
+        else:
+            os.makedirs(path)
+    if os.path.exists(os.path.join(queue_dir, 'stop')):
+        os.remove(os.path.join(queue_dir, 'stop'))
+
+def write_json(file, data):
+    # write atomically, so readers never see partial data
+    with atomic_open(file) as f:
+        json.dump(data, f)
+
+def read_json(file):
+    with open(file) as f:
+        return json.load(f)
+
+def register_worker(queue_dir, worker, info):
+    """Record information about a worker (dict) for the master script."""
+    write_json(os.path.join(queue_subdir(queue_dir, 'workers'), worker + '.json'), info)
+
+def registered_workers(queue_dir):
+    """Return a dict of information about all registered workers, with key=worker."""
+    workers_dir = queue_subdir(queue_dir, 'workers')
+    return {
+        f[:-len('.json')]: read_json(os.path.join(workers_dir, f))
+        for f in os.listdir(workers_dir)
+        if f.endswith('.json')
+    }
+
+def add_tasks(queue_dir, tasks):
+    """
+    Add tasks to the queue. Each task is a dict with an 'id' key; any prior
+    result for the same task id is discarded.
+    """
+    for task in tasks:
+        done_file = os.path.join(queue_subdir(queue_dir, 'done'), task['id'] + '.json')
+        if os.path.exists(done_file):
+            os.remove(done_file)
+        write_json(os.path.join(queue_subdir(queue_dir, 'tasks'), task['id'] + '.json'), task)
+
+def waiting_tasks(queue_dir):
+    """Return a sorted list of ids of tasks that haven't been claimed yet."""
+    return sorted(
+        f[:-len('.json')]
+        for f in os.listdir(queue_subdir(queue_dir, 'tasks'))
+        if f.endswith('.json')
+    )
+
+def claim_task(queue_dir, task_id, worker):
+    """
+    Try to claim the specified task for this worker. Returns the task dict, or
+    None if another worker claimed it first.
+    """
+    running_file = os.path.join(
+        queue_subdir(queue_dir, 'running'), '{}.{}.json'.format(task_id, worker)
+    )
+    try:
+        os.rename(
+            os.path.join(queue_subdir(queue_dir, 'tasks'), task_id + '.json'),
+            running_file
+        )
+    except OSError:
+        # already claimed by another worker
+        return None
+    return read_json(running_file)
+
+def withdraw_task(queue_dir, task_id):
+    """
+    Remove a task from the queue if no worker has claimed it yet. Returns True
+    if the task was withdrawn, False if a worker already has it.
+    """
+    task = claim_task(queue_dir, task_id, 'withdrawn')
+    if task is None:
+        return False
+    os.remove(os.path.join(
+        queue_subdir(queue_dir, 'running'), '{}.{}.json'.format(task_id, 'withdrawn')
+    ))
+    return True
+
+def finish_task(queue_dir, task, worker, result):
+    """Record the result for a task and release the claim on it."""
+    result = dict(result, id=task['id'], worker=worker)
+    write_json(os.path.join(queue_subdir(queue_dir, 'done'), task['id'] + '.json'), result)
+    os.remove(os.path.join(
+        queue_subdir(queue_dir, 'running'), '{}.{}.json'.format(task['id'], worker)
+    ))
+
+def finished_tasks(queue_dir):
+    """Return a dict of results for all finished tasks, with key=task id."""
+    done_dir = queue_subdir(queue_dir, 'done')
+    return {
+        f[:-len('.json')]: read_json(os.path.join(done_dir, f))
+        for f in os.listdir(done_dir)
+        if f.endswith('.json')
+    }
+
+def remove_result(queue_dir, task_id):
+    """Discard the result for a finished task after it has been used."""
+    os.remove(os.path.join(queue_subdir(queue_dir, 'done'), task_id + '.json'))
+
+def wait_for_tasks(queue_dir, task_ids, poll_interval=1.0, check=None):
+    """
+    Wait until all the specified tasks are finished, then return their results
+    as a dict with key=task id. check() (if specified) is called while waiting
+    and should raise an exception if the workers are no longer running.
+    """
+    task_ids = set(task_ids)
+    while True:
+        results = {k: v for k, v in finished_tasks(queue_dir).items() if k in task_ids}
+        if len(results) == len(task_ids):
+            return results
+        if check is not None:
+            check()
+        time.sleep(poll_interval)
+
+def request_stop(queue_dir):
+    with open(os.path.join(queue_dir, 'stop'), 'w') as f:
+        f.write('stop\n')
+
+def stop_requested(queue_dir):
+    return os.path.exists(os.path.join(queue_dir, 'stop'))
+
+class TaskQueue(object):
+    """
+    Object interface to a queue directory, with the same methods as
+    coordinator.Coordinator, so solve_loop.py and slice_worker.py can use
+    either one.
+    """
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+
+    def init_queue(self):
+        init_queue(self.queue_dir)
+
+    def register_worker(self, worker, info):
+        register_worker(self.queue_dir, worker, info)
+
+    def registered_workers(self):
+        return registered_workers(self.queue_dir)
+
+    def add_tasks(self, tasks):
+        add_tasks(self.queue_dir, tasks)
+
+    def waiting_tasks(self):
+        return waiting_tasks(self.queue_dir)
+
+    def claim_task(self, task_id, worker):
+        return claim_task(self.queue_dir, task_id, worker)
+
+    def withdraw_task(self, task_id):
+        return withdraw_task(self.queue_dir, task_id)
+
+    def finish_task(self, task, worker, result):
+        finish_task(self.queue_dir, task, worker, result)
+
+    def finished_tasks(self):
+        return finished_tasks(self.queue_dir)
+
+    def remove_result(self, task_id):
+        remove_result(self.queue_dir, task_id)
+
+    def wait_for_tasks(self, task_ids, poll_interval=1.0, check=None):
+        return wait_for_tasks(self.queue_dir, task_ids, poll_interval, check)
+
+    def request_stop(self):
+        request_stop(self.queue_dir)
+
+    def stop_requested(self):
+        return stop_requested(self.queue_dir)
@@ -0,0 +1,3 @@
+# the modules under test live in the top-level directory of the repository
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
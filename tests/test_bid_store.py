@@ -0,0 +1,56 @@
+import os
+import pytest
+np = pytest.importorskip('numpy')
+from bid_store import BidStore
+
+def test_rounds_are_padded_after_new_keys_are_added(tmpdir):
+    store = BidStore(str(tmpdir))
+    slices = ['s1', 's2']
+    store.append_round(
+        1, slices, [('A', '1'), ('B', '1')],
+        np.array([[1.0, 2.0], [3.0, 4.0]]), [10.0, 20.0], [1.0, 1.0]
+    )
+    store.append_round(
+        2, slices, [('C', '1'), ('A', '1')],
+        np.array([[5.0, 6.0], [7.0, 8.0]]), [30.0, 40.0], [1.0, 1.0]
+    )
+    # reopen, as solve_loop.py does each iteration
+    store = BidStore(str(tmpdir))
+    assert store.keys == [('A', '1'), ('B', '1'), ('C', '1')]
+
+    first = store.load_round(1)
+    assert first['slice_slack'].tolist() == [[1.0, 2.0, 0.0], [3.0, 4.0, 0.0]]
+    assert first['slack'].tolist() == [2.0, 3.0, 0.0]
+    second = store.load_round(2)
+    assert second['slice_slack'].tolist() == [[6.0, 0.0, 5.0], [8.0, 0.0, 7.0]]
+
+    summary = store.slack_range()
+    assert summary['low'].tolist() == [[1.0, 0.0, 0.0], [3.0, 0.0, 0.0]]
+    assert summary['high'].tolist() == [[6.0, 2.0, 5.0], [8.0, 4.0, 7.0]]
+    assert summary['slice_cost'].tolist() == [30.0, 40.0]
+
+def test_weighted_slice_slack_includes_padded_rounds(tmpdir):
+    store = BidStore(str(tmpdir))
+    store.append_round(1, ['s1'], [('A', '1')], np.array([[2.0]]), [1.0], [1.0])
+    store.append_round(2, ['s1'], [('B', '1')], np.array([[4.0]]), [1.0], [1.0])
+    total = store.weighted_slice_slack({1: 0.5, 2: 0.25})
+    assert total.tolist() == [[1.0, 1.0]]
+
+def test_slack_range_leaves_out_clustered_rounds(tmpdir):
+    store = BidStore(str(tmpdir))
+    slices = ['s1', 's2']
+    keys = [('A', '1')]
+    store.append_round(1, slices, keys, np.array([[1.0], [2.0]]), [10.0, 20.0], [1.0, 1.0])
+    # s2 was given s1's bid
+    store.append_round(
+        2, slices, keys, np.array([[-5.0], [-5.0]]), [30.0, 30.0], [1.0, 1.0],
+        clustered=True
+    )
+    for rebuild in [False, True]:
+        if rebuild:
+            os.remove(store.slack_range_file)
+        summary = store.slack_range()
+        assert summary['low'].tolist() == [[1.0], [2.0]]
+        assert summary['high'].tolist() == [[1.0], [2.0]]
+        assert summary['slice_cost'].tolist() == [10.0, 20.0]
+        assert summary['round'] == 1
@@ -0,0 +1,41 @@
+import pytest
+np = pytest.importorskip('numpy')
+from dw_bounds import lagrangian_value, relative_gap
+
+def round_data(**extra):
+    # two slices with equal weight; slack is priced at 2 per unit
+    slice_cost = np.array([100.0, 300.0])
+    slice_slack = np.array([[10.0], [-10.0]])
+    weights = np.array([1.0, 1.0])
+    data = dict(
+        cost=np.array(weights.dot(slice_cost) / weights.sum()),
+        slack=weights.dot(slice_slack) / weights.sum(),
+        slice_cost=slice_cost, slice_slack=slice_slack, weights=weights,
+        prices=np.array([2.0]),
+    )
+    data.update(extra)
+    return data
+
+def test_exact_value_without_mipgap():
+    assert lagrangian_value(round_data()) == 200.0
+
+def test_standard_rounds_are_reduced_by_the_default_mipgap():
+    # slice objectives are 120 and 280, so the bound can be up to 1% of 200 lower
+    assert lagrangian_value(round_data(), default_mipgap=0.01) == pytest.approx(198.0)
+
+def test_saved_mipgap_overrides_the_default():
+    data = round_data(slice_mipgap=np.array(0.1))
+    assert lagrangian_value(data, default_mipgap=0.01) == pytest.approx(180.0)
+
+def test_bound_with_mipgap_does_not_exceed_the_true_optimum():
+    # each slice's reported value may be up to mipgap above its optimum
+    mipgap = 0.01
+    data = round_data()
+    objective = data['slice_cost'] + data['slice_slack'].dot(data['prices'])
+    optimum = float(data['weights'].dot(objective * (1 - mipgap)) / data['weights'].sum())
+    assert lagrangian_value(data, default_mipgap=mipgap) <= optimum + 1e-9
+
+def test_relative_gap():
+    assert relative_gap(200.0, None) is None
+    assert relative_gap(200.0, 198.0) == pytest.approx(0.01)
+    assert relative_gap(0.0, 0.0) == 0.0
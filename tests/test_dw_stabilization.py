@@ -0,0 +1,36 @@
+from dw_stabilization import Stabilizer
+
+def null_step(stabilizer, round):
+    # the master predicted a large improvement, but the slices found none
+    stabilizer.predicted_value = stabilizer.center_value + 100.0
+    stabilizer.add_round(round, stabilizer.center_value - 1.0, {'k': 1.0})
+
+def serious_step(stabilizer, round):
+    stabilizer.predicted_value = stabilizer.center_value + 1.0
+    stabilizer.add_round(round, stabilizer.center_value + 1.0, {'k': 100.0})
+
+def test_bundle_step_does_not_collapse_after_null_steps():
+    stabilizer = Stabilizer('bundle', step=0.5, min_step_fraction=0.01)
+    stabilizer.add_round(0, 0.0, {'k': 100.0})
+    for r in range(1, 40):
+        null_step(stabilizer, r)
+    assert stabilizer.step == 0.01
+    lower, upper = stabilizer.price_bounds(['k'], {'k': 1e6})
+    assert lower['k'] == 99.0
+    assert upper['k'] == 101.0
+    # the center doesn't move on null steps
+    assert stabilizer.center == {'k': 100.0}
+
+def test_bundle_step_is_capped_after_serious_steps():
+    stabilizer = Stabilizer('bundle', step=0.5, max_step_fraction=4.0)
+    stabilizer.add_round(0, 0.0, {'k': 100.0})
+    for r in range(1, 40):
+        serious_step(stabilizer, r)
+    assert stabilizer.step == 4.0
+
+def test_saved_step_is_clamped(tmpdir):
+    state_file = str(tmpdir.join('state.json'))
+    stabilizer = Stabilizer('bundle', state_file=state_file)
+    stabilizer.step = 1e-9
+    stabilizer.save_state()
+    assert Stabilizer('bundle', state_file=state_file, min_step_fraction=0.01).step == 0.01
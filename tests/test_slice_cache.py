@@ -0,0 +1,54 @@
+import os
+from slice_cache import SliceCache, hash_files, hash_dir, hash_code, cache_key
+
+def write(path, text):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+def test_hash_files_depends_on_contents_but_not_order(tmpdir):
+    a, b = str(tmpdir.join('a.tab')), str(tmpdir.join('b.tab'))
+    write(a, '1\n')
+    write(b, '2\n')
+    before = hash_files([a, b])
+    assert hash_files([b, a]) == before
+    write(b, '3\n')
+    assert hash_files([a, b]) != before
+    # a missing file gives a different hash from an empty one
+    os.remove(b)
+    missing = hash_files([a, b])
+    write(b, '')
+    assert hash_files([a, b]) != missing
+
+def test_hash_dir_uses_relative_names(tmpdir):
+    for d in ['one', 'two']:
+        write(str(tmpdir.join(d, 'sub', 'loads.tab')), 'x\n')
+    assert hash_dir(str(tmpdir.join('one'))) == hash_dir(str(tmpdir.join('two')))
+
+def test_hash_code_ignores_compiled_files(tmpdir):
+    write(str(tmpdir.join('pkg', 'mod.py')), 'x = 1\n')
+    before = hash_code(str(tmpdir.join('pkg')))
+    write(str(tmpdir.join('pkg', 'mod.pyc')), 'compiled')
+    assert hash_code(str(tmpdir.join('pkg'))) == before
+    write(str(tmpdir.join('pkg', 'mod.py')), 'x = 2\n')
+    assert hash_code(str(tmpdir.join('pkg'))) != before
+
+def test_cache_key_keeps_parts_separate():
+    assert cache_key('ab', 'c') != cache_key('a', 'bc')
+    assert cache_key('a', None) == cache_key('a', '')
+    assert cache_key('a', None) != cache_key('a')
+
+def test_entries_are_reused_and_trimmed(tmpdir):
+    cache = SliceCache(str(tmpdir), 1.0)
+    key = cache_key('slice', 'prices')
+    assert cache.get(key) is None
+    bid = [('SystemCost', '', '12.5'), ('Cap', '2020', '-1')]
+    cache.put(key, 's1', bid)
+    entry = cache.get(key)
+    assert entry['slice'] == 's1'
+    assert entry['cost'] == 12.5
+    assert entry['bid'] == [list(row) for row in bid]
+    cache.max_bytes = 0
+    cache.trim()
+    assert cache.get(key) is None
@@ -0,0 +1,28 @@
+import pytest
+np = pytest.importorskip('numpy')
+from slice_clusters import kmeans, clustering_error
+
+def test_kmeans_separates_distinct_groups():
+    x = np.array([[0.0, 0.0], [0.1, 0.0], [10.0, 10.0], [10.0, 10.1], [0.0, 0.1]])
+    labels, centers = kmeans(x, 2)
+    assert len(set(labels[[0, 1, 4]])) == 1
+    assert len(set(labels[[2, 3]])) == 1
+    assert labels[0] != labels[2]
+
+def test_kmeans_with_fewer_distinct_rows_than_clusters():
+    x = np.ones((4, 3))
+    labels, centers = kmeans(x, 3)
+    assert len(centers) == 1
+    assert (labels == 0).all()
+
+def test_clustering_error():
+    # slice 1 uses slice 0's bid; slice 2 is its own representative
+    slack = np.array([[1.0], [3.0], [0.0]])
+    cost = np.array([10.0, 14.0, 12.0])
+    weights = np.array([1.0, 1.0, 2.0])
+    cost_error, slack_error = clustering_error(slack, cost, weights, [(1, 0)], 1.0)
+    # average cost is 12 and the error in it is 4 * 1/4
+    assert cost_error == pytest.approx(1.0 / 12)
+    # average slack is 1 and the error in it is 2 * 1/4
+    assert slack_error == pytest.approx(0.5)
+    assert clustering_error(slack, cost, weights, [], 1.0) == (None, None)
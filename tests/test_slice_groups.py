@@ -0,0 +1,11 @@
+from slice_groups import group_days
+
+def test_stride_groups_span_the_calendar():
+    groups = group_days(['day{}'.format(i) for i in range(10)], 3, 'stride')
+    assert groups == [[0, 4, 8], [1, 5, 9], [2, 6], [3, 7]]
+
+def test_stride_groups_use_every_day_once():
+    groups = group_days(['day{}'.format(i) for i in range(365)], 7, 'stride')
+    assert len(groups) == 53
+    assert sorted(d for g in groups for d in g) == list(range(365))
+    assert all(g[1] - g[0] == 53 for g in groups)
@@ -0,0 +1,20 @@
+import pytest
+np = pytest.importorskip('numpy')
+from slice_memory import fit_coefficients
+
+default = np.array([10.0, 1.0])
+
+def test_defaults_are_used_without_measurements():
+    assert fit_coefficients([], [], default) is default
+
+def test_defaults_are_scaled_with_few_measurements():
+    # fewer than two measurements per coefficient: keep the shape of the
+    # defaults, scaled by the median ratio of measured to predicted memory
+    features = [[1.0, 10.0], [1.0, 20.0], [1.0, 30.0]]
+    measured = [40.0, 90.0, 200.0]    # predicted 20, 30, 40 -> ratios 2, 3, 5
+    assert fit_coefficients(features, measured, default).tolist() == [30.0, 3.0]
+
+def test_least_squares_with_enough_measurements():
+    features = [[1.0, x] for x in [1.0, 2.0, 3.0, 4.0]]
+    measured = [5.0 + 2.0 * x for x in [1.0, 2.0, 3.0, 4.0]]
+    assert np.allclose(fit_coefficients(features, measured, default), [5.0, 2.0])
@@ -0,0 +1,36 @@
+from task_queue import TaskQueue
+
+def make_queue(tmpdir):
+    queue = TaskQueue(str(tmpdir))
+    queue.init_queue()
+    queue.add_tasks([dict(id='0001_s1', slice='s1'), dict(id='0002_s2', slice='s2')])
+    return queue
+
+def test_each_task_is_claimed_once(tmpdir):
+    queue = make_queue(tmpdir)
+    assert queue.waiting_tasks() == ['0001_s1', '0002_s2']
+    assert queue.claim_task('0001_s1', 'w1')['slice'] == 's1'
+    assert queue.claim_task('0001_s1', 'w2') is None
+    assert queue.waiting_tasks() == ['0002_s2']
+    # claimed tasks can't be withdrawn; waiting ones can
+    assert not queue.withdraw_task('0001_s1')
+    assert queue.withdraw_task('0002_s2')
+    assert queue.waiting_tasks() == []
+
+def test_finished_task_can_be_added_and_claimed_again(tmpdir):
+    queue = make_queue(tmpdir)
+    task = queue.claim_task('0001_s1', 'w1')
+    queue.finish_task(task, 'w1', dict(bid=[['SystemCost', '1.0']]))
+    results = queue.finished_tasks()
+    assert results['0001_s1']['worker'] == 'w1'
+    assert results['0001_s1']['bid'] == [['SystemCost', '1.0']]
+
+    # the next round reuses the task id; the old result is discarded
+    queue.add_tasks([dict(id='0001_s1', slice='s1', iteration=2)])
+    assert '0001_s1' not in queue.finished_tasks()
+    task = queue.claim_task('0001_s1', 'w2')
+    assert task['iteration'] == 2
+    queue.finish_task(task, 'w2', dict(bid=[]))
+    assert queue.wait_for_tasks(['0001_s1'])['0001_s1']['worker'] == 'w2'
+    queue.remove_result('0001_s1')
+    assert queue.finished_tasks() == {}